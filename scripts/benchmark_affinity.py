@@ -0,0 +1,111 @@
+# Benchmark of affinity.affinity_matrix against the original implementation
+import sys
+import time
+import argparse
+import resource
+import subprocess
+import numpy as np
+
+from scipy.stats import norm
+from sklearn.metrics.pairwise import euclidean_distances
+from farmer_welder.stats import affinity
+
+MODES = ['old', 'new', 'inplace', 'f32']
+
+
+def affinity_matrix_old(dist: np.ndarray,
+                        k: int = 20,
+                        sigma: float = 0.5) -> np.ndarray:
+    """
+    Original implementation of affinity.affinity_matrix.
+    """
+    mach_eps = np.finfo(float).eps
+    dist_mat = (dist + dist.transpose()) / 2
+    np.fill_diagonal(dist_mat, 0)
+    dist_mat_sort = np.sort(dist_mat, axis=0)
+    means = np.mean(dist_mat_sort[1:k + 1], axis=0) + mach_eps
+    sig = (np.add.outer(means, means) / 2) / 3 * 2 + dist_mat / 3 + mach_eps
+    sig[sig <= mach_eps] = mach_eps
+    densities = norm.pdf(dist_mat, loc=0, scale=(sigma * sig))
+    W = (densities + densities.transpose()) / 2
+    return W
+
+
+def squared_distances(n: int,
+                      seed: int = 0) -> np.ndarray:
+    """
+    Squared euclidean distances of n random samples with 20 features.
+    """
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n, 20))
+    return euclidean_distances(X, squared=True)
+
+
+def affinity_mode(dist: np.ndarray,
+                  mode: str) -> np.ndarray:
+    """
+    Affinity matrix with one of the benchmarked implementations.
+    """
+    if mode == 'old':
+        return affinity_matrix_old(dist)
+    return affinity.affinity_matrix(dist,
+                                    dtype=np.float32 if mode == 'f32'
+                                    else np.float64,
+                                    overwrite_dist=mode == 'inplace')
+
+
+def run_mode(mode: str,
+             n: int):
+    """
+    Time a single implementation and print its time and the peak memory
+    used on top of the distance matrix. Run in its own process, since the
+    peak memory can't be reset.
+    """
+    dist = squared_distances(n)
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    affinity_mode(dist, mode)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'{n:>6} {mode:>8} {elapsed:>8.2f}s {(peak - base) / 1024:>9.0f} MB')
+
+
+def main():
+    """
+    Main routine
+    """
+    parser = argparse.ArgumentParser(description='Benchmark affinity_matrix')
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs='+',
+                        default=[2000, 8000],
+                        help='Number of samples')
+    parser.add_argument('--mode',
+                        choices=MODES,
+                        default=None,
+                        help='Run a single implementation (used internally)')
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        for n in args.sizes:
+            run_mode(args.mode, n)
+        return
+
+    print(f'{"n":>6} {"mode":>8} {"time":>9} {"extra RSS":>12}')
+    for n in args.sizes:
+        for mode in MODES:
+            subprocess.run([sys.executable, __file__, '--mode', mode,
+                            '--sizes', str(n)],
+                           check=True)
+    # Accuracy, on the smallest size
+    dist = squared_distances(min(args.sizes))
+    expected = affinity_matrix_old(dist)
+    for mode in ['new', 'f32']:
+        W = affinity_mode(dist.copy(), mode)
+        diff = np.abs(W - expected).max() / expected.max()
+        print(f'Max relative difference from the old kernel ({mode}): '
+              f'{diff:.1e}')
+
+
+if __name__ == '__main__':
+    main()
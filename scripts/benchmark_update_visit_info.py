@@ -0,0 +1,68 @@
+# Benchmark of load.update_visit_info against the original per-group loop
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+from farmer_welder.data import load
+
+
+def update_visit_info_loop(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Original implementation of load.update_visit_info, looping over the
+    groups (Visit is the column in position 5).
+    """
+    for ind, dat in data.groupby(['Study ID', 'Subj ID']):
+        if sum(dat['Visit']) > 3 and len(dat) > 1:
+            data.iloc[dat.index[0], 5] = 1
+            data.iloc[dat.index[1], 5] = 2
+    return data
+
+
+def make_ids(n: int,
+             seed: int = 0) -> pd.DataFrame:
+    """
+    Synthetic project_IDs table with n rows, about two visits per
+    participant, and 2% of the visits and participant IDs missing.
+    """
+    rng = np.random.default_rng(seed)
+    ids = pd.DataFrame({'PSU IEE': np.arange(n),
+                        'Internal Code': 0,
+                        'Visit Code': 0,
+                        'Study ID': rng.choice([5467, 37016], n),
+                        'Subj ID': rng.integers(0, n // 2, n).astype(float),
+                        'Visit': rng.choice([1, 2, 3, 4, 5], n).
+                        astype(float)})
+    ids.loc[rng.choice(n, n // 50), 'Visit'] = np.nan
+    ids.loc[rng.choice(n, n // 50), 'Subj ID'] = np.nan
+    return ids
+
+
+def main():
+    """
+    Main routine
+    """
+    parser = argparse.ArgumentParser(description='Benchmark '
+                                                 'update_visit_info')
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs='+',
+                        default=[1000, 4000, 16000, 64000],
+                        help='Number of rows of the ID tables')
+    args = parser.parse_args()
+
+    print(f'{"rows":>7} {"loop":>9} {"vectorized":>11}  equal')
+    for n in args.sizes:
+        ids = make_ids(n)
+        start = time.perf_counter()
+        expected = update_visit_info_loop(ids.copy())
+        loop_time = time.perf_counter() - start
+        start = time.perf_counter()
+        result = load.update_visit_info(ids.copy())
+        vectorized_time = time.perf_counter() - start
+        print(f'{n:>7} {loop_time:>8.3f}s {vectorized_time:>10.3f}s  '
+              f'{expected.equals(result)}')
+
+
+if __name__ == '__main__':
+    main()
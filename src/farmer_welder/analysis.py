@@ -1,20 +1,22 @@
-import clarite
+import os
+import argparse
+import numpy as np
 import pandas as pd
-import statsmodels.formula.api as smf
-from typing import List
+import statsmodels.api as sm
+from typing import List, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor
 
 from farmer_welder.data import load, clean
-from farmer_welder.stats import stats
+from farmer_welder.stats import mixed, regression, resampling, stats
 from statsmodels.stats.multitest import multipletests
 
 
 def transform(dat: pd.DataFrame,
               replace_columns: dict,
-              exposures: List[str],
-              metabolites: List[str],
-              grouping: List[bool]) -> pd.DataFrame:
+              columns: List[str],
+              transformer: stats.DataTransformer) -> pd.DataFrame:
     """
-    Transform column names and transform data
+    Transform data and column names
 
     Parameters
     ----------
@@ -22,32 +24,85 @@ def transform(dat: pd.DataFrame,
         Original dataset.
     replace_columns: dict
         Dictionary with column names to replace.
-    exposures: List[str]
-        List of exposures to transform.
-    metabolites: List[str]
-        List of metabolites to transform.
-    grouping: list[bool]
-        List of bool to separate two groups.
+    columns: List[str]
+        List of columns to transform, with the original names.
+    transformer: stats.DataTransformer
+        Transformation fitted on the baseline data, grouped by project.
 
     Returns
     -------
     dat: pd.DataFrame
         Transformed dataset.
     """
+    dat.loc[:, columns] = transformer.transform(dat.loc[:, columns],
+                                                groups=dat['project_id'])
     dat = dat.rename(columns=replace_columns)
     dat = clean.transform_to_dummy(dat)
-    dat.loc[:, exposures] = stats.transform_data(dat.loc[:, exposures],
-                                                 grouping=grouping)
-    dat.loc[:, metabolites] = stats.transform_data(dat.loc[:, metabolites],
-                                                   grouping=grouping)
     return dat
 
 
+_worker_data = None
+_worker_cache = None
+
+
+def _init_worker(dat: Union[pd.DataFrame, None]):
+    """
+    Store the shared data frame, and a cache of its designs, once per worker
+    process. None releases them.
+    """
+    global _worker_data, _worker_cache
+    _worker_data = dat
+    _worker_cache = None if dat is None else regression.DesignCache(dat)
+
+
+def _fit_mixedlm(task: Tuple[str, str, List[str], np.ndarray, np.ndarray]) \
+        -> tuple:
+    """
+    Fit the linear mixed model `met ~ covariates + exp * Visit` of a single
+    exposure and metabolite pair, with a random intercept per participant.
+    The covariate design and the groups of the rows with complete
+    covariates, visit and participant come from the worker's cache, so they
+    are shared by all the pairs, and are restricted to the rows of the pair.
+
+    Parameters
+    ----------
+    task: Tuple[str, str, List[str], np.ndarray, np.ndarray]
+        Exposure, metabolite, covariate columns, the boolean mask of rows
+        with complete covariates, visit and participant, and the boolean
+        mask of complete rows to fit (within the former).
+
+    Returns
+    -------
+    fit: tuple
+        Converged flag, pvalue, coef and nobs of the exposure term.
+    """
+    exp, met, covariates, valid, mask = task
+    design = _worker_cache.get(covariates, valid)
+    groups, _ = _worker_cache.groups(covariates, valid, 'study_id')
+    rows = mask[valid]
+    covs = design['covs'][rows]
+    exp_values = _worker_data.loc[mask, exp].to_numpy(dtype=float)
+    visit = _worker_data.loc[mask, 'Visit'].to_numpy(dtype=float)
+    exog = np.column_stack([covs, exp_values, visit, exp_values * visit])
+    endog = _worker_data.loc[mask, met].to_numpy(dtype=float)
+    j = covs.shape[1]
+    try:
+        mdf = sm.MixedLM(endog, exog, groups=groups[rows]).fit()
+    except (np.linalg.LinAlgError, ValueError):
+        return False, np.nan, np.nan, np.nan
+    return mdf.converged, mdf.pvalues[j], mdf.params[j], mdf.nobs
+
+
 def analysis(dat: pd.DataFrame,
              exposures: List[str],
              metabolites: List[str],
              covariates: str,
-             baseline: bool = True) -> pd.DataFrame:
+             baseline: bool = True,
+             n_jobs: int = 1,
+             n_permutations: int = 0,
+             n_bootstrap: int = 0,
+             seed: Union[int, None] = None,
+             lmm_solver: str = 'reml') -> pd.DataFrame:
     """
     Main analysis.
 
@@ -64,34 +119,80 @@ def analysis(dat: pd.DataFrame,
     baseline: bool
         Run the analysis with baseline data (no repeated measures). Else, runs
         a linear mixed model for repeated measures.
+    n_jobs: int
+        Number of processes used to fit the linear mixed models (with the
+        statsmodels solver), or to run the resamples. -1 uses all the
+        available cores.
+    n_permutations: int
+        Number of permutations to compute max-T family-wise error rate
+        adjusted pvalues (pvalue_fwer), in the baseline analysis. If 0,
+        they are not computed.
+    n_bootstrap: int
+        Number of bootstrap replicates, resampling the participants, for the
+        95% percentile confidence intervals of the coefficients
+        (coef_ci_lower and coef_ci_upper). The linear mixed models are
+        refitted with the closed form solver, whatever lmm_solver is. If 0,
+        they are not computed.
+    seed: int or None
+        Seed of the permutations and bootstrap replicates.
+    lmm_solver: str
+        Solver of the linear mixed models: 'reml' for the closed form random
+        intercept solver (mixed.random_intercept_lmm), or 'statsmodels' to
+        fit each pair with smf.mixedlm (e.g. to validate the former).
 
     Returns
     -------
     res: pd.DataFrame
         Results table.
     """
-    # Creating results dataset
-    combinations = [(x, y) for x in exposures for y in metabolites]
-    res = pd.DataFrame(combinations, columns=['exposures', 'metabolites'])
-    res.loc[:, 'converged'] = True
-    res.loc[:, ['pvalue', 'coef', 'nobs']] = 0
-    res = res.set_index(['exposures', 'metabolites'])
-
-    for exp in exposures:
-        for met in metabolites:
-            dat.loc[:, [exp, met]] = clarite.modify.remove_outliers(dat.loc[:, [exp, met]])
-            if baseline:
-                formula = met + ' ~ ' + covariates + ' + ' + exp
-                mdf = smf.ols(formula, dat,
-                              missing='drop').fit()
-            else:
-                formula = met + ' ~ ' + covariates + ' + ' + exp + ' * Visit'
-                mdf = smf.mixedlm(formula, dat,
-                                  groups=dat.loc[:, 'study_id'], missing='drop').fit()
-                res.loc[(exp, met), 'converged'] = mdf.converged
-            res.loc[(exp, met), 'pvalue'] = mdf.pvalues[exp]
-            res.loc[(exp, met), 'coef'] = mdf.params[exp]
-            res.loc[(exp, met), 'nobs'] = mdf.nobs
+    # Outliers are flagged once per column, and combined for each pair
+    outliers = clean.get_outlier_mask(dat, exposures + metabolites)
+    # The covariate designs are built once per set of complete rows
+    covs = regression.get_formula_terms(covariates)
+    cache = regression.DesignCache(dat)
+    if baseline:
+        # All pairs share the covariate design, solve them in batch
+        res = regression.ols_association(dat, exposures, metabolites, covs,
+                                         exclude=outliers, cache=cache)
+        res = res.loc[:, ['pvalue', 'coef', 'nobs']]
+        res.insert(0, 'converged', True)
+    elif lmm_solver == 'reml':
+        # Random intercept models, batched over the metabolites
+        res = mixed.random_intercept_lmm(dat, exposures, metabolites, covs,
+                                         exclude=outliers, cache=cache)
+        res = res.loc[:, ['converged', 'pvalue', 'coef', 'nobs']]
+    elif lmm_solver == 'statsmodels':
+        valid = ~np.isnan(cache.covariates(covs)).any(axis=1) & \
+            dat.loc[:, ['Visit', 'study_id']].notna().all(axis=1).to_numpy()
+        tasks = []
+        for exp in exposures:
+            keep_exp = valid & dat.loc[:, exp].notna().to_numpy() & \
+                ~outliers.loc[:, exp].to_numpy()
+            for met in metabolites:
+                keep = keep_exp & dat.loc[:, met].notna().to_numpy() & \
+                    ~outliers.loc[:, met].to_numpy()
+                tasks.append((exp, met, covs, valid, keep))
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+        if n_jobs > 1:
+            with ProcessPoolExecutor(max_workers=n_jobs,
+                                     initializer=_init_worker,
+                                     initargs=(dat,)) as executor:
+                fits = list(executor.map(_fit_mixedlm, tasks))
+        else:
+            _init_worker(dat)
+            try:
+                fits = [_fit_mixedlm(task) for task in tasks]
+            finally:
+                _init_worker(None)
+        index = pd.MultiIndex.from_tuples([task[:2] for task in tasks],
+                                          names=['exposures', 'metabolites'])
+        res = pd.DataFrame(fits,
+                           columns=['converged', 'pvalue', 'coef', 'nobs'],
+                           index=index)
+        res.loc[:, 'converged'] = res.loc[:, 'converged'].astype(bool)
+    else:
+        raise ValueError('lmm_solver should be reml or statsmodels')
 
     # Correct for multiple testing
     converged_tests = res.loc[:, 'converged']
@@ -99,6 +200,18 @@ def analysis(dat: pd.DataFrame,
                                method='fdr_bh')
     res.loc[:, 'pvalue_fdr'] = 1
     res.loc[converged_tests, 'pvalue_fdr'] = pvalue_fdr[1]
+    if baseline and n_permutations > 0:
+        res.loc[:, 'pvalue_fwer'] = resampling.maxt_pvalues(
+            dat, exposures, metabolites, covs, exclude=outliers,
+            n_permutations=n_permutations, seed=seed, n_jobs=n_jobs,
+            cache=cache)
+    if n_bootstrap > 0:
+        bootstrap = resampling.bootstrap_ci if baseline else \
+            resampling.lmm_bootstrap_ci
+        ci = bootstrap(dat, exposures, metabolites, covs, exclude=outliers,
+                       n_bootstrap=n_bootstrap, seed=seed, n_jobs=n_jobs,
+                       cache=cache)
+        res = res.join(ci)
     return res
 
 
@@ -106,22 +219,54 @@ def main():
     """
     Main routine
     """
-    welders = pd.read_csv('data/processed/welders.csv')
-    grouping = welders.loc[:, 'project_id'] == 37016
+    parser = argparse.ArgumentParser(description='Run association analysis')
+    parser.add_argument('--n-jobs',
+                        type=int,
+                        default=1,
+                        help='Number of processes for the linear mixed '
+                             'models and permutations (-1 uses all cores)')
+    parser.add_argument('--lmm-solver',
+                        choices=['reml', 'statsmodels'],
+                        default='reml',
+                        help='Solver of the linear mixed models')
+    parser.add_argument('--n-permutations',
+                        type=int,
+                        default=0,
+                        help='Number of permutations for the max-T FWER '
+                             'pvalues of the baseline analysis')
+    parser.add_argument('--n-bootstrap',
+                        type=int,
+                        default=0,
+                        help='Number of bootstrap replicates for the '
+                             'confidence intervals of the coefficients')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=None,
+                        help='Seed of the permutations and bootstrap')
+    args = parser.parse_args()
+
+    welders = load.load_processed_data('welders')
     welders_bs = load.load_baseline_data('welders')
-    grouping_bs = welders_bs.loc[:, 'project_id'] == 37016
+    transformer = stats.DataTransformer.load(
+        load.get_transformer_path('welders'))
     exposures = ['elt', 'e90', 'fe', 'mn', 'pb']
     og_metabolites = load.get_metabolites()
     metabolites = load.get_metabolites(True)
     replace_metabolites = dict(zip(og_metabolites, metabolites))
-    welders = transform(welders, replace_metabolites, exposures, metabolites,
-                        grouping)
-    welders_bs = transform(welders_bs, replace_metabolites, exposures,
-                           metabolites, grouping_bs)
+    columns = exposures + og_metabolites
+    welders = transform(welders, replace_metabolites, columns, transformer)
+    welders_bs = transform(welders_bs, replace_metabolites, columns,
+                           transformer)
     covariates = 'age + years_of_education + sexd + ' \
                  'smoked_regularly + project_idd'
 
-    res = analysis(welders, exposures, metabolites, covariates, baseline=False)
-    res_bs = analysis(welders_bs, exposures, metabolites, covariates)
+    res = analysis(welders, exposures, metabolites, covariates, baseline=False,
+                   n_jobs=args.n_jobs, n_bootstrap=args.n_bootstrap,
+                   seed=args.seed, lmm_solver=args.lmm_solver)
+    res_bs = analysis(welders_bs, exposures, metabolites, covariates,
+                      n_jobs=args.n_jobs,
+                      n_permutations=args.n_permutations,
+                      n_bootstrap=args.n_bootstrap,
+                      seed=args.seed)
     res.to_csv('results/reports/LMM_res.csv')
     res_bs.to_csv('results/reports/LR_res.csv')
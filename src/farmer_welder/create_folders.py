@@ -3,10 +3,10 @@ import os
 
 def main():
     parent_data = 'data'
-    subdir_data = ['raw', 'processed']
+    subdir_data = ['raw', 'processed', 'cache']
 
     parent_results = 'results'
-    subdir_results = ['figures', 'reports']
+    subdir_results = ['figures', 'reports', 'models']
 
     for folder in [parent_data, parent_results]:
         if not os.path.exists(folder):
@@ -0,0 +1,164 @@
+# Binary cache of intermediate datasets keyed by the raw input files
+import os
+import glob
+import hashlib
+import pandas as pd
+from typing import List, Union
+
+CACHE_DIR = 'data/cache'
+# Bump to invalidate old entries (changes to the loading code of the data
+# package already invalidate them, see loader_digest)
+CACHE_VERSION = 1
+# Maximum size of the cache folder before evicting old entries
+MAX_CACHE_BYTES = 2 * 1024 ** 3
+
+
+def file_digest(path: str) -> str:
+    """
+    Get the SHA-256 digest of a file content
+
+    Parameters
+    ----------
+    path: str
+        Path to the file.
+
+    Returns
+    -------
+    digest: str
+        Hexadecimal digest.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 ** 2), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def loader_digest() -> str:
+    """
+    Get the SHA-256 digest of the source of the data package modules that
+    build the cached datasets, so any change to the loading logic (row
+    order, dtypes, merges) invalidates the cache
+
+    Returns
+    -------
+    digest: str
+        Hexadecimal digest.
+    """
+    sha = hashlib.sha256()
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    for path in sorted(glob.glob(os.path.join(package_dir, '*.py'))):
+        sha.update(f'{os.path.basename(path)}:{file_digest(path)}'.encode())
+    return sha.hexdigest()
+
+
+def get_cache_key(name: str,
+                  files: List[str]) -> str:
+    """
+    Build a cache key from a name, the content of the input files and the
+    loading code
+
+    Parameters
+    ----------
+    name: str
+        Name of the cached dataset (e.g. 'raw_farmers').
+    files: List[str]
+        Input files the dataset is built from.
+
+    Returns
+    -------
+    key: str
+        Cache key, the name followed by a digest of the inputs.
+    """
+    sha = hashlib.sha256()
+    sha.update(f'{name}:{CACHE_VERSION}:{loader_digest()}'.encode())
+    for file in sorted(files):
+        sha.update(f'{os.path.basename(file)}:{file_digest(file)}'.encode())
+    key = name + '_' + sha.hexdigest()[:16]
+    return key
+
+
+def _get_cache_path(key: str) -> str:
+    return os.path.join(CACHE_DIR, key + '.pkl')
+
+
+def read_cache(key: str) -> Union[pd.DataFrame, None]:
+    """
+    Read a dataset from the cache
+
+    Parameters
+    ----------
+    key: str
+        Cache key.
+
+    Returns
+    -------
+    dat: pd.DataFrame or None
+        Cached dataset, or None if it is not in the cache.
+    """
+    path = _get_cache_path(key)
+    if not os.path.exists(path):
+        return None
+    # Update the modification time to keep track of the last use
+    os.utime(path)
+    dat = pd.read_pickle(path)
+    return dat
+
+
+def write_cache(key: str,
+                dat: pd.DataFrame,
+                max_bytes: int = MAX_CACHE_BYTES):
+    """
+    Write a dataset to the cache, replacing older versions with the same name
+    and evicting the least recently used entries above max_bytes.
+
+    Parameters
+    ----------
+    key: str
+        Cache key.
+    dat: pd.DataFrame
+        Dataset to cache.
+    max_bytes: int
+        Maximum size of the cache folder.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    name = key.rsplit('_', 1)[0]
+    clear_cache(name)
+    dat.to_pickle(_get_cache_path(key))
+    evict_cache(max_bytes)
+
+
+def clear_cache(name: Union[str, None] = None):
+    """
+    Remove entries from the cache
+
+    Parameters
+    ----------
+    name: str or None
+        Name of the cached dataset to remove. If None, remove all entries.
+    """
+    pattern = '*.pkl' if name is None else name + '_*.pkl'
+    for path in glob.glob(os.path.join(CACHE_DIR, pattern)):
+        if name is None or \
+                os.path.basename(path).rsplit('_', 1)[0] == name:
+            os.remove(path)
+
+
+def evict_cache(max_bytes: int = MAX_CACHE_BYTES):
+    """
+    Remove the least recently used entries until the cache folder is
+    below max_bytes.
+
+    Parameters
+    ----------
+    max_bytes: int
+        Maximum size of the cache folder.
+    """
+    paths = glob.glob(os.path.join(CACHE_DIR, '*.pkl'))
+    paths.sort(key=os.path.getmtime)
+    total = sum(os.path.getsize(path) for path in paths)
+    for path in paths[:-1]:
+        if total <= max_bytes:
+            break
+        total -= os.path.getsize(path)
+        os.remove(path)
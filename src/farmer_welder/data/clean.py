@@ -1,6 +1,8 @@
 # Cleaning of datasets
 import pandas as pd
 
+from typing import List
+
 
 def transform_education(dat: pd.DataFrame) -> pd.DataFrame:
     """
@@ -69,3 +71,30 @@ def transform_to_dummy(dat: pd.DataFrame) -> pd.DataFrame:
     dat.loc[dat.loc[:, 'project_id'] == 37016, 'project_idd'] = 0
     dat.loc[dat.loc[:, 'project_id'] == 5467, 'project_idd'] = 1
     return dat
+
+
+def get_outlier_mask(dat: pd.DataFrame,
+                     columns: List[str],
+                     cutoff: float = 3.0) -> pd.DataFrame:
+    """
+    Flag the outliers of each column, those values that are more than cutoff
+    standard deviations away from the column mean.
+
+    Parameters
+    ----------
+    dat: pd.DataFrame
+        Dataset with the columns to evaluate.
+    columns: List[str]
+        Columns to evaluate.
+    cutoff: float
+        Number of standard deviations from the mean to flag a value.
+
+    Returns
+    -------
+    outliers: pd.DataFrame
+        Boolean data frame, True where the value is an outlier.
+    """
+    values = dat.loc[:, columns]
+    distance = (values - values.mean()).abs()
+    outliers = distance > cutoff * values.std()
+    return outliers
@@ -1,12 +1,21 @@
 # Load different data files for project
+import os
 import re
 import glob
 import numpy as np
 import pandas as pd
-from typing import List
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import Callable, Iterator, List, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+from farmer_welder.data import cache
 
-def load_raw_data(cohort: str = 'farmers') -> pd.DataFrame:
+
+def load_raw_data(cohort: str = 'farmers',
+                  use_cache: bool = True,
+                  refresh: bool = False,
+                  n_jobs: int = 1) -> pd.DataFrame:
     """
     Load complete data for either farmers or welders
 
@@ -14,6 +23,67 @@ def load_raw_data(cohort: str = 'farmers') -> pd.DataFrame:
     ----------
     cohort: str
         Either the 'farmers' or 'welders' cohort.
+    use_cache: bool
+        Whether to return the cached merged data when none of the raw input
+        files changed, and to cache newly merged data.
+    refresh: bool
+        Rebuild the merged data even if it is in the cache.
+    n_jobs: int
+        Number of threads used to load the project files in parallel.
+
+    Returns
+    -------
+    dat: pd.DataFrame
+        Data frame with complete data.
+    """
+    if not use_cache:
+        return _merge_raw_data(cohort, n_jobs)
+    key = cache.get_cache_key('raw_' + cohort,
+                              get_raw_files(cohort))
+    final_data = None if refresh else cache.read_cache(key)
+    if final_data is None:
+        final_data = _merge_raw_data(cohort, n_jobs)
+        cache.write_cache(key, final_data)
+    return final_data
+
+
+def get_raw_files(cohort: str = 'farmers') -> List[str]:
+    """
+    Get the raw input files used to build the data of a cohort
+
+    Parameters
+    ----------
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+
+    Returns
+    -------
+    files: List[str]
+        List of file paths.
+    """
+    if cohort not in ['farmers', 'welders']:
+        raise ValueError('type should be farmers or welders')
+    files = ['data/raw/project_IDs.csv',
+             'data/raw/metabolite_concentration.csv']
+    files += get_project_files(cohort)
+    if cohort == 'welders':
+        files += ['data/raw/Whole blood results all metals.xlsx',
+                  'data/raw/UNC WH Exposure.csv',
+                  'data/raw/UNC SEQ Exposure.csv']
+    return files
+
+
+def _merge_raw_data(cohort: str = 'farmers',
+                    n_jobs: int = 1) -> pd.DataFrame:
+    """
+    Read and merge the raw data for either farmers or welders
+
+    Parameters
+    ----------
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+    n_jobs: int
+        Number of threads used to load the project files in parallel.
 
     Returns
     -------
@@ -24,18 +94,196 @@ def load_raw_data(cohort: str = 'farmers') -> pd.DataFrame:
     ids = pd.read_csv('data/raw/project_IDs.csv')
     ids = update_visit_info(ids)
     metabolites = pd.read_csv('data/raw/metabolite_concentration.csv')
+    full_project = _load_project_data(cohort, n_jobs)
+
+    # MERGE DATA
+    final_data = _merge_metabolites(metabolites, ids, full_project, cohort)
+    return final_data
+
+
+def stream_raw_data(cohort: str = 'farmers',
+                    chunksize: int = 1000,
+                    n_jobs: int = 1,
+                    transform: Union[Callable[[pd.DataFrame], pd.DataFrame],
+                                     None] = None) -> str:
+    """
+    Merge the raw data for either farmers or welders reading the metabolite
+    concentrations in chunks, and write it incrementally to the processed
+    dataset. Peak memory depends on the chunk size, not on the number of
+    samples in the metabolite file. The dtypes are declared before reading
+    the chunks, and the dataset is written to a temporary file that only
+    replaces the processed one when complete (a ValueError is raised if no
+    samples are merged).
 
+    Parameters
+    ----------
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+    chunksize: int
+        Number of metabolite rows to read at a time.
+    n_jobs: int
+        Number of threads used to load the project files in parallel.
+    transform: Callable or None
+        Function applied to each merged chunk before writing it
+        (e.g. clean.transform_education).
+
+    Returns
+    -------
+    path: str
+        Path to the processed dataset.
+    """
+    path = get_processed_path(cohort)
+    ids = pd.read_csv('data/raw/project_IDs.csv')
+    ids = update_visit_info(ids)
+    full_project = _load_project_data(cohort, n_jobs)
+
+    # Declare the dtypes up front, so they don't depend on the chunk
+    metabolite_file = 'data/raw/metabolite_concentration.csv'
+    dtypes = {col: 'float64' for col in get_metabolites()}
+    dtypes['PSU IEE'] = ids['PSU IEE'].dtype
+    header = pd.read_csv(metabolite_file, nrows=0).columns
+    # The dtypes of the other columns are inferred from the whole file
+    dtypes.update(_infer_csv_dtypes(metabolite_file,
+                                    [col for col in header
+                                     if col not in dtypes],
+                                    chunksize))
+
+    tmp_path = path + '.tmp'
+    writer = None
+    schema = None
+    chunks = pd.read_csv(metabolite_file,
+                         chunksize=chunksize,
+                         dtype=dtypes)
+    try:
+        for i, metabolites in enumerate(chunks):
+            merged = _merge_metabolites(metabolites, ids, full_project,
+                                        cohort)
+            if transform is not None:
+                merged = transform(merged)
+            if len(merged) == 0:
+                continue
+            if schema is None:
+                schema = _stream_schema(merged)
+                writer = pq.ParquetWriter(tmp_path, schema)
+            try:
+                table = pa.Table.from_pandas(merged,
+                                             schema=schema,
+                                             preserve_index=False)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, KeyError) as e:
+                raise ValueError(f'Chunk {i} of the metabolite file does '
+                                 f'not match the schema of the first '
+                                 f'chunk: {e}') from e
+            writer.write_table(table)
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if writer is None:
+        raise ValueError(f'No {cohort} samples were merged, {path} was not '
+                         f'written')
+    writer.close()
+    # Replace the processed dataset only once it's complete
+    os.replace(tmp_path, path)
+    return path
+
+
+def _infer_csv_dtypes(file: str,
+                      columns: List[str],
+                      chunksize: int) -> dict:
+    """
+    Infer the dtypes that pandas gives to some columns of a csv file when
+    reading it whole, reading only those columns one chunk at a time.
+    """
+    if len(columns) == 0:
+        return {}
+    kinds = {col: set() for col in columns}
+    has_nan = {col: False for col in columns}
+    for chunk in pd.read_csv(file, usecols=columns, chunksize=chunksize):
+        for col in columns:
+            missing = chunk[col].isna()
+            has_nan[col] |= missing.any()
+            if not missing.all():
+                kinds[col].add(chunk[col].dtype.kind)
+    dtypes = {}
+    for col in columns:
+        if kinds[col] <= {'i'} and kinds[col] and not has_nan[col]:
+            dtypes[col] = 'int64'
+        elif kinds[col] <= {'b'} and kinds[col] and not has_nan[col]:
+            dtypes[col] = 'bool'
+        elif kinds[col] <= {'i', 'f'}:
+            dtypes[col] = 'float64'
+        else:
+            dtypes[col] = 'object'
+    return dtypes
+
+
+def _stream_schema(merged: pd.DataFrame) -> pa.Schema:
+    """
+    Parquet schema shared by all the chunks of stream_raw_data, from the
+    first merged chunk. Object columns missing in the whole chunk are
+    stored as strings.
+    """
+    schema = pa.Schema.from_pandas(merged, preserve_index=False)
+    for i, field in enumerate(schema):
+        if pa.types.is_null(field.type):
+            schema = schema.set(i, field.with_type(pa.string()))
+    return schema
+
+
+def _load_project_data(cohort: str = 'farmers',
+                       n_jobs: int = 1) -> pd.DataFrame:
+    """
+    Load the concatenated project data for either farmers or welders
+
+    Parameters
+    ----------
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+    n_jobs: int
+        Number of threads used to load the project files in parallel.
+
+    Returns
+    -------
+    full_project: pd.DataFrame
+        Concatenated project data.
+    """
     if cohort == 'farmers':
-        full_project = _load_raw_farmers()
+        full_project = _load_raw_farmers(n_jobs)
     elif cohort == 'welders':
-        full_project = _load_raw_welders()
+        full_project = _load_raw_welders(n_jobs)
         # Welder 36 is control
         id36 = full_project['study_id'] == 36
         full_project.loc[id36, 'research_subject'] = 'Control'
     else:
         raise ValueError('type should be farmers or welders')
+    return full_project
 
-    # MERGE DATA
+
+def _merge_metabolites(metabolites: pd.DataFrame,
+                       ids: pd.DataFrame,
+                       full_project: pd.DataFrame,
+                       cohort: str = 'farmers') -> pd.DataFrame:
+    """
+    Merge metabolite concentrations with the sample IDs and project data
+
+    Parameters
+    ----------
+    metabolites: pd.DataFrame
+        Metabolite concentrations, or a chunk of them.
+    ids: pd.DataFrame
+        Sample IDs with the corrected visit information.
+    full_project: pd.DataFrame
+        Concatenated project data.
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+
+    Returns
+    -------
+    final_data: pd.DataFrame
+        Merged data.
+    """
     merge_left = ['project_id', 'study_id']
     merge_right = ['Study ID', 'Subj ID']
     if cohort == 'welders':
@@ -53,173 +301,505 @@ def load_raw_data(cohort: str = 'farmers') -> pd.DataFrame:
     return final_data
 
 
-def _load_raw_farmers() -> pd.DataFrame:
+def get_project_id(file: str) -> int:
+    """
+    Get the project ID from a project file name
+
+    Parameters
+    ----------
+    file: str
+        Path to a Project_* file.
+
+    Returns
+    -------
+    project_id: int
+        Project ID.
+    """
+    project_id = re.findall(r"\d+", os.path.basename(file))
+    return int(project_id[0])
+
+
+def get_project_files(cohort: str = 'farmers') -> List[str]:
+    """
+    Get the project files of a cohort, sorted by project ID
+
+    Parameters
+    ----------
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+
+    Returns
+    -------
+    project_files: List[str]
+        List of file paths.
+    """
+    project_files = glob.glob('data/raw/Project_*' + cohort + '.csv')
+    return sorted(project_files, key=get_project_id)
+
+
+def _load_projects(load_project: Callable[[str], pd.DataFrame],
+                   project_files: List[str],
+                   n_jobs: int = 1,
+                   processes: bool = False) -> pd.DataFrame:
+    """
+    Load and concatenate the project files, optionally in parallel
+
+    Parameters
+    ----------
+    load_project: Callable[[str], pd.DataFrame]
+        Function that reads and normalizes a single project file.
+    project_files: List[str]
+        List of project files.
+    n_jobs: int
+        Number of workers. If 1, load the files sequentially. -1 uses all
+        the available cores.
+    processes: bool
+        Use a process pool instead of a thread pool.
+
+    Returns
+    -------
+    full_project: pd.DataFrame
+        Concatenated projects, in the order of project_files.
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if n_jobs == 1 or len(project_files) < 2:
+        project_data_list = [load_project(file) for file in project_files]
+    else:
+        pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        with pool(max_workers=n_jobs) as executor:
+            project_data_list = list(executor.map(load_project,
+                                                  project_files))
+    full_project = pd.concat(project_data_list).reset_index(drop=True)
+    return full_project
+
+
+def get_project_columns(cohort: str = 'farmers') -> Tuple[List[str], dict]:
+    """
+    Get the columns to read from the raw project files, and the dtypes of
+    the measures among them.
+
+    Parameters
+    ----------
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+
+    Returns
+    -------
+    columns: List[str]
+        Columns used from any project file, including the original names
+        of renamed columns and the extra columns used during the cleaning.
+    dtypes: dict
+        Column dtypes to declare when reading the files.
+    """
+    exposures = get_exposures(cohort)
+    covs = get_covariates(cohort)
+    if cohort == 'farmers':
+        extras = ['study_id_number']
+        measures = ['age', 'years_of_education', 'total_score',
+                    'alcoholic_drinks', 'cigarettes']
+    else:
+        extras = ['subject_id', 'cohort', 'total_score', 'date_of_birth',
+                  'blood_work_date', 'redcap_repeat_instance']
+        measures = ['age', 'years_of_education', 'upsit_score',
+                    'mmse_total_score', 'total_score'] + get_metals(37016)
+    columns = covs + exposures + extras
+    if cohort == 'welders':
+        columns += get_metals(37016)
+    dtypes = {col: 'float64' for col in measures + exposures}
+    dtypes.update({'redcap_event_name': str,
+                   'date_of_birth': str,
+                   'blood_work_date': str})
+    return columns, dtypes
+
+
+def _read_project_file(file: str,
+                       cohort: str = 'farmers') -> pd.DataFrame:
+    """
+    Read a raw project file, parsing only the columns that are used
+
+    Parameters
+    ----------
+    file: str
+        Path to the project file.
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+
+    Returns
+    -------
+    project_data: pd.DataFrame
+        Project data.
+    """
+    columns, dtypes = get_project_columns(cohort)
+    columns = set(columns)
+    project_data = pd.read_csv(file,
+                               sep=';',
+                               usecols=lambda col: col in columns,
+                               dtype=dtypes)
+    return project_data
+
+
+def _load_raw_farmers(n_jobs: int = 1,
+                      processes: bool = False) -> pd.DataFrame:
     """
     Load farmers databases concatenated
 
+    Parameters
+    ----------
+    n_jobs: int
+        Number of workers to load the project files.
+    processes: bool
+        Use a process pool instead of a thread pool.
+
     Returns
     -------
     full_project: pd.DataFrame
         Concatenated farmer databases
     """
-    project_files = glob.glob('data/raw/Project_*farmers.csv')
+    full_project = _load_projects(_load_farmers_project,
+                                  get_project_files('farmers'),
+                                  n_jobs,
+                                  processes)
+    # NA in exposures are 0
+    exposures = get_exposures('farmers')
+    full_project[exposures] = full_project[exposures].fillna(0)
+    return full_project
+
+
+def _load_farmers_project(file: str) -> pd.DataFrame:
+    """
+    Load and normalize a single farmers project file
+
+    Parameters
+    ----------
+    file: str
+        Path to the project file.
+
+    Returns
+    -------
+    project_data: pd.DataFrame
+        Project data with the farmers columns.
+    """
     exposures = get_exposures('farmers')
     covs = get_covariates('farmers')
     subject_replace = {1: 'Farmer',
                        3: 'Farmer',
                        2: 'Farmer Control',
                        4: 'Farmer Control'}
-    project_data_list = []
     columns = covs + exposures
-    for file in project_files:
-        project_data = pd.read_csv(file,
-                                   sep=';')
-        if '42368' in file:
-            replace_col_names = {'study_id_number': 'study_id'}
-            project_data.rename(columns=replace_col_names,
-                                inplace=True)
-        project_data = replace_values(project_data,
-                                      'research_subject',
-                                      subject_replace)
-        project_data = project_data.loc[:, columns]
-        project_id = re.findall(r"\d+", file)
-        project_data['project_id'] = int(project_id[0])
-        project_data_list.append(project_data)
-
-    full_project = pd.concat(project_data_list).reset_index(drop=True)
-    # NA in exposures are 0
-    full_project[exposures] = full_project[exposures].fillna(0)
-    return full_project
+    project_data = _read_project_file(file, 'farmers')
+    if '42368' in file:
+        replace_col_names = {'study_id_number': 'study_id'}
+        project_data.rename(columns=replace_col_names,
+                            inplace=True)
+    project_data = replace_values(project_data,
+                                  'research_subject',
+                                  subject_replace)
+    project_data = project_data.loc[:, columns]
+    project_data['project_id'] = get_project_id(file)
+    return project_data
 
 
-def _load_raw_welders() -> pd.DataFrame:
+def _load_raw_welders(n_jobs: int = 1,
+                      processes: bool = False) -> pd.DataFrame:
     """
     Load welders databases concatenated
 
+    Parameters
+    ----------
+    n_jobs: int
+        Number of workers to load the project files.
+    processes: bool
+        Use a process pool instead of a thread pool.
+
     Returns
     ----------
     full_project: pd.DataFrame
         Concatenated welders databases
     """
-    project_files = glob.glob('data/raw/Project_*welders.csv')
+    full_project = _load_projects(_load_welders_project,
+                                  get_project_files('welders'),
+                                  n_jobs,
+                                  processes)
+    return full_project
+
+
+def _load_welders_project(file: str) -> pd.DataFrame:
+    """
+    Load and normalize a single welders project file
+
+    Parameters
+    ----------
+    file: str
+        Path to the project file.
+
+    Returns
+    -------
+    project_data: pd.DataFrame
+        Project data with the welders columns.
+    """
     exposures = get_exposures('welders')
     covs = get_covariates('welders')
-    metal_names_5467 = get_metals()
     metal_names_37016 = get_metals(37016)
-    replace_metals = dict(zip(metal_names_5467,
-                              metal_names_37016))
     replace_mmse = {'total_score': 'mmse_total_score'}
     # Change type of research subject
     subject_replace = {1: 'Active',
                        2: 'Control'}
-    project_data_list = []
     columns = covs + metal_names_37016 + exposures
-    for file in project_files:
-        project_data = pd.read_csv(file,
-                                   sep=';')
-        if '5467' in file:
-            # Read metal levels 5467
-            use_cols = metal_names_5467 + ['Subject ID']
-            metal_file = 'data/raw/Whole blood results all metals.xlsx'
-            metal_5467 = pd.read_excel(metal_file,
-                                       usecols=use_cols,
-                                       skiprows=[i for i in range(78, 81)]).\
-                rename(replace_metals,
-                       axis=1)
-            non_baselines = metal_5467['Subject ID'].str.contains('flu')
-            metal_5467['visit'] = 'baseline_arm_1'
-            metal_5467.loc[non_baselines, 'visit'] = '18_month_followup_arm_1'
-            metal_5467['Subject ID'] = metal_5467['Subject ID'].\
-                str.replace('-flu18', '')
-            metal_5467['Subject ID'] = metal_5467['Subject ID'].\
-                astype('int64')
-
-            # Merge metals
-            project_data = pd.merge(project_data,
-                                    metal_5467,
-                                    how='left',
-                                    left_on=['subject_id',
-                                             'redcap_event_name'],
-                                    right_on=['Subject ID',
-                                              'visit'])
-            # Convert Fe ug/ml to ug/L
-            project_data.loc[:, 'fe'] = \
-                project_data.loc[:, 'fe'] * 1000
-            # There are weird column names in this file
-            replace_col_names = {'subject_id': 'study_id',
-                                 'cohort': 'research_subject'}
-            # Get the age
-            age = get_age(project_data['blood_work_date'],
-                          project_data['date_of_birth'])
-            project_data['age'] = age
-            # Delete extra medication rows
-            keep = ~ (project_data['redcap_repeat_instance'] >= 1)
-            project_data = project_data[keep]
-            remove_from_list = ['race',
-                                'years_of_education']
-            columns = [i for i in columns if i not in remove_from_list]
-            # Change type of research subject
-            subject_replace.update({2: 'Retired',
-                                    3: 'Control'})
-            project_data = project_data.rename(columns=replace_col_names)
-            # Copy research subject info to non-baselines
-            project_data = copy_from_baseline(project_data,
-                                              'research_subject')
-            # Read wh exposure data
-            # pelt is the measurement similar to elt from the
-            # old study (3706)
-            wh_exposure = pd.read_csv(
-                'data/raw/UNC WH Exposure.csv').\
-                rename(columns={'pelt (mg-years/m3)': 'elt'})
-            project_data = pd.merge(project_data,
-                                    wh_exposure,
-                                    how='left',
-                                    left_on='study_id',
-                                    right_on='subject_id')
-
-            # Read seq exposure data
-            # pe90 is the measurement similar to e90 from the
-            # old study (3706)
-            seq_exposure = pd.read_csv(
-                'data/raw/UNC SEQ Exposure.csv').\
-                rename(columns={'pe90 (mg/m3 hours)': 'e90',
-                                'hrsw (hours)': 'hrsw'}).\
-                replace({'Baseline': 'baseline_arm_1',
-                         '18 Month Follow-Up': '18_month_followup_arm_1'})
-            project_data = pd.merge(project_data,
-                                    seq_exposure,
-                                    how='left',
-                                    left_on=['study_id',
-                                             'redcap_event_name'],
-                                    right_on=['subject_id',
-                                              'redcap_event_name'])
-            # Participants with NA in elt have zero
-            project_data.loc[:, 'elt'] = project_data.loc[:, 'elt'].fillna(0)
-            # Control participants in e90 and hrsw have zero
-            controls_bool = project_data.\
-                loc[:, 'research_subject'] == 3
-            project_data.loc[controls_bool, 'e90'] = 0
-            project_data.loc[controls_bool, 'hrsw'] = 0
-        elif '37016' in file:
-            # Copy elt data from baseline to non-baseline
-            project_data = copy_from_baseline(project_data,
-                                              'elt')
-            project_data = project_data.rename(replace_mmse,
-                                               axis=1)
-
-        project_data = replace_values(project_data,
-                                      'research_subject',
-                                      subject_replace)
-        project_data = project_data.loc[:, columns]
-        project_id = re.findall(r"\d+", file)
-        project_data['project_id'] = int(project_id[0])
-        project_data_list.append(project_data)
+    project_data = _read_project_file(file, 'welders')
+    if '5467' in file:
+        # Read metal levels 5467
+        metal_5467 = load_metals_5467()
 
-    full_project = pd.concat(project_data_list).reset_index(drop=True)
-    return full_project
+        # Merge metals
+        project_data = pd.merge(project_data,
+                                metal_5467,
+                                how='left',
+                                left_on=['subject_id',
+                                         'redcap_event_name'],
+                                right_on=['Subject ID',
+                                          'visit'])
+        # Convert Fe ug/ml to ug/L
+        project_data.loc[:, 'fe'] = \
+            project_data.loc[:, 'fe'] * 1000
+        # There are weird column names in this file
+        replace_col_names = {'subject_id': 'study_id',
+                             'cohort': 'research_subject'}
+        # Get the age
+        age = get_age(project_data['blood_work_date'],
+                      project_data['date_of_birth'])
+        project_data['age'] = age
+        # Delete extra medication rows
+        keep = ~ (project_data['redcap_repeat_instance'] >= 1)
+        project_data = project_data[keep]
+        remove_from_list = ['race',
+                            'years_of_education']
+        columns = [i for i in columns if i not in remove_from_list]
+        # Change type of research subject
+        subject_replace.update({2: 'Retired',
+                                3: 'Control'})
+        project_data = project_data.rename(columns=replace_col_names)
+        # Copy research subject info to non-baselines
+        project_data = copy_from_baseline(project_data,
+                                          'research_subject')
+        # Read wh exposure data
+        # pelt is the measurement similar to elt from the
+        # old study (3706)
+        wh_exposure = pd.read_csv(
+            'data/raw/UNC WH Exposure.csv').\
+            rename(columns={'pelt (mg-years/m3)': 'elt'})
+        project_data = pd.merge(project_data,
+                                wh_exposure,
+                                how='left',
+                                left_on='study_id',
+                                right_on='subject_id')
+
+        # Read seq exposure data
+        # pe90 is the measurement similar to e90 from the
+        # old study (3706)
+        seq_exposure = pd.read_csv(
+            'data/raw/UNC SEQ Exposure.csv').\
+            rename(columns={'pe90 (mg/m3 hours)': 'e90',
+                            'hrsw (hours)': 'hrsw'}).\
+            replace({'Baseline': 'baseline_arm_1',
+                     '18 Month Follow-Up': '18_month_followup_arm_1'})
+        project_data = pd.merge(project_data,
+                                seq_exposure,
+                                how='left',
+                                left_on=['study_id',
+                                         'redcap_event_name'],
+                                right_on=['subject_id',
+                                          'redcap_event_name'])
+        # Participants with NA in elt have zero
+        project_data.loc[:, 'elt'] = project_data.loc[:, 'elt'].fillna(0)
+        # Control participants in e90 and hrsw have zero
+        controls_bool = project_data.\
+            loc[:, 'research_subject'] == 3
+        project_data.loc[controls_bool, 'e90'] = 0
+        project_data.loc[controls_bool, 'hrsw'] = 0
+    elif '37016' in file:
+        # Copy elt data from baseline to non-baseline
+        project_data = copy_from_baseline(project_data,
+                                          'elt')
+        project_data = project_data.rename(replace_mmse,
+                                           axis=1)
+
+    project_data = replace_values(project_data,
+                                  'research_subject',
+                                  subject_replace)
+    project_data = project_data.loc[:, columns]
+    project_data['project_id'] = get_project_id(file)
+    return project_data
+
+
+def get_processed_path(cohort: str = 'farmers') -> str:
+    """
+    Get the path of the processed dataset of a cohort
+
+    Parameters
+    ----------
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+
+    Returns
+    -------
+    path: str
+        Path to the processed Parquet file.
+    """
+    if cohort not in ['farmers', 'welders']:
+        raise ValueError('type should be farmers or welders')
+    path = 'data/processed/' + cohort + '.parquet'
+    return path
+
+
+def save_processed_data(dat: pd.DataFrame,
+                        cohort: str = 'farmers'):
+    """
+    Save a processed dataset in Parquet format, preserving the dtypes
+
+    Parameters
+    ----------
+    dat: pd.DataFrame
+        Processed dataset.
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+    """
+    dat.to_parquet(get_processed_path(cohort),
+                   index=False)
 
 
-def load_baseline_data(cohort: str = 'farmers') -> pd.DataFrame:
+def load_processed_data(cohort: str = 'farmers',
+                        columns: Union[List[str], None] = None) -> \
+        pd.DataFrame:
+    """
+    Load the processed dataset of a cohort
+
+    Parameters
+    ----------
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+    columns: List[str] or None
+        Columns to read. If None, read all columns.
+
+    Returns
+    -------
+    dat: pd.DataFrame
+        Processed dataset.
+    """
+    if columns is not None:
+        columns = list(dict.fromkeys(columns))
+    dat = pd.read_parquet(get_processed_path(cohort),
+                          columns=columns)
+    return dat
+
+
+def iter_processed_data(cohort: str = 'farmers',
+                        columns: Union[List[str], None] = None,
+                        batch_size: int = 10000) -> Iterator[pd.DataFrame]:
+    """
+    Iterate over the processed dataset of a cohort in batches of rows, so
+    it's never loaded in memory at once
+
+    Parameters
+    ----------
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+    columns: List[str] or None
+        Columns to read. If None, read all columns.
+    batch_size: int
+        Maximum number of rows per batch.
+
+    Returns
+    -------
+    batches: Iterator[pd.DataFrame]
+        Consecutive batches of rows, in the order of the file.
+    """
+    if columns is not None:
+        columns = list(dict.fromkeys(columns))
+    parquet_file = pq.ParquetFile(get_processed_path(cohort))
+    for batch in parquet_file.iter_batches(batch_size=batch_size,
+                                           columns=columns):
+        yield batch.to_pandas()
+
+
+def get_baseline_mask(cohort: str = 'farmers') -> np.ndarray:
+    """
+    Get which rows of the processed dataset are baseline samples, reading
+    only the 'Internal Code' and 'Visit' columns. The selected rows are the
+    ones returned by load_baseline_data.
+
+    Parameters
+    ----------
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+
+    Returns
+    -------
+    mask: np.ndarray
+        Boolean mask of baseline rows, in the order of the file.
+    """
+    keys = load_processed_data(cohort, ['Internal Code', 'Visit'])
+    if cohort == 'farmers':
+        mask = ~keys['Internal Code'].duplicated(keep='first')
+    elif cohort == 'welders':
+        keys = keys.sort_values(by=['Internal Code', 'Visit'],
+                                kind='mergesort')
+        mask = ~keys['Internal Code'].duplicated(keep='first')
+        mask = mask.sort_index()
+    else:
+        raise ValueError('type should be farmers or welders')
+    return mask.to_numpy()
+
+
+def load_metals_5467(use_cache: bool = True) -> pd.DataFrame:
+    """
+    Load the whole blood metal levels of project 5467.
+
+    Parsing the Excel workbook is slow, so the cleaned table is cached and
+    the workbook is only parsed again when its content changes.
+
+    Parameters
+    ----------
+    use_cache: bool
+        Whether to use the cached table.
+
+    Returns
+    -------
+    metal_5467: pd.DataFrame
+        Metal levels with 'Subject ID', 'visit' and the metal columns
+        renamed as in project 37016.
+    """
+    metal_file = 'data/raw/Whole blood results all metals.xlsx'
+    if use_cache:
+        key = cache.get_cache_key('metals_5467', [metal_file])
+        metal_5467 = cache.read_cache(key)
+        if metal_5467 is not None:
+            return metal_5467
+
+    metal_names_5467 = get_metals()
+    replace_metals = dict(zip(metal_names_5467,
+                              get_metals(37016)))
+    use_cols = metal_names_5467 + ['Subject ID']
+    metal_5467 = pd.read_excel(metal_file,
+                               usecols=use_cols,
+                               skiprows=[i for i in range(78, 81)]).\
+        rename(replace_metals,
+               axis=1)
+    non_baselines = metal_5467['Subject ID'].str.contains('flu')
+    metal_5467['visit'] = 'baseline_arm_1'
+    metal_5467.loc[non_baselines, 'visit'] = '18_month_followup_arm_1'
+    metal_5467['Subject ID'] = metal_5467['Subject ID'].\
+        str.replace('-flu18', '')
+    metal_5467['Subject ID'] = metal_5467['Subject ID'].\
+        astype('int64')
+    if use_cache:
+        cache.write_cache(key, metal_5467)
+    return metal_5467
+
+
+def load_baseline_data(cohort: str = 'farmers',
+                       columns: Union[List[str], None] = None) -> \
+        pd.DataFrame:
     """
     Get the baseline data from welders or farmers
 
@@ -227,18 +807,23 @@ def load_baseline_data(cohort: str = 'farmers') -> pd.DataFrame:
     ----------
     cohort: str
         The type of data, either farmers or welders
+    columns: List[str] or None
+        Columns to return. If None, return all columns.
 
     Returns
     -------
     baseline_data: pd.DataFrame
         Baseline dataframe
     """
+    read_columns = None
+    if columns is not None:
+        read_columns = columns + ['Internal Code', 'Visit']
     if cohort == 'farmers':
-        farmers = pd.read_csv('data/processed/farmers.csv')
+        farmers = load_processed_data('farmers', read_columns)
         baseline_data = farmers.drop_duplicates(subset='Internal Code',
                                                 keep='first')
     elif cohort == 'welders':
-        welders = pd.read_csv('data/processed/welders.csv')
+        welders = load_processed_data('welders', read_columns)
         non_duplicated = ~welders['Internal Code'].duplicated(keep=False)
         welders_nd = welders.loc[non_duplicated, :]
         welders_d = welders.loc[~non_duplicated, :]
@@ -249,9 +834,31 @@ def load_baseline_data(cohort: str = 'farmers') -> pd.DataFrame:
     else:
         raise ValueError('type should be farmers or welders')
 
+    if columns is not None:
+        baseline_data = baseline_data.loc[:, list(dict.fromkeys(columns))]
     return pd.DataFrame(baseline_data)
 
 
+def get_transformer_path(cohort: str = 'farmers') -> str:
+    """
+    Get the path of the fitted transformation of a cohort
+
+    Parameters
+    ----------
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+
+    Returns
+    -------
+    path: str
+        Path to the JSON file with the transformation parameters.
+    """
+    if cohort not in ['farmers', 'welders']:
+        raise ValueError('type should be farmers or welders')
+    path = 'data/processed/' + cohort + '_transform.json'
+    return path
+
+
 def get_exposures(cohort: str = 'farmers') -> list:
     """
     Get a list of exposures depending on the type of data
@@ -408,10 +1015,16 @@ def update_visit_info(data: pd.DataFrame) -> pd.DataFrame:
     corrected_data: pd.DataFrame
         Corrected dataframe
     """
-    for ind, dat in data.groupby(['Study ID', 'Subj ID']):
-        if sum(dat['Visit']) > 3 and len(dat) > 1:
-            data.iloc[dat.index[0], 5] = 1
-            data.iloc[dat.index[1], 5] = 2
+    keys = [data['Study ID'], data['Subj ID']]
+    visits = data['Visit']
+    groups = visits.groupby(keys)
+    # A missing visit makes the sum missing, so the group is not updated
+    has_missing = visits.isna().groupby(keys).transform('any')
+    total = groups.transform('sum').where(~has_missing.astype(bool))
+    update = (total > 3) & (groups.transform('size') > 1)
+    position = groups.cumcount()
+    data.loc[update & (position == 0), 'Visit'] = 1
+    data.loc[update & (position == 1), 'Visit'] = 2
 
     return data
 
@@ -457,29 +1070,19 @@ def get_age(collection_date: pd.DataFrame,
 
 
 def copy_from_baseline(dat: pd.DataFrame,
-                       colname: str) -> pd.DataFrame:
+                       colnames: Union[str, List[str]]) -> pd.DataFrame:
     """
-    Copy the baseline information in colname to the other rows
+    Copy the baseline information in colnames to the other rows of each
+    participant, in place and keeping the row order
 
     Parameters
     ----------
     dat: pd.DataFrame
         Data in which to copy
-    colname: str
-        Column name
+    colnames: str or List[str]
+        Column name, or list of column names
     """
-    data = dat.copy()
-    data = data.set_index('study_id')
-    col = data.groupby('study_id')[colname].max()
-    data = pd.merge(col,
-                    data,
-                    left_index=True,
-                    right_index=True)
-    col_to_drop = colname + '_y'
-    col_to_change = colname + '_x'
-    data = data.drop(col_to_drop,
-                     axis=1)
-    data = data.rename(columns={col_to_change:
-                                colname})
-    data = data.reset_index()
-    return data
+    if isinstance(colnames, str):
+        colnames = [colnames]
+    dat[colnames] = dat.groupby('study_id')[colnames].transform('max')
+    return dat
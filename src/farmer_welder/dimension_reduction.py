@@ -1,18 +1,21 @@
 # Creating a PCA space with baseline subset only
 # Then projecting everyone onto that
+import argparse
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-from typing import Union
-from sklearn.decomposition import PCA
+from typing import List, Tuple, Union
+from sklearn.decomposition import PCA, IncrementalPCA
 from farmer_welder.data import load
-from farmer_welder.stats import stats
+from farmer_welder.stats import models, stats
 from farmer_welder.visualization import figures
 
 
 def run_PCA(dat: pd.DataFrame,
-            transform: bool = True,
-            grouping: Union[list[bool], None] = None) -> PCA:
+            transformer: Union[stats.DataTransformer, None] = None,
+            groups: Union[pd.Series, None] = None) -> PCA:
     '''
     Run PCA on dataset
 
@@ -20,10 +23,11 @@ def run_PCA(dat: pd.DataFrame,
     ----------
     dat: pd.DataFrame
         Dataframe to apply the PCA.
-    transform: bool
-        Whether to apply transformation to the dataset or not (log2 and zscore)
-    grouping: Union[list[bool], None]
-        List of boolean with groupings to separate dataset.
+    transformer: stats.DataTransformer or None
+        Fitted transformation to apply to the dataset (log2 and zscore). If
+        None, the dataset is used as is.
+    groups: pd.Series or None
+        Group of each row, as used to fit the transformer.
 
     Returns
     -------
@@ -31,16 +35,18 @@ def run_PCA(dat: pd.DataFrame,
        PCA results
     '''
     pca = PCA()
-    if transform:
-        dat = stats.transform_data(dat,
-                                   grouping=grouping)
-    pca.fit(dat)
+    if transformer is not None:
+        dat = transformer.transform(dat,
+                                    groups=groups)
+    pca.fit(np.asarray(dat))
     print(pca.explained_variance_ratio_.round(3))
     return pca
 
 
 def get_PCA_scores(pca: PCA,
-                   X: pd.DataFrame) -> np.ndarray:
+                   X: pd.DataFrame,
+                   transformer: Union[stats.DataTransformer, None] = None,
+                   groups: Union[pd.Series, None] = None) -> np.ndarray:
     '''
     Get PCA scores from a PCA on metabolites from a baseline.
 
@@ -49,17 +55,200 @@ def get_PCA_scores(pca: PCA,
     pca: PCA
         PCA results from scikit.
     X: pd.DataFrame
+        Data to project.
+    transformer: stats.DataTransformer or None
+        Transformation used to fit the PCA. The baseline parameters are
+        applied to X, so it's projected on the same scale.
+    groups: pd.Series or None
+        Group of each row of X, as used to fit the transformer.
 
     Returns
     -------
     scores: np.ndarray
         PCA scores obtained from projecting onto the PCA space.
     '''
-    X = stats.transform_data(X)
-    scores = pca.transform(X)
+    if transformer is not None:
+        X = transformer.transform(X,
+                                  groups=groups)
+    scores = pca.transform(np.asarray(X))
     return scores
 
 
+def run_incremental_PCA(cohort: str,
+                        columns: List[str],
+                        transformer: stats.DataTransformer,
+                        n_components: Union[int, None] = None,
+                        batch_size: int = 10000) -> IncrementalPCA:
+    '''
+    Run PCA on the baseline samples of the processed dataset, reading it in
+    batches of rows and updating an IncrementalPCA with each one. Only one
+    batch is in memory at a time.
+
+    Parameters
+    ----------
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+    columns: List[str]
+        Columns to use in the PCA.
+    transformer: stats.DataTransformer
+        Fitted transformation to apply to each batch, grouped by project.
+    n_components: int or None
+        Number of components to keep. If None, keep all of them.
+    batch_size: int
+        Number of rows to read at a time.
+
+    Returns
+    -------
+    pca: IncrementalPCA
+       PCA results
+    '''
+    if n_components is None:
+        n_components = len(columns)
+    pca = IncrementalPCA(n_components=n_components)
+    baseline = load.get_baseline_mask(cohort)
+    # Every partial fit needs at least n_components samples, so the last
+    # block is held back and merged with any smaller remainder
+    ready = None
+    pending = []
+    n_pending = 0
+    start = 0
+    for batch in load.iter_processed_data(cohort,
+                                          columns + ['project_id'],
+                                          batch_size):
+        keep = baseline[start:start + len(batch)]
+        start += len(batch)
+        if not keep.any():
+            continue
+        batch = batch.loc[keep, :]
+        X = transformer.transform(batch.loc[:, columns],
+                                  groups=batch.loc[:, 'project_id'])
+        pending.append(X.to_numpy())
+        n_pending += len(X)
+        if n_pending >= n_components:
+            if ready is not None:
+                pca.partial_fit(ready)
+            ready = np.vstack(pending)
+            pending = []
+            n_pending = 0
+    if ready is not None:
+        pending.insert(0, ready)
+    n_samples = sum(len(X) for X in pending)
+    if n_samples < n_components:
+        raise ValueError(f'Not enough {cohort} baseline samples for the '
+                         f'PCA: {n_samples} samples, {n_components} '
+                         f'components')
+    pca.partial_fit(np.vstack(pending))
+    print(pca.explained_variance_ratio_.round(3))
+    return pca
+
+
+def project_PCA(pca: Union[PCA, IncrementalPCA],
+                cohort: str,
+                columns: List[str],
+                transformer: stats.DataTransformer,
+                path: str,
+                id_columns: Union[List[str], None] = None,
+                batch_size: int = 10000) -> str:
+    '''
+    Project all the samples of the processed dataset onto the PCA space in
+    batches of rows, writing the scores to a Parquet file as they are
+    computed.
+
+    Parameters
+    ----------
+    pca: PCA or IncrementalPCA
+        PCA results from scikit.
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+    columns: List[str]
+        Columns used in the PCA.
+    transformer: stats.DataTransformer
+        Transformation used to fit the PCA, grouped by project.
+    path: str
+        Path to the output Parquet file.
+    id_columns: List[str] or None
+        Columns copied next to the scores to identify the samples.
+    batch_size: int
+        Number of rows to read at a time.
+
+    Returns
+    -------
+    path: str
+        Path to the scores, one row per sample in the order of the
+        processed dataset, with one column per component (PC1, PC2, ...).
+    '''
+    if id_columns is None:
+        id_columns = ['project_id']
+    writer = None
+    try:
+        for batch in load.iter_processed_data(cohort,
+                                              id_columns + columns +
+                                              ['project_id'],
+                                              batch_size):
+            scores = models.get_scores(pca, transformer, batch, columns)
+            for col in reversed(id_columns):
+                scores.insert(0, col, batch.loc[:, col].to_numpy())
+            table = pa.Table.from_pandas(scores,
+                                         preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    return path
+
+
+def get_PCA_model(cohort: str,
+                  columns: List[str],
+                  incremental: bool = False,
+                  batch_size: int = 10000,
+                  refit: bool = False) -> \
+        Tuple[Union[PCA, IncrementalPCA], stats.DataTransformer]:
+    '''
+    Load the PCA model saved for the current data of a cohort, or fit it on
+    the baseline samples and save it.
+
+    Parameters
+    ----------
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+    columns: List[str]
+        Columns to use in the PCA.
+    incremental: bool
+        Whether to fit an IncrementalPCA reading the data in batches.
+    batch_size: int
+        Number of rows per batch in incremental mode.
+    refit: bool
+        Whether to fit the PCA even if there is a saved model.
+
+    Returns
+    -------
+    pca: PCA or IncrementalPCA
+        PCA results
+    transformer: stats.DataTransformer
+        Transformation applied before the PCA.
+    '''
+    if not refit:
+        model = models.load_pca(columns, cohort, incremental)
+        if model is not None:
+            print(f'Loaded saved {cohort} PCA model')
+            print(model[0].explained_variance_ratio_.round(3))
+            return model
+    transformer = stats.DataTransformer.load(
+        load.get_transformer_path(cohort))
+    if incremental:
+        pca = run_incremental_PCA(cohort, columns, transformer,
+                                  batch_size=batch_size)
+    else:
+        baseline = load.load_baseline_data(cohort, columns + ['project_id'])
+        pca = run_PCA(baseline.loc[:, columns],
+                      transformer=transformer,
+                      groups=baseline.loc[:, 'project_id'])
+    models.save_pca(pca, transformer, columns, cohort)
+    return pca, transformer
+
+
 def print_contributing_vars(pca: PCA,
                             component: int,
                             variables: list[str],
@@ -110,89 +299,137 @@ def main():
     '''
     Main routine.
     '''
-    # Get initial data
-    print('Getting baseline data and running PCA')
-    farmers_bs = load.load_baseline_data('farmers')
-    welders_bs = load.load_baseline_data('welders')
+    parser = argparse.ArgumentParser(description='Run PCA on the baseline '
+                                                 'metabolites and project '
+                                                 'all samples')
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help='Fit and project reading the processed data '
+                             'in batches, writing the scores to disk')
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=10000,
+                        help='Number of rows per batch in incremental mode')
+    parser.add_argument('--n-jobs',
+                        type=int,
+                        default=1,
+                        help='Number of processes to render the figures '
+                             '(-1 uses all cores)')
+    parser.add_argument('--refit',
+                        action='store_true',
+                        help='Fit the PCA even if there is a saved model for '
+                             'the same data')
+    args = parser.parse_args()
+
     metabolites = load.get_metabolites()
     exp_names_w = load.get_exposures('welders')
     exp_names_f = load.get_exposures()
-    # Run PCA
-    grouping_w = get_groupings(welders_bs,
-                               'project_id')
-    grouping_f = get_groupings(farmers_bs,
-                               'project_id')
-    pca_w = run_PCA(welders_bs.loc[:, metabolites],
-                    grouping=grouping_w)
-    pca_f = run_PCA(farmers_bs.loc[:, metabolites],
-                    grouping=grouping_f)
+    # Run PCA, or load the models fitted on the same data
+    print('Getting baseline data and running PCA')
+    pca_w, transformer_w = get_PCA_model('welders', metabolites,
+                                         args.incremental, args.batch_size,
+                                         args.refit)
+    pca_f, transformer_f = get_PCA_model('farmers', metabolites,
+                                         args.incremental, args.batch_size,
+                                         args.refit)
     # Get contribution of variables
     print_contributing_vars(pca_w, 2, metabolites, 'welders')
     print_contributing_vars(pca_f, 2, metabolites, 'farmers')
 
     # Get all data
     print('Getting all data and projecting PCA')
-    farmers_all = pd.read_csv('data/processed/farmers.csv')
-    welders_all = pd.read_csv('data/processed/welders.csv')
+    farmers_cols = exp_names_f + ['research_subject', 'project_id',
+                                  'total_score', 'alcoholic_drinks',
+                                  'cigarettes', 'smoked_regularly',
+                                  'still_smoke', 'age']
+    welders_cols = exp_names_w + ['research_subject', 'project_id',
+                                  'cognitive_impairment', 'age',
+                                  'upsit_score', 'mmse_total_score']
+    if args.incremental:
+        farmers_all = load.load_processed_data('farmers', farmers_cols)
+        welders_all = load.load_processed_data('welders', welders_cols)
+        print('Transforming metabolites')
+        scores = []
+        for cohort, pca, transformer in [('welders', pca_w, transformer_w),
+                                         ('farmers', pca_f, transformer_f)]:
+            path = project_PCA(pca, cohort, metabolites, transformer,
+                               'data/processed/' + cohort +
+                               '_pca_scores.parquet',
+                               batch_size=args.batch_size)
+            scores.append(pd.read_parquet(path).
+                          drop(columns='project_id').to_numpy())
+        welders_scores, farmers_scores = scores
+    else:
+        farmers_all = load.load_processed_data('farmers',
+                                               metabolites + farmers_cols)
+        welders_all = load.load_processed_data('welders',
+                                               metabolites + welders_cols)
+        print('Transforming metabolites')
+        welders_scores = get_PCA_scores(pca_w,
+                                        welders_all.loc[:, metabolites],
+                                        transformer_w,
+                                        welders_all.loc[:, 'project_id'])
+        farmers_scores = get_PCA_scores(pca_f,
+                                        farmers_all.loc[:, metabolites],
+                                        transformer_f,
+                                        farmers_all.loc[:, 'project_id'])
     print('Transforming exposures')
-    exp_welders = stats.transform_data(welders_all.loc[:, exp_names_w])
-    print('Transforming metabolites')
-    welders_scores = get_PCA_scores(pca_w, welders_all.loc[:, metabolites])
-    farmers_scores = get_PCA_scores(pca_f, farmers_all.loc[:, metabolites])
+    exp_welders = transformer_w.transform(
+        welders_all.loc[:, exp_names_w],
+        groups=welders_all.loc[:, 'project_id'])
     print(welders_scores)
     print('Plots')
-    print('Welders exposures')
+    plot = figures.plot_pca_scores
+    jobs = []
+    # Welders exposures
     for exp in exp_names_w:
-        figures.plot_pca_scores(welders_scores,
-                                continuous=exp_welders.loc[:, exp],
-                                filename='PCA_welders_' + exp)
-    print('Research subjects')
+        jobs.append((plot, {'pca_scores': welders_scores,
+                            'continuous': exp_welders.loc[:, exp],
+                            'filename': 'PCA_welders_' + exp}))
+    # Research subjects
     for g in ['research_subject', 'project_id']:
-        figures.plot_pca_scores(welders_scores,
-                                groups=welders_all.loc[:, g],
-                                filename='PCA_welders_' + g)
-        figures.plot_pca_scores(farmers_scores,
-                                groups=farmers_all.loc[:, g],
-                                filename='PCA_farmers_' + g)
-    print('Farmer exposures')
+        jobs.append((plot, {'pca_scores': welders_scores,
+                            'groups': welders_all.loc[:, g],
+                            'filename': 'PCA_welders_' + g}))
+        jobs.append((plot, {'pca_scores': farmers_scores,
+                            'groups': farmers_all.loc[:, g],
+                            'filename': 'PCA_farmers_' + g}))
+    # Farmer exposures
     for exp in exp_names_f:
-        print(exp)
-        figures.plot_pca_scores(farmers_scores,
-                                continuous=farmers_all.loc[:, exp],
-                                filename='PCA_farmers_' + exp)
-    print('Farmer covariates')
+        jobs.append((plot, {'pca_scores': farmers_scores,
+                            'continuous': farmers_all.loc[:, exp],
+                            'filename': 'PCA_farmers_' + exp}))
+    # Farmer covariates
     for var in ['total_score',
                 'alcoholic_drinks',
                 'cigarettes',
                 'smoked_regularly',
                 'still_smoke',
                 'age']:
-        print(var)
         if var in ['total_score', 'age']:
             # Remove NA from this variable
-            if var == 'total_score':
-                keep_non_nas = ~farmers_all.loc[:, 'total_score'].isna()
-            else:
-                keep_non_nas = ~farmers_all.loc[:, 'age'].isna()
-            figures.plot_pca_scores(farmers_scores[keep_non_nas, :],
-                                    continuous=farmers_all.loc[keep_non_nas,
-                                                               var],
-                                    filename='PCA_farmers_' + var)
+            keep_non_nas = ~farmers_all.loc[:, var].isna()
+            jobs.append((plot, {'pca_scores': farmers_scores[keep_non_nas, :],
+                                'continuous': farmers_all.loc[keep_non_nas,
+                                                              var],
+                                'filename': 'PCA_farmers_' + var}))
         else:
-            figures.plot_pca_scores(farmers_scores,
-                                    groups=farmers_all.loc[:, var],
-                                    filename='PCA_farmers_' + var)
-    print('Welder covariates')
-    for var in ['currently_smoking',
-                'cognitive_impairment',
+            jobs.append((plot, {'pca_scores': farmers_scores,
+                                'groups': farmers_all.loc[:, var],
+                                'filename': 'PCA_farmers_' + var}))
+    # Welder covariates. There's no current smoking status for the welders
+    # (only smoked_regularly), so that figure is not drawn
+    for var in ['cognitive_impairment',
                 'age',
                 'upsit_score',
                 'mmse_total_score']:
         if var in ['age', 'upsit_score', 'mmse_total_score']:
-            figures.plot_pca_scores(welders_scores,
-                                    continuous=welders_all.loc[:, var],
-                                    filename='PCA_welders_' + var)
+            jobs.append((plot, {'pca_scores': welders_scores,
+                                'continuous': welders_all.loc[:, var],
+                                'filename': 'PCA_welders_' + var}))
         else:
-            figures.plot_pca_scores(welders_scores,
-                                    groups=welders_all.loc[:, var],
-                                    filename='PCA_welders_' + var)
+            jobs.append((plot, {'pca_scores': welders_scores,
+                                'groups': welders_all.loc[:, var],
+                                'filename': 'PCA_welders_' + var}))
+    print(f'Rendering {len(jobs)} figures')
+    figures.render_jobs(jobs, n_jobs=args.n_jobs)
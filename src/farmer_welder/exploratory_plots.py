@@ -7,11 +7,13 @@ from farmer_welder.visualization import figures
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from typing import Union
 
 
 def distribution_plots(dat: pd.DataFrame,
                        filename: str,
-                       exposures: bool = True):
+                       exposures: bool = True,
+                       transformer: Union[stats.DataTransformer, None] = None):
     """
     Generate violin plots with distribution of blood metal levels and metabolites.
 
@@ -23,12 +25,19 @@ def distribution_plots(dat: pd.DataFrame,
         Filename to use, including extension.
     exposures: bool
         Whether to plot the exposures. If False, plot metabolites
+    transformer: stats.DataTransformer or None
+        Transformation fitted on the baseline data, grouped by project. If
+        None, the one saved for the welders is loaded.
     """
+    if transformer is None:
+        transformer = stats.DataTransformer.load(
+            load.get_transformer_path('welders'))
     if exposures:
         variables = ['elt', 'e90', 'fe', 'mn', 'pb']
     else:
         variables = load.get_metabolites()
-    grouping = dat.loc[:, 'Study ID'] == 37016
+    transformed_dat = transformer.transform(dat.loc[:, variables],
+                                            groups=dat.loc[:, 'project_id'])
     fig = plt.figure(figsize=(10, len(variables) * 2),
                      dpi=300)
     gs = GridSpec(len(variables), 2, figure=fig)
@@ -39,13 +48,10 @@ def distribution_plots(dat: pd.DataFrame,
         ax1 = fig.add_subplot(gs[rows[count], cols[count]])
         count = count + 1
         ax2 = fig.add_subplot(gs[rows[count], cols[count]])
-        transformed_dat = stats.transform_data(dat.loc[:, var],
-                                               grouping=grouping,
-                                               to_print=False)
         figures.concentration_violinplot(dat.loc[:, var],
                                          ax1,
                                          group_by=dat.loc[:, 'research_subject'])
-        figures.concentration_violinplot(transformed_dat,
+        figures.concentration_violinplot(transformed_dat.loc[:, var],
                                          ax2,
                                          group_by=dat.loc[:, 'research_subject'])
         count = count + 1
@@ -55,7 +61,8 @@ def distribution_plots(dat: pd.DataFrame,
 
 
 def correlation_plots(dat: pd.DataFrame,
-                      filename: str):
+                      filename: str,
+                      transformer: Union[stats.DataTransformer, None] = None):
     """
     Generate correlation plots with blood metal levels and metabolites.
 
@@ -65,17 +72,21 @@ def correlation_plots(dat: pd.DataFrame,
         Dataset to use.
     filename: str
         Filename to use, including extension.
+    transformer: stats.DataTransformer or None
+        Transformation fitted on the baseline data, grouped by project. If
+        None, the one saved for the welders is loaded.
     """
+    if transformer is None:
+        transformer = stats.DataTransformer.load(
+            load.get_transformer_path('welders'))
     metabolites = load.get_metabolites()
     metals = ['elt', 'e90', 'fe', 'mn', 'pb']
     variables = metabolites + metals
-    grouping = dat.loc[:, 'Study ID'] == 37016
     fig = plt.figure(figsize=(10, 10),
                      dpi=300)
     ax = fig.add_subplot(111)
-    transformed_dat = stats.transform_data(dat.loc[:, variables],
-                                           grouping=grouping,
-                                           to_print=False)
+    transformed_dat = transformer.transform(dat.loc[:, variables],
+                                            groups=dat.loc[:, 'project_id'])
     figures.correlation_plot(data=transformed_dat,
                              ax=ax,
                              labels=variables)
@@ -89,13 +100,21 @@ def main():
     Main routine
     """
     print('=== Loading and transforming datasets ===')
-    w_bs = load.load_baseline_data('welders')
-    w_all = pd.read_csv('data/processed/welders.csv')
+    columns = ['project_id', 'research_subject', 'elt', 'e90', 'fe', 'mn',
+               'pb'] + load.get_metabolites()
+    w_bs = load.load_baseline_data('welders', columns)
+    w_all = load.load_processed_data('welders', columns)
+    transformer = stats.DataTransformer.load(
+        load.get_transformer_path('welders'))
     print('\n=== Creating distribution plots ===')
-    distribution_plots(w_bs, 'welders_baseline_exposures.png')
-    distribution_plots(w_all, 'welders_total_exposures.png')
-    distribution_plots(w_bs, 'welders_baseline_metabolites.png', False)
-    distribution_plots(w_all, 'welders_total_metabolites.png', False)
+    distribution_plots(w_bs, 'welders_baseline_exposures.png',
+                       transformer=transformer)
+    distribution_plots(w_all, 'welders_total_exposures.png',
+                       transformer=transformer)
+    distribution_plots(w_bs, 'welders_baseline_metabolites.png', False,
+                       transformer)
+    distribution_plots(w_all, 'welders_total_metabolites.png', False,
+                       transformer)
     print('\n=== Creating correlation plots ===')
-    correlation_plots(w_bs, 'welders_bs_corr.png')
-    correlation_plots(w_all, 'welders_tot_corr.png')
+    correlation_plots(w_bs, 'welders_bs_corr.png', transformer)
+    correlation_plots(w_all, 'welders_tot_corr.png', transformer)
@@ -1,13 +1,95 @@
+import argparse
+import pandas as pd
+
+from farmer_welder.data import cache
 from farmer_welder.data import load
 from farmer_welder.data import clean
+from farmer_welder.stats import stats
+
+COLS_NA = ['age', 'sex', 'race', 'ethnicity', 'years_of_education',
+           'smoked_regularly', 'zn', 'cu', 'pb', 'mn', 'fe', 'elt',
+           'e90', 'hrsw']
+COLS_MEAN = ['age', 'years_of_education', 'zn', 'cu', 'pb', 'mn', 'fe',
+             'elt', 'e90', 'hrsw']
+SUMMARY_COLUMNS = ['project_id', 'study_id', 'research_subject'] + COLS_NA
 
 
 def main():
-    farmers = load.load_raw_data('farmers')
-    welders = load.load_raw_data('welders')
-    welders = clean.transform_education(welders)
+    parser = argparse.ArgumentParser(description='Merge the raw data files')
+    parser.add_argument('--refresh',
+                        action='store_true',
+                        help='Rebuild the merged data ignoring the cache')
+    parser.add_argument('--clear-cache',
+                        action='store_true',
+                        help='Remove all cached data before merging')
+    parser.add_argument('--n-jobs',
+                        type=int,
+                        default=1,
+                        help='Number of threads to load the project files '
+                             '(-1 uses all cores)')
+    parser.add_argument('--stream',
+                        action='store_true',
+                        help='Read the metabolite file in chunks and write '
+                             'the merged data incrementally')
+    parser.add_argument('--chunksize',
+                        type=int,
+                        default=1000,
+                        help='Number of metabolite rows per chunk when '
+                             'streaming')
+    args = parser.parse_args()
+    if args.clear_cache:
+        cache.clear_cache()
+
+    if args.stream:
+        load.stream_raw_data('farmers', chunksize=args.chunksize,
+                             n_jobs=args.n_jobs)
+        load.stream_raw_data('welders', chunksize=args.chunksize,
+                             n_jobs=args.n_jobs,
+                             transform=clean.transform_education)
+        welders = load.load_processed_data('welders', SUMMARY_COLUMNS)
+    else:
+        farmers = load.load_raw_data('farmers', refresh=args.refresh,
+                                     n_jobs=args.n_jobs)
+        welders = load.load_raw_data('welders', refresh=args.refresh,
+                                     n_jobs=args.n_jobs)
+        welders = clean.transform_education(welders)
+        load.save_processed_data(farmers, 'farmers')
+        load.save_processed_data(welders, 'welders')
+
+    fit_transformer('farmers')
+    fit_transformer('welders')
+    print_summary(welders)
+    print('Farmer and Welder data consolidated\n')
+
 
-    # print basic information
+def fit_transformer(cohort: str = 'farmers'):
+    """
+    Fit the log2 and zscore transformation on the baseline data of a cohort,
+    grouped by project, and save it next to the processed data.
+
+    Parameters
+    ----------
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+    """
+    columns = load.get_metabolites()
+    if cohort == 'welders':
+        columns = columns + ['elt', 'e90', 'hrsw'] + load.get_metals(37016)
+    baseline = load.load_baseline_data(cohort, ['project_id'] + columns)
+    transformer = stats.DataTransformer().fit(baseline.loc[:, columns],
+                                              baseline.loc[:, 'project_id'])
+    transformer.save(load.get_transformer_path(cohort))
+
+
+def print_summary(welders: pd.DataFrame):
+    """
+    Print basic information of the welders dataset.
+
+    Parameters
+    ----------
+    welders: pd.DataFrame
+        Welders dataset.
+    """
     print('=== Basic information in welders ===')
     for project, dat in welders.groupby('project_id'):
         print(f'In project {project}:')
@@ -24,24 +106,13 @@ def main():
         print(unique_dat.loc[:, 'research_subject'].value_counts())
         print('From the repeated dataset, the samples are splitted like this:')
         print(repeated_dat.loc[:, 'research_subject'].value_counts(), '\n')
-        cols_na = ['age', 'sex', 'race', 'ethnicity', 'years_of_education',
-                   'smoked_regularly', 'zn', 'cu', 'pb', 'mn', 'fe', 'elt',
-                   'e90', 'hrsw']
-        cols_mean = ['age', 'years_of_education', 'zn', 'cu', 'pb', 'mn', 'fe',
-                     'elt', 'e90', 'hrsw']
-        for col in cols_na:
+        for col in COLS_NA:
             nas = welders.loc[:, col].isna().sum()
             print(f'In column {col} there are {nas} missing values.')
         print('')
         for subject, dat2 in dat.groupby('research_subject'):
             print(f'Mean values for {subject}')
-            for col in cols_mean:
+            for col in COLS_MEAN:
                 mean = dat2.loc[:, col].mean().round(2)
                 print(f'Mean value for {col}: {mean}')
             print('')
-
-    farmers.to_csv('data/processed/farmers.csv',
-                   index=False)
-    welders.to_csv('data/processed/welders.csv',
-                   index=False)
-    print('Farmer and Welder data consolidated\n')
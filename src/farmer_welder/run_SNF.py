@@ -1,31 +1,99 @@
-from sklearn.metrics.pairwise import euclidean_distances,\
-                                     nan_euclidean_distances
 from farmer_welder.data import load
-from farmer_welder.stats import affinity, stats
+from farmer_welder.stats import affinity, distance, snf, stats
 from farmer_welder.visualization import figures
+import argparse
 import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
 
-mach_eps = np.finfo(float).eps
-bs = load.load_baseline_data('welders')
-metabolites = load.get_metabolites()
-exposures = load.get_exposures('welders')
-metals = load.get_metals(37016)
-old_study = bs[bs['project_id'] == 37016]
-
-dist_metabolites = euclidean_distances(stats.
-                                       transform_data(old_study[metabolites] +
-                                                      mach_eps))
-dist_exposures = euclidean_distances(stats.transform_data(old_study[exposures],
-                                                          log2_transform=False))
-dist_metals = nan_euclidean_distances(stats.transform_data(old_study[metals]))
-
-W1 = affinity.affinity_matrix(np.power(dist_metabolites, 2))
-W2 = affinity.affinity_matrix(np.power(dist_exposures, 2))
-W3 = affinity.affinity_matrix(np.power(dist_metals, 2))
-
-figures.correlation_plot(W1, estimate_corr=False,
-                         filename='affinity_matrix_metabolites.png')
-figures.correlation_plot(W2, estimate_corr=False,
-                         filename='affinity_matrix_exposures.png')
-figures.correlation_plot(W3, estimate_corr=False,
-                         filename='affinity_matrix_metals.png')
+
+def plot_affinity(W: np.ndarray,
+                  filename: str):
+    """
+    Plot an affinity matrix.
+
+    Parameters
+    ----------
+    W: np.ndarray
+        Affinity matrix.
+    filename: str
+        Filename to use, including extension.
+    """
+    fig = plt.figure(figsize=(10, 10))
+    ax = fig.add_subplot(111)
+    figures.correlation_plot(W, ax, estimate_corr=False)
+    fig.tight_layout()
+    fig.savefig('results/figures/' + filename,
+                dpi=300)
+    plt.close(fig)
+
+
+def main():
+    """
+    Main routine
+    """
+    parser = argparse.ArgumentParser(description='Run Similarity Network '
+                                                 'Fusion')
+    parser.add_argument('-k',
+                        type=int,
+                        default=20,
+                        help='Number of nearest neighbors')
+    parser.add_argument('-t',
+                        type=int,
+                        default=20,
+                        help='Maximum number of fusion iterations')
+    parser.add_argument('--n-clusters',
+                        type=int,
+                        default=None,
+                        help='Number of clusters (estimated if not given)')
+    parser.add_argument('--nan-aware',
+                        action='store_true',
+                        help='Ignore missing values in the metabolite and '
+                             'exposure distances too (always done for the '
+                             'metals)')
+    args = parser.parse_args()
+
+    metabolites = load.get_metabolites()
+    exposures = load.get_exposures('welders')
+    metals = load.get_metals(37016)
+    bs = load.load_baseline_data('welders',
+                                 ['study_id', 'project_id'] + metabolites +
+                                 exposures + metals)
+    old_study = bs[bs['project_id'] == 37016]
+    transformer = stats.DataTransformer.load(
+        load.get_transformer_path('welders'))
+
+    print('=== Building affinity matrices ===')
+    # The exposures have zeros, so they are only standardized
+    views = [transformer.transform(old_study[metabolites],
+                                   groups=old_study['project_id']),
+             stats.transform_data(old_study[exposures],
+                                  log2_transform=False),
+             transformer.transform(old_study[metals],
+                                   groups=old_study['project_id'])]
+    # The metals have missing values, the other views only use the
+    # NaN-aware distances if asked
+    nan_aware = [args.nan_aware, args.nan_aware, True]
+    affinities = []
+    for view, view_nan_aware in zip(views, nan_aware):
+        # Squared distances are reused as the affinity buffer
+        dist = distance.squared_distances(view,
+                                          nan_aware=view_nan_aware)
+        affinities.append(affinity.affinity_matrix(dist,
+                                                   k=args.k,
+                                                   overwrite_dist=True))
+    W1, W2, W3 = affinities
+
+    print('=== Fusing networks ===')
+    W = snf.snf([W1, W2, W3], k=args.k, t=args.t)
+    labels = snf.spectral_clusters(W, n_clusters=args.n_clusters)
+    clusters = pd.DataFrame({'study_id': old_study['study_id'].to_numpy(),
+                             'cluster': labels})
+    clusters.to_csv('results/reports/SNF_clusters.csv',
+                    index=False)
+    print(clusters['cluster'].value_counts())
+
+    plot_affinity(W1, 'affinity_matrix_metabolites.png')
+    plot_affinity(W2, 'affinity_matrix_exposures.png')
+    plot_affinity(W3, 'affinity_matrix_metals.png')
+    plot_affinity(W, 'affinity_matrix_fused.png')
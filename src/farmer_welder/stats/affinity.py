@@ -1,13 +1,89 @@
 import numpy as np
-from scipy.stats import norm
+import scipy.sparse as sp
+from sklearn.neighbors import NearestNeighbors
 
 
 def affinity_matrix(dist: np.ndarray,
                     k: int = 20,
-                    sigma: float = 0.5):
+                    sigma: float = 0.5,
+                    dtype: type = np.float64,
+                    overwrite_dist: bool = False):
     '''
     Generate an affinity matrix from a distance matrix
 
+    The gaussian kernel is computed in place, so the peak memory is about
+    two N x N buffers (one if overwrite_dist is True and dist already has
+    the requested dtype).
+
+    Parameters
+    ----------
+    dist: np.array
+        Distance matrix
+    k: int
+        Number of nearest neighbors (Recommended between 10 and 30)
+    sigma: float
+        Variance for local model
+    dtype: type
+        Data type of the affinity matrix (np.float64 or np.float32)
+    overwrite_dist: bool
+        Whether to reuse dist as the output buffer
+    '''
+    dist = np.asarray(dist)
+    if overwrite_dist and dist.dtype == dtype and dist.flags.writeable:
+        W = dist
+    else:
+        W = np.array(dist, dtype=dtype)
+
+    mach_eps = np.finfo(float).eps
+    k = min(k, W.shape[0] - 1)
+    _symmetrize(W)
+    np.fill_diagonal(W, 0)
+    # Mean of the k nearest distances, excluding the closest (itself)
+    sig = np.empty_like(W)
+    np.copyto(sig, W)
+    sig.partition([0, k], axis=0)
+    means = np.mean(sig[1:k+1], axis=0, dtype=np.float64) + mach_eps
+    # Local scale, symmetric by construction
+    np.add.outer(means, means, out=sig)
+    sig += W
+    sig /= 3
+    sig += mach_eps
+    np.maximum(sig, mach_eps, out=sig)
+    sig *= sigma
+    # Gaussian density with zero mean and scale sig
+    W /= sig
+    np.square(W, out=W)
+    W *= -0.5
+    np.exp(W, out=W)
+    sig *= np.sqrt(2 * np.pi)
+    W /= sig
+    return W
+
+
+def _symmetrize(W: np.ndarray,
+                block_size: int = 1024):
+    '''
+    Replace W with (W + W.T) / 2 in place, one block at a time.
+    '''
+    n = W.shape[0]
+    for i in range(0, n, block_size):
+        rows = slice(i, min(i + block_size, n))
+        for j in range(i, n, block_size):
+            cols = slice(j, min(j + block_size, n))
+            block = (W[rows, cols] + W[cols, rows].transpose()) / 2
+            W[rows, cols] = block
+            W[cols, rows] = block.transpose()
+
+
+def sparse_affinity_matrix(dist: np.ndarray,
+                           k: int = 20,
+                           sigma: float = 0.5,
+                           block_size: int = 1024) -> sp.csr_matrix:
+    '''
+    Generate a sparse affinity matrix from a distance matrix, keeping only
+    the k nearest neighbors of each sample. The kept entries are equal to
+    the ones from affinity_matrix.
+
     Parameters
     ----------
     dist: np.array
@@ -16,17 +92,92 @@ def affinity_matrix(dist: np.ndarray,
         Number of nearest neighbors (Recommended between 10 and 30)
     sigma: float
         Variance for local model
+    block_size: int
+        Number of rows to process at a time
+
+    Returns
+    -------
+    W: sp.csr_matrix
+        Sparse affinity matrix
     '''
     if not isinstance(dist, np.ndarray):
         dist = np.array(dist)
 
+    n = dist.shape[0]
+    k = min(k, n - 1)
+    neighbors = np.empty((n, k + 1), dtype=np.int64)
+    neighbor_dist = np.empty((n, k + 1))
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        rows = np.arange(start, stop)
+        block = (dist[start:stop] + dist[:, start:stop].transpose()) / 2
+        block[rows - start, rows] = 0
+        idx = np.argpartition(block, k, axis=1)[:, :k + 1]
+        neighbors[start:stop] = idx
+        neighbor_dist[start:stop] = np.take_along_axis(block, idx, axis=1)
+    return _knn_affinity(neighbors, neighbor_dist, sigma)
+
+
+def knn_affinity_matrix(data: np.ndarray,
+                        k: int = 20,
+                        sigma: float = 0.5,
+                        algorithm: str = 'auto') -> sp.csr_matrix:
+    '''
+    Generate a sparse affinity matrix from a data matrix, using a tree
+    based nearest neighbors search on the squared euclidean distances.
+    No dense distance matrix is created.
+
+    Parameters
+    ----------
+    data: np.array
+        Data matrix (samples x features)
+    k: int
+        Number of nearest neighbors (Recommended between 10 and 30)
+    sigma: float
+        Variance for local model
+    algorithm: str
+        Nearest neighbors algorithm ('auto', 'kd_tree', 'ball_tree')
+
+    Returns
+    -------
+    W: sp.csr_matrix
+        Sparse affinity matrix
+    '''
+    k = min(k, data.shape[0] - 1)
+    nn = NearestNeighbors(n_neighbors=k + 1,
+                          algorithm=algorithm).fit(data)
+    neighbor_dist, neighbors = nn.kneighbors(data)
+    return _knn_affinity(neighbors, np.square(neighbor_dist), sigma)
+
+
+def _knn_affinity(neighbors: np.ndarray,
+                  neighbor_dist: np.ndarray,
+                  sigma: float) -> sp.csr_matrix:
+    '''
+    Gaussian kernel over the union of the k nearest neighbor graph and
+    its transpose, from the k + 1 nearest samples (including itself) of
+    each sample and their distances.
+    '''
+    n, k = neighbors.shape[0], neighbors.shape[1] - 1
     mach_eps = np.finfo(float).eps
-    dist_mat = (dist + dist.transpose()) / 2
-    np.fill_diagonal(dist_mat, 0)
-    dist_mat_sort = np.sort(dist_mat, axis=0)
-    means = np.mean(dist_mat_sort[1:k+1], axis=0) + mach_eps
-    sig = (np.add.outer(means, means) / 2) / 3 * 2 + dist_mat / 3 + mach_eps
+    # Mean distance to the k nearest neighbors, excluding the closest
+    means = (neighbor_dist.sum(axis=1) - neighbor_dist.min(axis=1)) / k
+    means = means + mach_eps
+
+    rows = np.repeat(np.arange(n), k + 1)
+    cols = neighbors.ravel()
+    vals = neighbor_dist.ravel()
+    # Symmetric pattern, with the diagonal always included
+    rows, cols = (np.concatenate([rows, cols, np.arange(n)]),
+                  np.concatenate([cols, rows, np.arange(n)]))
+    vals = np.concatenate([vals, vals, np.zeros(n)])
+    _, first = np.unique(rows * n + cols, return_index=True)
+    rows, cols, vals = rows[first], cols[first], vals[first]
+
+    sig = (means[rows] + means[cols]) / 3 + vals / 3 + mach_eps
     sig[sig <= mach_eps] = mach_eps
-    densities = norm.pdf(dist_mat, loc=0, scale=(sigma * sig))
-    W = (densities + densities.transpose()) / 2
+    scale = sigma * sig
+    densities = np.exp(-0.5 * np.square(vals / scale)) / \
+        (scale * np.sqrt(2 * np.pi))
+    W = sp.csr_matrix((densities, (rows, cols)), shape=(n, n))
     return W
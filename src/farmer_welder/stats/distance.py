@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+
+from typing import Union
+
+
+def squared_distances(X: Union[np.ndarray, pd.DataFrame],
+                      nan_aware: bool = False,
+                      block_size: int = 1024,
+                      dtype: type = np.float64,
+                      out: Union[np.ndarray, None] = None) -> np.ndarray:
+    '''
+    Squared euclidean distances between the rows of X, computed directly
+    (without a square root) one block of rows at a time
+
+    Parameters
+    ----------
+    X: np.array or pd.DataFrame
+        Data matrix (samples x features)
+    nan_aware: bool
+        Whether to ignore missing values. As in sklearn's
+        nan_euclidean_distances, the distance over the coordinates present
+        in both samples is scaled by the ratio of total to present
+        coordinates.
+    block_size: int
+        Number of rows to process at a time
+    dtype: type
+        Data type of the distance matrix
+    out: np.array or None
+        Preallocated N x N output buffer
+
+    Returns
+    -------
+    dist: np.array
+        Squared distance matrix, to pass to affinity.affinity_matrix
+        (e.g. with overwrite_dist=True)
+    '''
+    X = np.asarray(X, dtype=np.float64)
+    n, n_features = X.shape
+    if out is None:
+        out = np.empty((n, n), dtype=dtype)
+
+    if nan_aware:
+        present = (~np.isnan(X)).astype(np.float64)
+        X = np.where(present > 0, X, 0)
+        X_sq = np.square(X)
+    else:
+        norms = np.einsum('ij,ij->i', X, X)
+
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        block = X[start:stop] @ X.transpose()
+        block *= -2
+        if nan_aware:
+            block += X_sq[start:stop] @ present.transpose()
+            block += present[start:stop] @ X_sq.transpose()
+            n_present = present[start:stop] @ present.transpose()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                block *= n_features / n_present
+            block[n_present == 0] = np.nan
+        else:
+            block += norms[start:stop, None]
+            block += norms[None, :]
+        np.maximum(block, 0, out=block)
+        rows = np.arange(start, stop)
+        block[rows - start, rows] = 0
+        out[start:stop] = block
+    return out
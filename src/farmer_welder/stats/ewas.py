@@ -0,0 +1,261 @@
+import numpy as np
+import pandas as pd
+
+from typing import Dict, List, Tuple, Union
+from scipy import stats as sps
+from farmer_welder.stats import regression
+
+# Same columns as clarite.analyze.association_study
+RESULT_COLUMNS = ['Variable_type', 'Weight', 'Converged', 'N', 'Beta', 'SE',
+                  'Beta_pvalue', 'LRT_pvalue', 'Diff_AIC', 'pvalue']
+
+
+def get_types(data: pd.DataFrame,
+              columns: Union[List[str], None] = None) -> pd.Series:
+    """
+    Infer the type of each variable from its number of unique values, as
+    clarite.modify.categorize does (with the unknown ones made continuous).
+
+    Parameters
+    ----------
+    data: pd.DataFrame
+        Data frame with the variables.
+    columns: List[str] or None
+        Columns to evaluate. If None, evaluate all columns.
+
+    Returns
+    -------
+    var_types: pd.Series
+        'binary' (2 unique values), 'categorical' (3 to 6), 'continuous'
+        (more than 6) or 'constant' (less than 2), indexed by column.
+    """
+    if columns is not None:
+        data = data.loc[:, columns]
+    n_unique = data.nunique(dropna=True)
+    var_types = pd.Series('continuous', index=n_unique.index)
+    var_types[(n_unique >= 3) & (n_unique <= 6)] = 'categorical'
+    var_types[n_unique == 2] = 'binary'
+    var_types[n_unique < 2] = 'constant'
+    return var_types
+
+
+def _encode(values: pd.Series,
+            var_type: str,
+            standardize: bool) -> np.ndarray:
+    """
+    Encode a variable as design columns: the (standardized) values if it's
+    continuous, or indicators of all but the first level otherwise. Missing
+    values are NaN in every column.
+    """
+    if var_type == 'continuous':
+        values = values.astype(float)
+        if standardize:
+            values = (values - values.mean()) / values.std()
+        return values.to_numpy()[:, None]
+    categories = pd.Categorical(values)
+    codes = categories.codes
+    levels = np.arange(1, len(categories.categories))
+    encoded = (codes[:, None] == levels[None, :]).astype(float)
+    encoded[codes == -1, :] = np.nan
+    return encoded
+
+
+def _covariate_design(data: pd.DataFrame,
+                      covariates: List[str],
+                      var_types: pd.Series,
+                      standardize: bool) -> np.ndarray:
+    """
+    Covariate design without intercept, NaN in the incomplete rows.
+    """
+    blocks = [np.empty((len(data), 0))]
+    for cov in covariates:
+        if var_types[cov] == 'constant':
+            continue
+        blocks.append(_encode(data.loc[:, cov], var_types[cov], standardize))
+    return np.column_stack(blocks)
+
+
+def _wald_association(covs: np.ndarray,
+                      predictors: np.ndarray,
+                      out_values: np.ndarray) -> pd.DataFrame:
+    """
+    Beta, SE and N of single column predictors, solved in blocks of pairs
+    that share their complete rows.
+    """
+    cov_names = ['c' + str(i) for i in range(covs.shape[1])]
+    pred_names = ['p' + str(i) for i in range(predictors.shape[1])]
+    out_names = ['o' + str(i) for i in range(out_values.shape[1])]
+    frame = pd.DataFrame(np.column_stack([covs, predictors, out_values]),
+                         columns=cov_names + pred_names + out_names)
+    res = regression.ols_association(frame, pred_names, out_names, cov_names)
+    return res
+
+
+def _lrt_association(covs: np.ndarray,
+                     predictors: List[np.ndarray],
+                     out_values: np.ndarray) -> \
+        Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Likelihood ratio test of multi column (categorical) predictors against
+    the covariates only model, for every predictor and outcome pair.
+
+    For gaussian models LR = N * log(RSS0 / RSS1), and the reduction of the
+    RSS is the squared projection of the covariate residuals of the outcome
+    onto the covariate residuals of the predictor columns.
+
+    Returns
+    -------
+    lrt: np.ndarray
+        LR statistic (n_predictors x n_outcomes).
+    df: np.ndarray
+        Degrees of freedom of each test.
+    nobs: np.ndarray
+        Number of observations of each test.
+    """
+    n_pred, n_out = len(predictors), out_values.shape[1]
+    lrt = np.full((n_pred, n_out), np.nan)
+    df = np.zeros((n_pred, n_out))
+    nobs = np.zeros((n_pred, n_out))
+    valid_pred = np.column_stack([~np.isnan(p).any(axis=1)
+                                  for p in predictors])
+    groups = regression.group_pairs_by_mask(~np.isnan(covs).any(axis=1),
+                                            valid_pred,
+                                            ~np.isnan(out_values))
+    intercept = np.ones((len(covs), 1))
+    for mask, pairs in groups.values():
+        pair_pred = np.array([p[0] for p in pairs])
+        pair_out = np.array([p[1] for p in pairs])
+        basis, _ = regression.covariate_basis(
+            np.column_stack([intercept[mask], covs[mask]]))
+        out_idx, out_pos = np.unique(pair_out, return_inverse=True)
+        res_out = regression.residualize(out_values[np.ix_(mask, out_idx)],
+                                         basis)
+        rss0 = np.einsum('ij,ij->j', res_out, res_out)
+        for p in np.unique(pair_pred):
+            selected = pair_pred == p
+            outs = out_pos[selected]
+            res_pred = regression.residualize(predictors[p][mask], basis)
+            pred_basis, rank = regression.covariate_basis(res_pred)
+            projection = pred_basis.T @ res_out[:, outs]
+            rss1 = rss0[outs] - np.einsum('ij,ij->j', projection, projection)
+            n = mask.sum()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                stat = n * np.log(rss0[outs] / np.clip(rss1, 0, None))
+            lrt[p, pair_out[selected]] = np.where(rank > 0, stat, np.nan)
+            df[p, pair_out[selected]] = rank
+            nobs[p, pair_out[selected]] = n
+    return lrt, df, nobs
+
+
+def association_study(data: pd.DataFrame,
+                      outcomes: List[str],
+                      predictors: List[str],
+                      covariates: List[str],
+                      var_types: Union[Dict[str, str], pd.Series, None] =
+                      None,
+                      min_n: int = 10,
+                      standardize_data: bool = True) -> pd.DataFrame:
+    """
+    Gaussian regression of each continuous outcome on each predictor,
+    adjusted by the covariates.
+
+    Every pair is fitted on its complete rows. The pairs that share them
+    are solved together: continuous and binary predictors with a Wald test
+    on their coefficient, categorical predictors with a likelihood ratio
+    test against the covariates only model.
+
+    Parameters
+    ----------
+    data: pd.DataFrame
+        Data frame with outcomes, predictors and covariates.
+    outcomes: List[str]
+        List of continuous outcome columns.
+    predictors: List[str]
+        List of predictor columns, each tested separately.
+    covariates: List[str]
+        List of covariate columns. An intercept is always added.
+    var_types: dict, pd.Series or None
+        Type of each predictor and covariate ('continuous', 'binary',
+        'categorical' or 'constant'). If None, they are inferred once with
+        get_types.
+    min_n: int
+        Minimum number of observations to report a test.
+    standardize_data: bool
+        Whether to standardize the outcomes and the continuous predictors
+        and covariates.
+
+    Returns
+    -------
+    res: pd.DataFrame
+        Results in the format of clarite.analyze.association_study, indexed
+        by Variable and Outcome and sorted by pvalue.
+    """
+    inferred = get_types(data, predictors + covariates)
+    if var_types is not None:
+        inferred.update(pd.Series(var_types))
+    var_types = inferred
+    covs = _covariate_design(data, covariates, var_types, standardize_data)
+    out_values = data.loc[:, outcomes].astype(float)
+    if standardize_data:
+        out_values = (out_values - out_values.mean()) / out_values.std()
+    out_values = out_values.to_numpy()
+
+    n_pred, n_out = len(predictors), len(outcomes)
+    beta = np.full((n_pred, n_out), np.nan)
+    se = np.full((n_pred, n_out), np.nan)
+    wald_pvalue = np.full((n_pred, n_out), np.nan)
+    lrt_pvalue = np.full((n_pred, n_out), np.nan)
+    diff_aic = np.full((n_pred, n_out), np.nan)
+    nobs = np.zeros((n_pred, n_out))
+
+    types = var_types[predictors].to_numpy()
+    single = np.flatnonzero(np.isin(types, ['continuous', 'binary']))
+    if single.size:
+        encoded = np.column_stack([_encode(data.loc[:, predictors[p]],
+                                           types[p],
+                                           standardize_data)
+                                   for p in single])
+        res = _wald_association(covs, encoded, out_values)
+        shape = (single.size, n_out)
+        beta[single] = res['coef'].to_numpy().reshape(shape)
+        se[single] = res['se'].to_numpy().reshape(shape)
+        nobs[single] = res['nobs'].to_numpy().reshape(shape)
+        # t-test, as in the gaussian GLM fitted by clarite
+        wald_pvalue[single] = res['pvalue'].to_numpy().reshape(shape)
+
+    multi = np.flatnonzero(types == 'categorical')
+    if multi.size:
+        encoded = [_encode(data.loc[:, predictors[p]],
+                           'categorical',
+                           standardize_data)
+                   for p in multi]
+        lrt, df, n = _lrt_association(covs, encoded, out_values)
+        with np.errstate(invalid='ignore'):
+            lrt_pvalue[multi] = np.where(df > 0, sps.chi2.sf(lrt, df),
+                                         np.nan)
+        diff_aic[multi] = -lrt + 2 * df
+        nobs[multi] = n
+
+    converged = (nobs >= min_n) & ~np.isin(types, ['constant'])[:, None]
+    pvalue = np.where(np.isin(types, ['categorical'])[:, None],
+                      lrt_pvalue, wald_pvalue)
+    converged &= ~np.isnan(pvalue)
+    for values in [beta, se, wald_pvalue, lrt_pvalue, diff_aic, pvalue]:
+        values[~converged] = np.nan
+
+    index = pd.MultiIndex.from_product([predictors, outcomes],
+                                       names=['Variable', 'Outcome'])
+    res = pd.DataFrame({'Variable_type': np.repeat(types, n_out),
+                        'Weight': None,
+                        'Converged': converged.ravel(),
+                        'N': nobs.ravel().astype(int),
+                        'Beta': beta.ravel(),
+                        'SE': se.ravel(),
+                        'Beta_pvalue': wald_pvalue.ravel(),
+                        'LRT_pvalue': lrt_pvalue.ravel(),
+                        'Diff_AIC': diff_aic.ravel(),
+                        'pvalue': pvalue.ravel()},
+                       index=index)
+    res = res.loc[:, RESULT_COLUMNS].sort_values('pvalue',
+                                                 kind='mergesort')
+    return res
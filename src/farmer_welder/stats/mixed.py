@@ -0,0 +1,375 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from typing import List, Tuple, Union
+from scipy import stats as sps
+from farmer_welder.stats import regression
+
+# Grid of variance ratios (random intercept over residual variance) where
+# the REML criterion is evaluated before the golden section refinement
+GAMMA_GRID = np.concatenate([[0], np.logspace(-3, 3, 25)])
+GOLDEN_ITERATIONS = 40
+GOLDEN_RATIO = (np.sqrt(5) - 1) / 2
+
+
+def _group_statistics(X: np.ndarray,
+                      Y: np.ndarray,
+                      groups: np.ndarray) -> dict:
+    """
+    Per group cross products of the design and the outcomes. Every
+    quantity of the random intercept model is a (weighted) sum of these.
+    """
+    n, p = X.shape
+    k = Y.shape[1]
+    n_groups = groups.max() + 1
+    Z = sp.csr_matrix((np.ones(n), (groups, np.arange(n))),
+                      shape=(n_groups, n))
+    sum_x = Z @ X
+    sum_y = Z @ Y
+    stats = {'shape': (p, k),
+             'n_g': np.bincount(groups, minlength=n_groups),
+             'xx': Z @ (X[:, :, None] * X[:, None, :]).reshape(n, -1),
+             'xy': Z @ (X[:, :, None] * Y[:, None, :]).reshape(n, -1),
+             'yy': Z @ np.square(Y),
+             'sxx': (sum_x[:, :, None] * sum_x[:, None, :]).
+             reshape(n_groups, -1),
+             'sxy': (sum_x[:, :, None] * sum_y[:, None, :]).
+             reshape(n_groups, -1),
+             'syy': np.square(sum_y)}
+    return stats
+
+
+def _aggregate(stats: dict,
+               weights: np.ndarray) -> dict:
+    """
+    Sum the group statistics with a weight per group (1, or the number of
+    times the group is drawn in a bootstrap replicate), separating the sums
+    of the outer products by group size. Also flags the sets of weights
+    with a rank deficient design (e.g. a constant covariate, or a single
+    time point), which can't be fitted.
+
+    Parameters
+    ----------
+    stats: dict
+        Output of _group_statistics.
+    weights: np.ndarray
+        Weights (B x n_groups), one row per set of weights.
+    """
+    p, k = stats['shape']
+    n_weights = weights.shape[0]
+    sizes = np.unique(stats['n_g'])
+    agg = {'shape': (p, k),
+           'sizes': sizes.astype(float),
+           'n': weights @ stats['n_g'].astype(float),
+           'xx': (weights @ stats['xx']).reshape(n_weights, p, p),
+           'xy': (weights @ stats['xy']).reshape(n_weights, p, k).
+           transpose(0, 2, 1),
+           'yy': weights @ stats['yy'],
+           'count': [], 'sxx': [], 'sxy': [], 'syy': []}
+    for size in sizes:
+        in_size = stats['n_g'] == size
+        w = weights[:, in_size]
+        agg['count'].append(w.sum(axis=1))
+        agg['sxx'].append((w @ stats['sxx'][in_size]).
+                          reshape(n_weights, p, p))
+        agg['sxy'].append((w @ stats['sxy'][in_size]).
+                          reshape(n_weights, p, k).transpose(0, 2, 1))
+        agg['syy'].append(w @ stats['syy'][in_size])
+    for key in ['count', 'sxx', 'sxy', 'syy']:
+        agg[key] = np.stack(agg[key])
+    # X'H^-1X has the rank of X'X whatever the variance ratio
+    agg['singular'] = np.linalg.matrix_rank(agg['xx'], hermitian=True) < p
+    return agg
+
+
+def _gls(agg: dict,
+         gamma: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray,
+                                     np.ndarray]:
+    """
+    GLS solution and profiled REML criterion for the variance ratios gamma.
+
+    With V = sigma2 * (I + gamma * ZZ'), the inverse of each group block is
+    (I - w_g * 11') / sigma2, with w_g = gamma / (1 + n_g * gamma), so
+    X'V^-1X = (X'X - sum_g w_g * s_g s_g') / sigma2 with s_g the group sums.
+
+    Parameters
+    ----------
+    agg: dict
+        Output of _aggregate.
+    gamma: np.ndarray
+        Variance ratios (B x k), one per set of weights and outcome.
+
+    Returns
+    -------
+    reml: np.ndarray
+        Profiled REML log likelihood, up to a constant (B x k). -inf for
+        the singular designs.
+    beta: np.ndarray
+        Fixed effects (B x k x p). NaN for the singular designs.
+    xvx: np.ndarray
+        X'H^-1X, with H = V / sigma2 (B x k x p x p).
+    scale: np.ndarray
+        Residual variance sigma2 (B x k).
+    """
+    p, _ = agg['shape']
+    w = gamma[None] / (1 + agg['sizes'][:, None, None] * gamma[None])
+    xvx = agg['xx'][:, None] - np.einsum('sbk,sbij->bkij', w, agg['sxx'])
+    # Solve the singular designs as identities, and discard them below
+    singular = agg['singular'][:, None]
+    xvx = np.where(singular[..., None, None], np.eye(p), xvx)
+    xvy = agg['xy'] - np.einsum('sbk,sbkj->bkj', w, agg['sxy'])
+    yvy = agg['yy'] - np.einsum('sbk,sbk->bk', w, agg['syy'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        beta = np.linalg.solve(xvx, xvy[..., None])[..., 0]
+        rss = yvy - np.einsum('bkj,bkj->bk', xvy, beta)
+        _, logdet_xvx = np.linalg.slogdet(xvx)
+        logdet_h = np.einsum('sb,sbk->bk', agg['count'],
+                             np.log1p(agg['sizes'][:, None, None] *
+                                      gamma[None]))
+        df = (agg['n'] - p)[:, None]
+        reml = -(df * np.log(rss) + logdet_h + logdet_xvx) / 2
+        scale = rss / df
+    reml = np.where(np.isfinite(reml) & ~singular, reml, -np.inf)
+    beta = np.where(singular[..., None], np.nan, beta)
+    scale = np.where(singular, np.nan, scale)
+    return reml, beta, xvx, scale
+
+
+def _fit(agg: dict) -> Tuple[np.ndarray, np.ndarray, np.ndarray,
+                             np.ndarray]:
+    """
+    Maximize the REML criterion over the variance ratio of every set of
+    weights and outcome at once: a grid search followed by a golden section
+    search between the neighbors of the best grid point.
+
+    Returns
+    -------
+    beta: np.ndarray
+        Fixed effects (B x k x p).
+    cov: np.ndarray
+        Covariance of the fixed effects (B x k x p x p).
+    gamma: np.ndarray
+        Variance ratios (B x k).
+    converged: np.ndarray
+        Whether the criterion is finite at the optimum (B x k), False for
+        the singular designs.
+    """
+    _, k = agg['shape']
+    shape = (agg['n'].shape[0], k)
+    grid = np.stack([_gls(agg, np.full(shape, g))[0] for g in GAMMA_GRID])
+    best = grid.argmax(axis=0)
+    lower = GAMMA_GRID[np.maximum(best - 1, 0)]
+    upper = GAMMA_GRID[np.minimum(best + 1, len(GAMMA_GRID) - 1)]
+    x1 = upper - GOLDEN_RATIO * (upper - lower)
+    x2 = lower + GOLDEN_RATIO * (upper - lower)
+    f1 = _gls(agg, x1)[0]
+    f2 = _gls(agg, x2)[0]
+    for _ in range(GOLDEN_ITERATIONS):
+        # Keep the bracket with the best point, and evaluate a new point
+        left = f1 > f2
+        upper = np.where(left, x2, upper)
+        lower = np.where(left, lower, x1)
+        x_kept = np.where(left, x1, x2)
+        f_kept = np.where(left, f1, f2)
+        x_new = np.where(left,
+                         upper - GOLDEN_RATIO * (upper - lower),
+                         lower + GOLDEN_RATIO * (upper - lower))
+        f_new = _gls(agg, x_new)[0]
+        x1, f1 = np.where(left, x_new, x_kept), np.where(left, f_new, f_kept)
+        x2, f2 = np.where(left, x_kept, x_new), np.where(left, f_kept, f_new)
+    gamma = np.where(f1 > f2, x1, x2)
+    # Keep the grid point if it's better (e.g. on the boundary gamma = 0)
+    grid_best = grid.max(axis=0)
+    refined = _gls(agg, gamma)[0]
+    gamma = np.where(refined >= grid_best, gamma, GAMMA_GRID[best])
+    reml, beta, xvx, scale = _gls(agg, gamma)
+    converged = np.isfinite(reml) & np.isfinite(scale) & (scale > 0)
+    with np.errstate(invalid='ignore'):
+        cov = np.linalg.pinv(xvx, hermitian=True) * scale[..., None, None]
+    return beta, cov, gamma, converged
+
+
+def lmm_blocks(dat: pd.DataFrame,
+               exposures: List[str],
+               outcomes: List[str],
+               covariates: List[str],
+               group: str = 'study_id',
+               time: str = 'Visit',
+               exclude: Union[pd.DataFrame, None] = None,
+               cache: Union[regression.DesignCache, None] = None) -> \
+        List[dict]:
+    """
+    Group statistics of the random intercept models
+    `outcome ~ covariates + exposure * time` with a random intercept per
+    group, once per exposure and set of complete rows. All the outcomes in
+    a block share the design and are fitted together. The covariate block
+    and the groups of each set of rows come from cache (a new
+    regression.DesignCache of dat if None).
+
+    The pairs with too few complete rows to estimate the fixed effects
+    (number of covariates plus 4 or less, counting the intercept) get no
+    block, so they are left as not converged. Their number is printed.
+
+    Returns
+    -------
+    blocks: List[dict]
+        One block per exposure and set of complete rows, with its group
+        statistics ('stats'), the position of each of its pairs in the
+        exposures x outcomes results ('position'), the ID of each group
+        among all the groups of dat ('groups'), the column of the exposure
+        in the design ('exposure_col') and the number of rows ('nobs').
+    """
+    if cache is None:
+        cache = regression.DesignCache(dat)
+    covs = cache.covariates(covariates)
+    times = dat.loc[:, time].to_numpy(dtype=float)
+    group_ids, _ = pd.factorize(dat.loc[:, group])
+    exp_values = dat.loc[:, exposures].to_numpy(dtype=float)
+    out_values = dat.loc[:, outcomes].to_numpy(dtype=float)
+    valid_exp = ~np.isnan(exp_values)
+    valid_out = ~np.isnan(out_values)
+    if exclude is not None:
+        valid_exp &= ~exclude.loc[:, exposures].to_numpy(dtype=bool)
+        valid_out &= ~exclude.loc[:, outcomes].to_numpy(dtype=bool)
+    valid = ~np.isnan(covs).any(axis=1) & ~np.isnan(times) & \
+        (group_ids >= 0)
+    groups = regression.group_pairs_by_mask(valid, valid_exp, valid_out)
+
+    blocks = []
+    n_skipped = 0
+    for mask, pairs in groups.values():
+        # Too few rows to estimate the fixed effects, left as not converged
+        if mask.sum() <= covs.shape[1] + 3:
+            n_skipped += len(pairs)
+            continue
+        pair_exp = np.array([p[0] for p in pairs])
+        pair_out = np.array([p[1] for p in pairs])
+        design = cache.get(covariates, mask)
+        local_groups, ids = cache.groups(covariates, mask, group)
+        for e in np.unique(pair_exp):
+            outs = pair_out[pair_exp == e]
+            exp_col = exp_values[mask, e]
+            X = np.column_stack([design['covs'], exp_col, times[mask],
+                                 exp_col * times[mask]])
+            Y = out_values[np.ix_(mask, outs)]
+            blocks.append({'stats': _group_statistics(X, Y, local_groups),
+                           'position': e * len(outcomes) + outs,
+                           'groups': ids,
+                           'exposure_col': covs.shape[1],
+                           'nobs': mask.sum()})
+    if n_skipped > 0:
+        print(f'{n_skipped} pairs with too few complete rows for the mixed '
+              f'model, left as not converged')
+    return blocks
+
+
+def fit_block(block: dict,
+              weights: Union[np.ndarray, None] = None) -> \
+        Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Fit the random intercept models of a block by REML.
+
+    Parameters
+    ----------
+    block: dict
+        Block from lmm_blocks.
+    weights: np.ndarray or None
+        Weights of the groups (B x n_groups). If None, every group has
+        weight one.
+
+    Returns
+    -------
+    coef: np.ndarray
+        Exposure coefficient (B x k).
+    se: np.ndarray
+        Standard error of the exposure coefficient (B x k).
+    converged: np.ndarray
+        Whether each fit converged (B x k). The sets of weights with a rank
+        deficient design are not converged, with NaN coef and se.
+    """
+    stats = block['stats']
+    if weights is None:
+        weights = np.ones((1, len(stats['n_g'])))
+    beta, cov, _, converged = _fit(_aggregate(stats, weights))
+    j = block['exposure_col']
+    coef = beta[..., j]
+    with np.errstate(invalid='ignore'):
+        se = np.sqrt(cov[..., j, j])
+    return coef, se, converged
+
+
+def random_intercept_lmm(dat: pd.DataFrame,
+                         exposures: List[str],
+                         outcomes: List[str],
+                         covariates: List[str],
+                         group: str = 'study_id',
+                         time: str = 'Visit',
+                         exclude: Union[pd.DataFrame, None] = None,
+                         cache: Union[regression.DesignCache, None] = None) \
+        -> pd.DataFrame:
+    """
+    Random intercept linear mixed models for every exposure and outcome
+    pair, fitted by REML.
+
+    Equivalent to `smf.mixedlm('outcome ~ covariates + exposure * time',
+    groups=group)` for each pair (dropping rows with missing values), but
+    it uses the block diagonal, compound symmetry structure of the random
+    intercept covariance: the REML criterion is profiled over the ratio of
+    variances with closed form group sums, and the outcomes that share the
+    design are solved together.
+
+    Parameters
+    ----------
+    dat: pd.DataFrame
+        Data frame with exposures, outcomes, covariates, group and time.
+    exposures: List[str]
+        List of exposure columns.
+    outcomes: List[str]
+        List of outcome columns.
+    covariates: List[str]
+        List of covariate columns. An intercept is always added.
+    group: str
+        Column with the groups of the random intercept (participants).
+    time: str
+        Column interacting with the exposure (visit).
+    exclude: pd.DataFrame or None
+        Boolean data frame with the exposure and outcome columns, True for
+        the values to leave out of the fits (e.g. outliers).
+    cache: regression.DesignCache or None
+        Cache of the covariate designs of dat. If None, a new one is used.
+
+    Returns
+    -------
+    res: pd.DataFrame
+        Results table indexed by exposures and outcomes, with the converged
+        flag, pvalue (z test, as statsmodels), coef, standard error and
+        number of observations of the exposure term. The pairs with too few
+        complete rows (see lmm_blocks) are not converged, with missing coef,
+        standard error and pvalue.
+    """
+    n_pairs = len(exposures) * len(outcomes)
+    converged = np.zeros(n_pairs, dtype=bool)
+    coef = np.full(n_pairs, np.nan)
+    se = np.full(n_pairs, np.nan)
+    nobs = np.zeros(n_pairs)
+    for block in lmm_blocks(dat, exposures, outcomes, covariates, group,
+                            time, exclude, cache):
+        block_coef, block_se, block_converged = fit_block(block)
+        position = block['position']
+        coef[position] = block_coef[0]
+        se[position] = block_se[0]
+        converged[position] = block_converged[0]
+        nobs[position] = block['nobs']
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pvalue = 2 * sps.norm.sf(np.abs(coef / se))
+    index = pd.MultiIndex.from_product([exposures, outcomes],
+                                       names=['exposures', 'metabolites'])
+    res = pd.DataFrame({'converged': converged,
+                        'pvalue': pvalue,
+                        'coef': coef,
+                        'se': se,
+                        'nobs': nobs},
+                       index=index)
+    return res
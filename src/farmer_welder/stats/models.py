@@ -0,0 +1,148 @@
+# Fitted PCA models saved as versioned artifacts keyed by their input data
+import os
+import glob
+import pickle
+import pandas as pd
+
+from typing import List, Tuple, Union
+from sklearn.decomposition import PCA, IncrementalPCA
+from farmer_welder.data import cache, load
+from farmer_welder.stats.stats import DataTransformer
+
+MODELS_DIR = 'results/models'
+# Bump when the content of the artifacts changes, to refit old models
+MODEL_VERSION = 1
+
+
+def get_model_key(cohort: str = 'farmers',
+                  incremental: bool = False) -> str:
+    '''
+    Build the key of the PCA model of a cohort from the content of the
+    processed data and the fitted transformation
+
+    Parameters
+    ----------
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+    incremental: bool
+        Whether the model is an IncrementalPCA.
+
+    Returns
+    -------
+    key: str
+        Model key, the model name followed by a digest of the inputs.
+    '''
+    name = ('ipca_' if incremental else 'pca_') + cohort
+    files = [load.get_processed_path(cohort),
+             load.get_transformer_path(cohort)]
+    return cache.get_cache_key(name, files)
+
+
+def _get_model_path(key: str) -> str:
+    return os.path.join(MODELS_DIR, key + '.pkl')
+
+
+def save_pca(pca: Union[PCA, IncrementalPCA],
+             transformer: DataTransformer,
+             columns: List[str],
+             cohort: str = 'farmers') -> str:
+    '''
+    Save a fitted PCA with the transformation and columns it was fitted on.
+    Older models of the same cohort and kind are removed.
+
+    Parameters
+    ----------
+    pca: PCA or IncrementalPCA
+        PCA results from scikit, with the components and explained variance.
+    transformer: DataTransformer
+        Transformation applied before the PCA.
+    columns: List[str]
+        Columns used in the PCA, in order.
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+
+    Returns
+    -------
+    path: str
+        Path to the saved artifact.
+    '''
+    incremental = isinstance(pca, IncrementalPCA)
+    key = get_model_key(cohort, incremental)
+    name = key.rsplit('_', 1)[0]
+    for old_path in glob.glob(_get_model_path(name + '_*')):
+        os.remove(old_path)
+    artifact = {'version': MODEL_VERSION,
+                'key': key,
+                'columns': list(columns),
+                'transformer': transformer.get_params(),
+                'pca': pca}
+    path = _get_model_path(key)
+    with open(path, 'wb') as f:
+        pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def load_pca(columns: List[str],
+             cohort: str = 'farmers',
+             incremental: bool = False) -> \
+        Union[Tuple[Union[PCA, IncrementalPCA], DataTransformer], None]:
+    '''
+    Load the PCA model fitted on the current data of a cohort
+
+    Parameters
+    ----------
+    columns: List[str]
+        Columns the model should be fitted on, in order.
+    cohort: str
+        Either the 'farmers' or 'welders' cohort.
+    incremental: bool
+        Whether to load the IncrementalPCA model.
+
+    Returns
+    -------
+    model: Tuple[PCA or IncrementalPCA, DataTransformer] or None
+        Fitted PCA and its transformation, or None if there's no model for
+        the current data, version and columns.
+    '''
+    path = _get_model_path(get_model_key(cohort, incremental))
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        artifact = pickle.load(f)
+    if artifact['version'] != MODEL_VERSION or \
+            artifact['columns'] != list(columns):
+        return None
+    transformer = DataTransformer.from_params(artifact['transformer'])
+    return artifact['pca'], transformer
+
+
+def get_scores(pca: Union[PCA, IncrementalPCA],
+               transformer: DataTransformer,
+               dat: pd.DataFrame,
+               columns: List[str]) -> pd.DataFrame:
+    '''
+    Project new samples with a loaded PCA model
+
+    Parameters
+    ----------
+    pca: PCA or IncrementalPCA
+        Fitted PCA.
+    transformer: DataTransformer
+        Transformation applied before the PCA.
+    dat: pd.DataFrame
+        Samples to project, with the model columns and 'project_id'.
+    columns: List[str]
+        Columns used in the PCA, in order.
+
+    Returns
+    -------
+    scores: pd.DataFrame
+        Scores (PC1, PC2, ...) with the same index as dat.
+    '''
+    X = transformer.transform(dat.loc[:, columns],
+                              groups=dat.loc[:, 'project_id'])
+    pc_names = ['PC' + str(i + 1) for i in range(pca.n_components_)]
+    scores = pd.DataFrame(pca.transform(X.to_numpy()),
+                          columns=pc_names,
+                          index=dat.index)
+    return scores
@@ -0,0 +1,337 @@
+import numpy as np
+import pandas as pd
+
+from collections import OrderedDict
+from typing import Dict, List, Tuple, Union
+from scipy import stats as sps
+
+
+def get_formula_terms(formula: str) -> List[str]:
+    """
+    Split a formula style string of additive terms into column names.
+
+    Parameters
+    ----------
+    formula: str
+        Terms in formula style (e.g. 'cov1 + cov2').
+
+    Returns
+    -------
+    terms: List[str]
+        List of column names.
+    """
+    terms = [term.strip() for term in formula.split('+')]
+    return [term for term in terms if term != '']
+
+
+def covariate_basis(covs: np.ndarray,
+                    tol: float = 1e-10) -> Tuple[np.ndarray, int]:
+    """
+    Orthonormal basis of the column space of the covariate design.
+
+    Parameters
+    ----------
+    covs: np.ndarray
+        Covariate design matrix (n x p), including the intercept.
+    tol: float
+        Relative tolerance to drop singular values (rank deficiency).
+
+    Returns
+    -------
+    basis: np.ndarray
+        Orthonormal basis (n x rank).
+    rank: int
+        Rank of the covariate design.
+    """
+    u, s, _ = np.linalg.svd(covs, full_matrices=False)
+    keep = s > tol * s.max() if s.size else np.zeros(0, dtype=bool)
+    return u[:, keep], int(keep.sum())
+
+
+def residualize(values: np.ndarray,
+                basis: np.ndarray) -> np.ndarray:
+    """
+    Residuals of values after projecting out the covariate basis.
+
+    Parameters
+    ----------
+    values: np.ndarray
+        Matrix (n x k) of columns to residualize.
+    basis: np.ndarray
+        Orthonormal basis (n x rank) of the covariate design.
+
+    Returns
+    -------
+    residuals: np.ndarray
+        Residualized columns (n x k).
+    """
+    return values - basis @ (basis.T @ values)
+
+
+class DesignCache:
+    """
+    Covariate designs of a data frame, built once and shared by all the
+    models fitted on it.
+
+    The covariate block (with intercept) is built once per set of
+    covariates, and its restriction to a set of complete rows, with the
+    orthonormal basis and the groups of those rows, once per set of
+    covariates and rows. The least recently used designs are evicted when
+    there are more than maxsize sets of rows.
+
+    Parameters
+    ----------
+    dat: pd.DataFrame
+        Data frame with the covariates (and group columns).
+    maxsize: int
+        Maximum number of designs kept.
+    """
+    def __init__(self,
+                 dat: pd.DataFrame,
+                 maxsize: int = 128):
+        self.dat = dat
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._covariates = {}
+        self._designs = OrderedDict()
+
+    def covariates(self,
+                   covariates: List[str]) -> np.ndarray:
+        """
+        Covariate block of all the rows, with an intercept (n x p). Rows
+        with missing covariates are NaN.
+        """
+        key = tuple(covariates)
+        if key not in self._covariates:
+            self._covariates[key] = np.column_stack(
+                [np.ones(len(self.dat)),
+                 self.dat.loc[:, covariates].to_numpy(dtype=float)])
+        return self._covariates[key]
+
+    def get(self,
+            covariates: List[str],
+            mask: np.ndarray) -> dict:
+        """
+        Design of the rows in mask, a dict with the covariate block
+        ('covs'). The basis and groups are added by the methods below when
+        first needed.
+        """
+        key = (tuple(covariates), np.packbits(mask).tobytes())
+        if key in self._designs:
+            self.hits += 1
+            self._designs.move_to_end(key)
+            return self._designs[key]
+        self.misses += 1
+        design = {'covs': self.covariates(covariates)[mask]}
+        self._designs[key] = design
+        if len(self._designs) > self.maxsize:
+            self._designs.popitem(last=False)
+        return design
+
+    def basis(self,
+              covariates: List[str],
+              mask: np.ndarray) -> Tuple[np.ndarray, int]:
+        """
+        Orthonormal basis and rank of the covariate block of the rows in
+        mask (see covariate_basis).
+        """
+        design = self.get(covariates, mask)
+        if 'basis' not in design:
+            design['basis'], design['rank'] = covariate_basis(design['covs'])
+        return design['basis'], design['rank']
+
+    def groups(self,
+               covariates: List[str],
+               mask: np.ndarray,
+               group: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Group of each row in mask, as codes from 0 to the number of groups,
+        and the group IDs among all the groups of the data frame.
+        """
+        design = self.get(covariates, mask)
+        key = 'groups_' + group
+        if key not in design:
+            all_groups, _ = pd.factorize(self.dat.loc[:, group])
+            codes, ids = pd.factorize(all_groups[mask])
+            design[key] = (codes, np.asarray(ids))
+        return design[key]
+
+
+def group_pairs_by_mask(valid_covs: np.ndarray,
+                        valid_exp: np.ndarray,
+                        valid_out: np.ndarray) -> Dict[bytes, list]:
+    """
+    Group the (exposure, outcome) pairs that share the same complete rows.
+
+    Parameters
+    ----------
+    valid_covs: np.ndarray
+        Boolean mask of the rows with complete covariates (n).
+    valid_exp: np.ndarray
+        Boolean mask of the usable values of each exposure (n x exposures).
+    valid_out: np.ndarray
+        Boolean mask of the usable values of each outcome (n x outcomes).
+
+    Returns
+    -------
+    groups: Dict[bytes, list]
+        For each set of complete rows (keyed by its packed mask), the mask
+        and the list of (exposure, outcome) index pairs that use it.
+    """
+    groups = {}
+    for e in range(valid_exp.shape[1]):
+        masks = valid_covs[:, None] & valid_exp[:, [e]] & valid_out
+        for m in range(valid_out.shape[1]):
+            mask = masks[:, m]
+            key = np.packbits(mask).tobytes()
+            if key not in groups:
+                groups[key] = [mask, []]
+            groups[key][1].append((e, m))
+    return groups
+
+
+def residualized_blocks(dat: pd.DataFrame,
+                        exposures: List[str],
+                        outcomes: List[str],
+                        covariates: List[str],
+                        exclude: Union[pd.DataFrame, None] = None,
+                        cache: Union[DesignCache, None] = None) -> \
+        List[dict]:
+    """
+    Residualize the exposures and outcomes on the covariates, once per set
+    of complete rows shared by (exposure, outcome) pairs.
+
+    Parameters
+    ----------
+    dat: pd.DataFrame
+        Data frame with exposures, outcomes and covariates.
+    exposures: List[str]
+        List of exposure columns.
+    outcomes: List[str]
+        List of outcome columns.
+    covariates: List[str]
+        List of covariate columns. An intercept is always added.
+    exclude: pd.DataFrame or None
+        Boolean data frame with the exposure and outcome columns, True for
+        the values to leave out of the fits (e.g. outliers).
+    cache: DesignCache or None
+        Cache of the covariate designs of dat. If None, a new one is used.
+
+    Returns
+    -------
+    blocks: List[dict]
+        One block per set of complete rows, with the row indices ('rows'),
+        the residualized exposures and outcomes used by its pairs
+        ('res_exp', 'res_out'), the columns of each pair in them
+        ('exp_pos', 'out_pos'), the position of each pair in the
+        exposures x outcomes results ('position'), and the orthonormal
+        basis and rank of the covariate design ('basis', 'rank').
+    """
+    if cache is None:
+        cache = DesignCache(dat)
+    covs = cache.covariates(covariates)
+    exp_values = dat.loc[:, exposures].to_numpy(dtype=float)
+    out_values = dat.loc[:, outcomes].to_numpy(dtype=float)
+    valid_exp = ~np.isnan(exp_values)
+    valid_out = ~np.isnan(out_values)
+    if exclude is not None:
+        valid_exp &= ~exclude.loc[:, exposures].to_numpy(dtype=bool)
+        valid_out &= ~exclude.loc[:, outcomes].to_numpy(dtype=bool)
+    groups = group_pairs_by_mask(~np.isnan(covs).any(axis=1),
+                                 valid_exp,
+                                 valid_out)
+
+    blocks = []
+    for mask, pairs in groups.values():
+        pair_exp = np.array([p[0] for p in pairs])
+        pair_out = np.array([p[1] for p in pairs])
+        exp_idx, exp_pos = np.unique(pair_exp, return_inverse=True)
+        out_idx, out_pos = np.unique(pair_out, return_inverse=True)
+        basis, rank = cache.basis(covariates, mask)
+        blocks.append({
+            'rows': np.flatnonzero(mask),
+            'res_exp': residualize(exp_values[np.ix_(mask, exp_idx)], basis),
+            'res_out': residualize(out_values[np.ix_(mask, out_idx)], basis),
+            'exp_pos': exp_pos,
+            'out_pos': out_pos,
+            'position': pair_exp * len(outcomes) + pair_out,
+            'basis': basis,
+            'rank': rank})
+    return blocks
+
+
+def ols_association(dat: pd.DataFrame,
+                    exposures: List[str],
+                    outcomes: List[str],
+                    covariates: List[str],
+                    exclude: Union[pd.DataFrame, None] = None,
+                    cache: Union[DesignCache, None] = None) -> \
+        pd.DataFrame:
+    """
+    Batched least squares for every exposure and outcome pair.
+
+    Equivalent to fitting `outcome ~ covariates + exposure` with OLS for each
+    pair (dropping rows with missing values), but the covariate design is
+    factorized once per set of complete rows and all pairs sharing it are
+    solved together.
+
+    Parameters
+    ----------
+    dat: pd.DataFrame
+        Data frame with exposures, outcomes and covariates.
+    exposures: List[str]
+        List of exposure columns.
+    outcomes: List[str]
+        List of outcome columns.
+    covariates: List[str]
+        List of covariate columns. An intercept is always added.
+    exclude: pd.DataFrame or None
+        Boolean data frame with the exposure and outcome columns, True for
+        the values to leave out of the fits (e.g. outliers).
+    cache: DesignCache or None
+        Cache of the covariate designs of dat. If None, a new one is used.
+
+    Returns
+    -------
+    res: pd.DataFrame
+        Results table indexed by exposures and outcomes, with the coef,
+        standard error, t statistic, pvalue and number of observations of
+        the exposure term.
+    """
+    n_pairs = len(exposures) * len(outcomes)
+    coef = np.full(n_pairs, np.nan)
+    se = np.full(n_pairs, np.nan)
+    nobs = np.zeros(n_pairs)
+    df_resid = np.zeros(n_pairs)
+    for block in residualized_blocks(dat, exposures, outcomes, covariates,
+                                     exclude, cache):
+        res_exp, res_out = block['res_exp'], block['res_out']
+        exp_pos, out_pos = block['exp_pos'], block['out_pos']
+        sxx = np.einsum('ij,ij->j', res_exp, res_exp)[exp_pos]
+        syy = np.einsum('ij,ij->j', res_out, res_out)[out_pos]
+        sxy = (res_exp.T @ res_out)[exp_pos, out_pos]
+        n = len(block['rows'])
+        df = n - block['rank'] - 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            beta = sxy / sxx
+            rss = np.clip(syy - beta * sxy, 0, None)
+            beta_se = np.sqrt(rss / df / sxx)
+        position = block['position']
+        coef[position] = beta
+        se[position] = beta_se
+        nobs[position] = n
+        df_resid[position] = df
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tvalue = coef / se
+        pvalue = 2 * sps.t.sf(np.abs(tvalue), df_resid)
+    index = pd.MultiIndex.from_product([exposures, outcomes],
+                                       names=['exposures', 'metabolites'])
+    res = pd.DataFrame({'pvalue': pvalue,
+                        'coef': coef,
+                        'se': se,
+                        'tvalue': tvalue,
+                        'nobs': nobs},
+                       index=index)
+    return res
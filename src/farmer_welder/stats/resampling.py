@@ -0,0 +1,442 @@
+import os
+import numpy as np
+import pandas as pd
+
+from typing import Callable, List, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor
+from farmer_welder.stats import mixed, regression
+
+_worker_blocks = None
+
+
+def _init_worker(blocks: tuple):
+    """
+    Store the residualized blocks (and the data shared by the resamples)
+    once per worker process.
+    """
+    global _worker_blocks
+    _worker_blocks = blocks
+
+
+def _run_chunks(run_chunk: Callable[[Tuple[np.random.SeedSequence, int]],
+                                     np.ndarray],
+                shared: tuple,
+                n_samples: int,
+                seed: Union[int, None],
+                n_jobs: int,
+                chunk_size: int) -> np.ndarray:
+    """
+    Run the resamples in chunks, each with its own independent seed spawned
+    from seed, serially or in a process pool. The results don't depend on
+    the number of processes.
+    """
+    sizes = [chunk_size] * (n_samples // chunk_size)
+    if n_samples % chunk_size:
+        sizes.append(n_samples % chunk_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = list(zip(seeds, sizes))
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_init_worker,
+                                 initargs=(shared,)) as executor:
+            results = list(executor.map(run_chunk, tasks))
+    else:
+        _init_worker(shared)
+        results = [run_chunk(task) for task in tasks]
+    return np.concatenate(results)
+
+
+def _pair_statistics(block: dict) -> Tuple[np.ndarray, np.ndarray,
+                                           np.ndarray]:
+    """
+    Sum of squares of the exposure and outcome residuals of each pair of a
+    block, and its residual degrees of freedom.
+    """
+    res_exp, res_out = block['res_exp'], block['res_out']
+    sxx = np.einsum('ij,ij->j', res_exp, res_exp)[block['exp_pos']]
+    syy = np.einsum('ij,ij->j', res_out, res_out)[block['out_pos']]
+    df = len(block['rows']) - block['rank'] - 1
+    return sxx, syy, df
+
+
+def _tvalues(sxy: np.ndarray,
+             sxx: np.ndarray,
+             syy: np.ndarray,
+             df: int) -> np.ndarray:
+    """
+    t statistics of the exposure coefficient from the residual products.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        beta = sxy / sxx
+        rss = np.clip(syy - beta * sxy, 0, None)
+        return beta / np.sqrt(rss / df / sxx)
+
+
+def _max_statistics(task: Tuple[np.random.SeedSequence, int]) -> np.ndarray:
+    """
+    Maximum absolute t statistic over all pairs for a chunk of permutations.
+
+    The permutations are drawn as random keys over all the rows, so every
+    block uses the same permutation restricted to its own rows (the order
+    of the keys of those rows).
+    """
+    seed, n_permutations = task
+    blocks, n_rows = _worker_blocks
+    rng = np.random.default_rng(seed)
+    keys = rng.random((n_permutations, n_rows))
+    max_t = np.zeros(n_permutations)
+    for block in blocks:
+        sxx, syy, df = _pair_statistics(block)
+        order = np.argsort(keys[:, block['rows']], axis=1)
+        # Permuted exposure residuals, one matrix per permutation
+        permuted = block['res_exp'][order]
+        sxy = np.einsum('bne,nm->bem', permuted, block['res_out'])
+        sxy = sxy[:, block['exp_pos'], block['out_pos']]
+        tvalues = np.abs(_tvalues(sxy, sxx, syy, df))
+        np.fmax(max_t, np.nanmax(tvalues, axis=1, initial=0), out=max_t)
+    return max_t
+
+
+def maxt_pvalues(dat: pd.DataFrame,
+                 exposures: List[str],
+                 outcomes: List[str],
+                 covariates: List[str],
+                 exclude: Union[pd.DataFrame, None] = None,
+                 n_permutations: int = 10000,
+                 seed: Union[int, None] = None,
+                 n_jobs: int = 1,
+                 chunk_size: int = 100,
+                 cache: Union[regression.DesignCache, None] = None) -> \
+        pd.Series:
+    """
+    Family-wise error rate adjusted pvalues of every exposure and outcome
+    pair with the max-T permutation method (Westfall and Young).
+
+    The covariate design is factorized once per set of complete rows (as in
+    regression.ols_association) and the exposure residuals are permuted
+    (Kennedy), so each permutation is a batched matrix product. Taking the
+    maximum statistic over all pairs accounts for the correlation between
+    outcomes.
+
+    Parameters
+    ----------
+    dat: pd.DataFrame
+        Data frame with exposures, outcomes and covariates.
+    exposures: List[str]
+        List of exposure columns.
+    outcomes: List[str]
+        List of outcome columns.
+    covariates: List[str]
+        List of covariate columns. An intercept is always added.
+    exclude: pd.DataFrame or None
+        Boolean data frame with the exposure and outcome columns, True for
+        the values to leave out of the fits (e.g. outliers).
+    n_permutations: int
+        Number of permutations.
+    seed: int or None
+        Seed of the random number generator.
+    n_jobs: int
+        Number of processes to run the permutations. -1 uses all the
+        available cores.
+    chunk_size: int
+        Number of permutations computed together.
+    cache: regression.DesignCache or None
+        Cache of the covariate designs of dat. If None, a new one is used.
+
+    Returns
+    -------
+    pvalue_fwer: pd.Series
+        Adjusted pvalues indexed by exposures and outcomes.
+    """
+    blocks = regression.residualized_blocks(dat, exposures, outcomes,
+                                            covariates, exclude, cache)
+    observed = np.full(len(exposures) * len(outcomes), np.nan)
+    for block in blocks:
+        sxx, syy, df = _pair_statistics(block)
+        sxy = (block['res_exp'].T @ block['res_out'])[block['exp_pos'],
+                                                       block['out_pos']]
+        observed[block['position']] = np.abs(_tvalues(sxy, sxx, syy, df))
+
+    max_t = _run_chunks(_max_statistics, (blocks, len(dat)),
+                        n_permutations, seed, n_jobs, chunk_size)
+    max_t = np.sort(max_t)
+
+    # Number of permutations with a maximum at least as large
+    exceed = n_permutations - np.searchsorted(max_t, observed, side='left')
+    pvalue_fwer = (1 + exceed) / (n_permutations + 1)
+    pvalue_fwer[np.isnan(observed)] = np.nan
+    index = pd.MultiIndex.from_product([exposures, outcomes],
+                                       names=['exposures', 'metabolites'])
+    return pd.Series(pvalue_fwer, index=index, name='pvalue_fwer')
+
+
+def _bootstrap_products(block: dict) -> dict:
+    """
+    Row products of a block needed by the weighted least squares, computed
+    once and reused by every replicate.
+    """
+    basis, res_exp, res_out = (block['basis'], block['res_exp'],
+                               block['res_out'])
+    exp_pos, out_pos = block['exp_pos'], block['out_pos']
+    n = len(block['rows'])
+    products = {'rows': block['rows'],
+                'position': block['position'],
+                'exp_pos': exp_pos,
+                'out_pos': out_pos,
+                'shape': (block['rank'], res_exp.shape[1],
+                          res_out.shape[1]),
+                'xy': res_exp[:, exp_pos] * res_out[:, out_pos],
+                'xx': np.square(res_exp),
+                'qq': (basis[:, :, None] * basis[:, None, :]).reshape(n, -1),
+                'qx': (basis[:, :, None] * res_exp[:, None, :]).
+                reshape(n, -1),
+                'qy': (basis[:, :, None] * res_out[:, None, :]).
+                reshape(n, -1)}
+    return products
+
+
+def _bootstrap_coefs(task: Tuple[np.random.SeedSequence, int]) -> np.ndarray:
+    """
+    Exposure coefficients of every pair for a chunk of cluster bootstrap
+    replicates.
+
+    A replicate draws the clusters with replacement and weights each row by
+    the number of times its cluster was drawn, so all the arrays keep the
+    same shape across replicates and the row products are reused. The
+    weighted least squares are solved with the unweighted covariate basis Q
+    of each block: x'WMy = x'Wy - (Q'Wx)' (Q'WQ)^+ (Q'Wy).
+    """
+    seed, n_replicates = task
+    blocks, n_pairs, clusters = _worker_blocks
+    rng = np.random.default_rng(seed)
+    counts = _draw_counts(rng, clusters.max() + 1, n_replicates)
+    coefs = np.full((n_replicates, n_pairs), np.nan)
+    for block in blocks:
+        rank, n_exp, n_out = block['shape']
+        exp_pos, out_pos = block['exp_pos'], block['out_pos']
+        weights = counts[:, clusters[block['rows']]]
+        # Weighted sums of the row products, for all replicates at once
+        sxy = weights @ block['xy']
+        sxx = weights @ block['xx']
+        gram = (weights @ block['qq']).reshape(-1, rank, rank)
+        qx = (weights @ block['qx']).reshape(-1, rank, n_exp)
+        qy = (weights @ block['qy']).reshape(-1, rank, n_out)
+        gram_inv = np.linalg.pinv(gram, hermitian=True)
+        sxy -= np.einsum('bie,bim->bem', qx,
+                         gram_inv @ qy)[:, exp_pos, out_pos]
+        sxx -= np.einsum('bie,bie->be', qx, gram_inv @ qx)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            coefs[:, block['position']] = sxy / sxx[:, exp_pos]
+    return coefs
+
+
+def _cluster_codes(dat: pd.DataFrame,
+                   cluster: str) -> np.ndarray:
+    """
+    Code of the cluster of each row, from 0 to the number of clusters. Rows
+    without a cluster can't be resampled, so they raise a ValueError.
+    """
+    clusters = pd.factorize(dat.loc[:, cluster])[0]
+    if (clusters < 0).any():
+        raise ValueError(f'{(clusters < 0).sum()} rows have a missing '
+                         f'{cluster}, drop them before the bootstrap')
+    return clusters
+
+
+def _draw_counts(rng: np.random.Generator,
+                 n_clusters: int,
+                 n_replicates: int) -> np.ndarray:
+    """
+    Number of times each cluster is drawn (with replacement) in each
+    replicate (n_replicates x n_clusters).
+    """
+    counts = rng.multinomial(n_clusters,
+                             np.full(n_clusters, 1 / n_clusters),
+                             size=n_replicates).astype(float)
+    return counts
+
+
+def _percentile_ci(coefs: np.ndarray,
+                   exposures: List[str],
+                   outcomes: List[str],
+                   alpha: float) -> pd.DataFrame:
+    """
+    Percentile confidence intervals from the bootstrap coefficients
+    (n_bootstrap x pairs), ignoring the replicates that couldn't be fitted.
+    """
+    with np.errstate(invalid='ignore'):
+        lower, upper = np.nanpercentile(coefs,
+                                        [100 * alpha / 2,
+                                         100 * (1 - alpha / 2)],
+                                        axis=0)
+    index = pd.MultiIndex.from_product([exposures, outcomes],
+                                       names=['exposures', 'metabolites'])
+    ci = pd.DataFrame({'coef_ci_lower': lower,
+                       'coef_ci_upper': upper},
+                      index=index)
+    return ci
+
+
+def bootstrap_ci(dat: pd.DataFrame,
+                 exposures: List[str],
+                 outcomes: List[str],
+                 covariates: List[str],
+                 exclude: Union[pd.DataFrame, None] = None,
+                 cluster: str = 'study_id',
+                 n_bootstrap: int = 2000,
+                 alpha: float = 0.05,
+                 seed: Union[int, None] = None,
+                 n_jobs: int = 1,
+                 chunk_size: int = 50,
+                 cache: Union[regression.DesignCache, None] = None) -> \
+        pd.DataFrame:
+    """
+    Percentile confidence intervals of the exposure coefficient of every
+    exposure and outcome pair, with a bootstrap of the participants.
+
+    The rows of a participant (cluster) are resampled together, and every
+    replicate refits all the pairs with the batched least squares of
+    regression.ols_association.
+
+    Parameters
+    ----------
+    dat: pd.DataFrame
+        Data frame with exposures, outcomes, covariates and the cluster
+        column.
+    exposures: List[str]
+        List of exposure columns.
+    outcomes: List[str]
+        List of outcome columns.
+    covariates: List[str]
+        List of covariate columns. An intercept is always added.
+    exclude: pd.DataFrame or None
+        Boolean data frame with the exposure and outcome columns, True for
+        the values to leave out of the fits (e.g. outliers).
+    cluster: str
+        Column with the participant IDs. Rows without one raise a
+        ValueError.
+    n_bootstrap: int
+        Number of bootstrap replicates.
+    alpha: float
+        Significance level, for a (1 - alpha) confidence interval.
+    seed: int or None
+        Seed of the random number generator.
+    n_jobs: int
+        Number of processes to run the replicates. -1 uses all the
+        available cores.
+    chunk_size: int
+        Number of replicates computed together.
+    cache: regression.DesignCache or None
+        Cache of the covariate designs of dat. If None, a new one is used.
+
+    Returns
+    -------
+    ci: pd.DataFrame
+        coef_ci_lower and coef_ci_upper columns, indexed by exposures and
+        outcomes.
+    """
+    blocks = regression.residualized_blocks(dat, exposures, outcomes,
+                                            covariates, exclude, cache)
+    blocks = [_bootstrap_products(block) for block in blocks]
+    clusters = _cluster_codes(dat, cluster)
+    n_pairs = len(exposures) * len(outcomes)
+    coefs = _run_chunks(_bootstrap_coefs, (blocks, n_pairs, clusters),
+                        n_bootstrap, seed, n_jobs, chunk_size)
+    return _percentile_ci(coefs, exposures, outcomes, alpha)
+
+
+def _lmm_bootstrap_coefs(task: Tuple[np.random.SeedSequence, int]) -> \
+        np.ndarray:
+    """
+    Exposure coefficients of the random intercept models of every pair for
+    a chunk of cluster bootstrap replicates.
+
+    The clusters are the groups of the random intercept. A cluster drawn
+    several times enters the group sums of mixed.fit_block with that weight,
+    so each replicate reuses the group statistics of the blocks.
+    """
+    seed, n_replicates = task
+    blocks, n_pairs, n_clusters = _worker_blocks
+    rng = np.random.default_rng(seed)
+    counts = _draw_counts(rng, n_clusters, n_replicates)
+    coefs = np.full((n_replicates, n_pairs), np.nan)
+    for block in blocks:
+        coef, _, converged = mixed.fit_block(block,
+                                             counts[:, block['groups']])
+        coefs[:, block['position']] = np.where(converged, coef, np.nan)
+    return coefs
+
+
+def lmm_bootstrap_ci(dat: pd.DataFrame,
+                     exposures: List[str],
+                     outcomes: List[str],
+                     covariates: List[str],
+                     exclude: Union[pd.DataFrame, None] = None,
+                     cluster: str = 'study_id',
+                     time: str = 'Visit',
+                     n_bootstrap: int = 2000,
+                     alpha: float = 0.05,
+                     seed: Union[int, None] = None,
+                     n_jobs: int = 1,
+                     chunk_size: int = 50,
+                     cache: Union[regression.DesignCache, None] = None) -> \
+        pd.DataFrame:
+    """
+    Percentile confidence intervals of the exposure coefficient of the
+    random intercept models (mixed.random_intercept_lmm) of every exposure
+    and outcome pair, with a bootstrap of the participants.
+
+    The rows of a participant (cluster, also the group of the random
+    intercept) are resampled together, and every replicate refits all the
+    pairs by REML from the group statistics of mixed.lmm_blocks.
+
+    Parameters
+    ----------
+    dat: pd.DataFrame
+        Data frame with exposures, outcomes, covariates, time and the
+        cluster column.
+    exposures: List[str]
+        List of exposure columns.
+    outcomes: List[str]
+        List of outcome columns.
+    covariates: List[str]
+        List of covariate columns. An intercept is always added.
+    exclude: pd.DataFrame or None
+        Boolean data frame with the exposure and outcome columns, True for
+        the values to leave out of the fits (e.g. outliers).
+    cluster: str
+        Column with the participant IDs. Rows without one raise a
+        ValueError.
+    time: str
+        Column interacting with the exposure (visit).
+    n_bootstrap: int
+        Number of bootstrap replicates.
+    alpha: float
+        Significance level, for a (1 - alpha) confidence interval.
+    seed: int or None
+        Seed of the random number generator.
+    n_jobs: int
+        Number of processes to run the replicates. -1 uses all the
+        available cores.
+    chunk_size: int
+        Number of replicates computed together.
+    cache: regression.DesignCache or None
+        Cache of the covariate designs of dat. If None, a new one is used.
+
+    Returns
+    -------
+    ci: pd.DataFrame
+        coef_ci_lower and coef_ci_upper columns, indexed by exposures and
+        outcomes.
+    """
+    clusters = _cluster_codes(dat, cluster)
+    blocks = mixed.lmm_blocks(dat, exposures, outcomes, covariates,
+                              group=cluster, time=time, exclude=exclude,
+                              cache=cache)
+    n_pairs = len(exposures) * len(outcomes)
+    coefs = _run_chunks(_lmm_bootstrap_coefs,
+                        (blocks, n_pairs, clusters.max() + 1),
+                        n_bootstrap, seed, n_jobs, chunk_size)
+    return _percentile_ci(coefs, exposures, outcomes, alpha)
@@ -0,0 +1,251 @@
+import numpy as np
+import scipy.sparse as sp
+
+from typing import List, Union
+from scipy.linalg import eigh
+from scipy.sparse.linalg import eigsh, norm as sparse_norm
+from sklearn.cluster import spectral_clustering
+
+# Fraction of non zero entries above which the diffused networks are
+# converted to dense arrays, since the sparse products are slower then
+DENSE_FRACTION = 0.05
+
+
+def normalize_affinity(W: Union[np.ndarray, sp.spmatrix]) -> \
+        Union[np.ndarray, sp.csr_matrix]:
+    '''
+    Normalize an affinity matrix so that each row sums to one, with half of
+    the weight on the diagonal (the full kernel P of SNF)
+
+    Parameters
+    ----------
+    W: np.array or sparse matrix
+        Affinity matrix
+
+    Returns
+    -------
+    P: np.array or sp.csr_matrix
+        Normalized affinity matrix, sparse if W is sparse
+    '''
+    mach_eps = np.finfo(float).eps
+    if sp.issparse(W):
+        P = sp.csr_matrix(W, dtype=float)
+        diagonal = P.diagonal()
+        off_sums = np.asarray(P.sum(axis=1)).ravel() - diagonal
+        P = sp.diags(1 / (2 * np.maximum(off_sums, mach_eps))) @ P
+        P = P - sp.diags(P.diagonal()) + sp.diags(np.full(P.shape[0], 0.5))
+        return sp.csr_matrix(P)
+    P = np.array(W, dtype=float)
+    diagonal = np.diagonal(P).copy()
+    off_sums = P.sum(axis=1) - diagonal
+    P /= (2 * np.maximum(off_sums, mach_eps))[:, None]
+    np.fill_diagonal(P, 0.5)
+    return P
+
+
+def knn_kernel(W: Union[np.ndarray, sp.spmatrix],
+               k: int = 20) -> sp.csr_matrix:
+    '''
+    Keep the k largest affinities of each row and normalize them to sum to
+    one (the sparse local kernel S of SNF)
+
+    Parameters
+    ----------
+    W: np.array or sparse matrix
+        Affinity matrix
+    k: int
+        Number of nearest neighbors
+
+    Returns
+    -------
+    S: sp.csr_matrix
+        Sparse kernel with k non zero entries per row (or all the stored
+        entries of the row if W is sparse and has fewer)
+    '''
+    if sp.issparse(W):
+        return _sparse_knn_kernel(W, k)
+    n = W.shape[0]
+    k = min(k, n)
+    cols = np.argpartition(-W, k - 1, axis=1)[:, :k]
+    vals = np.take_along_axis(W, cols, axis=1)
+    vals = vals / vals.sum(axis=1, keepdims=True)
+    rows = np.repeat(np.arange(n), k)
+    S = sp.csr_matrix((vals.ravel(), (rows, cols.ravel())), shape=(n, n))
+    return S
+
+
+def _sparse_knn_kernel(W: sp.spmatrix,
+                       k: int) -> sp.csr_matrix:
+    '''
+    knn_kernel of a sparse affinity matrix, from the stored entries of each
+    row, without building the dense matrix.
+    '''
+    W = sp.csr_matrix(W, dtype=float)
+    W.sum_duplicates()
+    n = W.shape[0]
+    rows = np.repeat(np.arange(n), np.diff(W.indptr))
+    # Entries sorted by row, and by decreasing affinity within each row
+    order = np.lexsort((-W.data, rows))
+    rank = np.arange(len(order)) - W.indptr[rows]
+    keep = order[rank < k]
+    rows, cols, vals = rows[keep], W.indices[keep], W.data[keep]
+    sums = np.bincount(rows, weights=vals, minlength=n)
+    S = sp.csr_matrix((vals / sums[rows], (rows, cols)), shape=(n, n))
+    return S
+
+
+def _norm(X: Union[np.ndarray, sp.spmatrix]) -> float:
+    '''
+    Frobenius norm of a dense or sparse matrix.
+    '''
+    if sp.issparse(X):
+        return sparse_norm(X)
+    return np.linalg.norm(X)
+
+
+def snf(affinities: List[Union[np.ndarray, sp.spmatrix]],
+        k: int = 20,
+        t: int = 20,
+        tol: float = 1e-6,
+        to_print: bool = True) -> np.ndarray:
+    '''
+    Similarity Network Fusion of several affinity matrices
+    (Wang et al. 2014, Nature Methods)
+
+    Each view is diffused through its sparse local kernel towards the
+    average of the other views until the networks stop changing. If all
+    the affinity matrices are sparse (e.g. from
+    affinity.knn_affinity_matrix), the networks are kept sparse while the
+    diffusion doesn't fill them in (more than DENSE_FRACTION non zero
+    entries), and converted to dense arrays after.
+
+    Parameters
+    ----------
+    affinities: List[np.array or sparse matrix]
+        Affinity matrices of the same samples, one per view
+    k: int
+        Number of nearest neighbors of the local kernels
+    t: int
+        Maximum number of iterations
+    tol: float
+        Relative change of the networks below which the fusion stops
+    to_print: bool
+        Print to screen information of function
+
+    Returns
+    -------
+    W: np.array or sp.csr_matrix
+        Fused affinity matrix, sparse if the networks stayed sparse
+    '''
+    n_views = len(affinities)
+    if n_views < 2:
+        raise ValueError('SNF needs at least two affinity matrices')
+    S = [knn_kernel(W, k) for W in affinities]
+    if not all(sp.issparse(W) for W in affinities):
+        affinities = [W.toarray() if sp.issparse(W) else W
+                      for W in affinities]
+    P = [normalize_affinity(W) for W in affinities]
+    P_sum = sum(P[1:], P[0])
+    converged = False
+    for iteration in range(t):
+        change = 0
+        P_new = []
+        for v in range(n_views):
+            others = (P_sum - P[v]) / (n_views - 1)
+            # S @ others @ S.T, with the sparse kernel on both sides
+            diffused = S[v] @ others
+            diffused = (S[v] @ diffused.transpose()).transpose()
+            diffused = normalize_affinity(diffused)
+            change = max(change, _norm(diffused - P[v]) / _norm(P[v]))
+            P_new.append(diffused)
+        P = P_new
+        P_sum = sum(P[1:], P[0])
+        if sp.issparse(P_sum) and \
+                P_sum.nnz > DENSE_FRACTION * P_sum.shape[0] ** 2:
+            P = [P_v.toarray() for P_v in P]
+            P_sum = sum(P[1:], P[0])
+        if change < tol:
+            converged = True
+            break
+
+    if to_print:
+        status = 'converged' if converged else 'did not converge'
+        print(f'SNF {status} after {iteration + 1} iterations '
+              f'(relative change {change:.2e})')
+    W = P_sum / n_views
+    W = (W + W.transpose()) / 2
+    if sp.issparse(W):
+        W = sp.csr_matrix(W)
+    return W
+
+
+def estimate_n_clusters(W: Union[np.ndarray, sp.spmatrix],
+                        max_clusters: int = 10) -> int:
+    '''
+    Estimate the number of clusters with the eigengap of the normalized
+    Laplacian of an affinity matrix
+
+    Parameters
+    ----------
+    W: np.array or sparse matrix
+        Affinity matrix
+    max_clusters: int
+        Maximum number of clusters to consider
+
+    Returns
+    -------
+    n_clusters: int
+        Number of clusters with the largest eigengap (at least 2, unless
+        there are fewer samples)
+    '''
+    n = W.shape[0]
+    max_clusters = min(max_clusters, n - 1)
+    if max_clusters < 2:
+        return n
+    degrees = np.asarray(W.sum(axis=1)).ravel()
+    d = 1 / np.sqrt(np.maximum(degrees, np.finfo(float).eps))
+    if sp.issparse(W) and max_clusters + 1 < n - 1:
+        # Smallest eigenvalues of the Laplacian, as the largest of the
+        # normalized affinity matrix
+        normalized = sp.diags(d) @ W @ sp.diags(d)
+        eigenvalues = 1 - eigsh(normalized, k=max_clusters + 1,
+                                which='LA', return_eigenvectors=False)
+        eigenvalues = np.sort(eigenvalues)
+    else:
+        if sp.issparse(W):
+            W = W.toarray()
+        laplacian = np.eye(n) - d[:, None] * W * d[None, :]
+        eigenvalues = eigh(laplacian,
+                           eigvals_only=True,
+                           subset_by_index=[0, max_clusters])
+    gaps = np.diff(eigenvalues)
+    n_clusters = int(np.argmax(gaps[1:]) + 2)
+    return n_clusters
+
+
+def spectral_clusters(W: np.ndarray,
+                      n_clusters: Union[int, None] = None,
+                      random_state: int = 0) -> np.ndarray:
+    '''
+    Spectral clustering of a (fused) affinity matrix
+
+    Parameters
+    ----------
+    W: np.array or sparse matrix
+        Affinity matrix
+    n_clusters: int or None
+        Number of clusters. If None, it's estimated with the eigengap
+    random_state: int
+        Seed for the k-means step
+
+    Returns
+    -------
+    labels: np.array
+        Cluster label of each sample
+    '''
+    if n_clusters is None:
+        n_clusters = estimate_n_clusters(W)
+    labels = spectral_clustering(W,
+                                 n_clusters=n_clusters,
+                                 random_state=random_state)
+    return labels
@@ -1,12 +1,13 @@
-import clarite
+import json
 import numpy as np
 import pandas as pd
 import scipy.cluster.hierarchy as sch
 
-from typing import Union, List
-from scipy.stats import zscore
+from typing import Dict, List, Tuple, Union
 from sklearn.preprocessing import StandardScaler
 from sklearn.decomposition import PCA
+from farmer_welder.data import clean
+from farmer_welder.stats import ewas
 
 
 def generate_PCA(D,
@@ -40,7 +41,9 @@ def EWAS(outcomes: List[str],
          covariates: List[str],
          predictors: List[str],
          data: pd.DataFrame,
-         remove_outliers: bool = False) -> pd.DataFrame:
+         remove_outliers: bool = False,
+         var_types: Union[Dict[str, str], pd.Series, None] = None) -> \
+        pd.DataFrame:
     """
     Run an environment-wide association study
 
@@ -56,37 +59,38 @@ def EWAS(outcomes: List[str],
         Data frame to use
     remove_outliers: bool
         Whether to remove outliers before the EWAS. Default False
+    var_types: dict, pd.Series or None
+        Type of the predictors and covariates ('continuous', 'binary' or
+        'categorical'). The missing ones are inferred from the number of
+        unique values.
 
     Returns
     -------
     res: pd.DataFrame
-        Results dataframe.
+        Results dataframe, in the format of clarite's association_study.
     """
     dat_clean = data.loc[:, covariates + predictors + outcomes]
     # Log2 and normalize
     dat_clean.loc[:, outcomes] = np.log2(
         dat_clean.loc[:, outcomes] + (1 / 100000000))
-    dat_clean = clarite.modify.categorize(dat_clean)
-    var_types = clarite.describe.get_types(dat_clean)
-    var_unknown = var_types[var_types == 'unknown'].index
-    dat_clean = clarite.modify.make_continuous(dat_clean,
-                                               only=var_unknown)
     if remove_outliers:
-        dat_clean.loc[:, outcomes] = clarite.modify.remove_outliers(
-            dat_clean.loc[:, outcomes])
-    res = clarite.analyze.association_study(outcomes=outcomes,
-                                            covariates=covariates,
-                                            regression_variables=predictors,
-                                            data=dat_clean,
-                                            min_n=10,
-                                            standardize_data=True)
+        outliers = clean.get_outlier_mask(dat_clean, outcomes)
+        dat_clean.loc[:, outcomes] = dat_clean.loc[:, outcomes].\
+            mask(outliers)
+    res = ewas.association_study(dat_clean,
+                                 outcomes=outcomes,
+                                 predictors=predictors,
+                                 covariates=covariates,
+                                 var_types=var_types,
+                                 min_n=10,
+                                 standardize_data=True)
     return res
 
 
 def transform_data(data: Union[pd.DataFrame, pd.Series],
                    log2_transform: bool = True,
                    zscore_transform: bool = True,
-                   grouping: Union[List[bool], None] = None,
+                   grouping: Union[List, pd.Series, np.ndarray, None] = None,
                    to_print: bool = True) -> \
         Union[pd.DataFrame, pd.Series]:
     """
@@ -100,55 +104,273 @@ def transform_data(data: Union[pd.DataFrame, pd.Series],
         Whether to log2 transform or not.
     zscore_transform: bool
         Whether to zscore transform or not.
-    grouping: Union[list[bool], None]
-        List of boolean to generate two groups on which to apply the zscore.
+    grouping: list, pd.Series, np.ndarray or None
+        Group of each row (e.g. a list of bool, or project IDs) on which to
+        apply the zscore separately. Any number of groups is supported.
     to_print: bool
         Print to screen information of function.
 
     Returns
     -------
-    transformed_data: pd.DataFrame
-        Transformed data
+    transformed_data: pd.DataFrame or pd.Series
+        Transformed data, in the same order as data.
     """
     if to_print:
         print('=== Transforming data ===')
-    transformed_data = data.copy()
-    if log2_transform:
-        if to_print:
+        if log2_transform:
             print('Log2 transformation ...')
-        transformed_data = np.log2(transformed_data + (1 / 100000000))
-
-    if zscore_transform:
-        if to_print:
+        if zscore_transform:
             print('Zscore transformation ...')
-        if grouping is not None:
-            not_grouping = [not elem for elem in grouping]
-            if isinstance(transformed_data, pd.DataFrame):
-                t1 = pd.DataFrame(transformed_data.loc[grouping, :].
-                                  apply(zscore, nan_policy='omit'))
-                t2 = pd.DataFrame(transformed_data.loc[not_grouping, :].
-                                  apply(zscore, nan_policy='omit'))
-            elif isinstance(transformed_data, pd.Series):
-                t1 = pd.Series(zscore(transformed_data.loc[grouping],
-                                      nan_policy='omit'))
-                t2 = pd.Series(zscore(transformed_data.loc[not_grouping],
-                                      nan_policy='omit'))
-            else:
-                t1 = pd.DataFrame()
-                t2 = pd.DataFrame()
-            transformed_data = pd.concat([t1, t2])
-        else:
-            if isinstance(transformed_data, pd.DataFrame):
-                transformed_data = transformed_data.apply(zscore,
-                                                          nan_policy='omit')
-            elif isinstance(transformed_data, pd.Series):
-                transformed_data = pd.Series(zscore(transformed_data,
-                                                    nan_policy='omit'))
+    transformer = DataTransformer(log2_transform, zscore_transform)
+    transformed_data = transformer.fit_transform(data, grouping)
     if to_print:
         print('')
     return transformed_data
 
 
+class DataTransformer:
+    """
+    Log2 transformation and group-wise zscore normalization with fitted
+    parameters, so the same transformation can be applied to new data,
+    inverted, and persisted.
+
+    Parameters
+    ----------
+    log2_transform: bool
+        Whether to log2 transform or not.
+    zscore_transform: bool
+        Whether to zscore transform or not.
+    """
+    offset = 1 / 100000000
+
+    def __init__(self,
+                 log2_transform: bool = True,
+                 zscore_transform: bool = True):
+        self.log2_transform = log2_transform
+        self.zscore_transform = zscore_transform
+        self.means = None
+        self.stds = None
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self.means.columns)
+
+    def fit(self,
+            data: Union[pd.DataFrame, pd.Series],
+            groups: Union[pd.Series, np.ndarray, None] = None) -> \
+            'DataTransformer':
+        """
+        Learn the mean and standard deviation of each column and group.
+
+        Parameters
+        ----------
+        data: pd.DataFrame or pd.Series
+            Data to fit.
+        groups: pd.Series, np.ndarray or None
+            Group label of each row. If None, all rows are one group.
+
+        Returns
+        -------
+        self: DataTransformer
+            Fitted transformer.
+        """
+        frame = data.to_frame() if isinstance(data, pd.Series) else data
+        values = self._log2(frame)
+        grouped = values.groupby(self._get_groups(frame, groups))
+        self.means = grouped.mean()
+        self.stds = grouped.std(ddof=0)
+        return self
+
+    def fit_transform(self,
+                      data: Union[pd.DataFrame, pd.Series],
+                      groups: Union[pd.Series, np.ndarray, None] = None) -> \
+            Union[pd.DataFrame, pd.Series]:
+        """
+        Fit the transformation and apply it to the same data.
+
+        The statistics of all columns are computed at once per group, and
+        the rows keep their original order.
+
+        Parameters
+        ----------
+        data: pd.DataFrame or pd.Series
+            Data to fit and transform.
+        groups: pd.Series, np.ndarray or None
+            Group label of each row. If None, all rows are one group.
+
+        Returns
+        -------
+        transformed_data: pd.DataFrame or pd.Series
+            Transformed data, with the same index as data.
+        """
+        return self.fit(data, groups).transform(data, groups)
+
+    def transform(self,
+                  data: Union[pd.DataFrame, pd.Series],
+                  groups: Union[pd.Series, np.ndarray, None] = None) -> \
+            Union[pd.DataFrame, pd.Series]:
+        """
+        Apply the fitted transformation.
+
+        Parameters
+        ----------
+        data: pd.DataFrame or pd.Series
+            Data to transform, with a subset of the fitted columns.
+        groups: pd.Series, np.ndarray or None
+            Group label of each row, among the fitted groups.
+
+        Returns
+        -------
+        transformed_data: pd.DataFrame or pd.Series
+            Transformed data, with the same index as data.
+        """
+        frame = data.to_frame() if isinstance(data, pd.Series) else data
+        transformed = self._log2(frame)
+        if self.zscore_transform:
+            means, stds = self._get_params(frame, groups)
+            transformed = (transformed - means) / stds
+        if isinstance(data, pd.Series):
+            return transformed.iloc[:, 0]
+        return transformed
+
+    def inverse_transform(self,
+                          data: Union[pd.DataFrame, pd.Series],
+                          groups: Union[pd.Series, np.ndarray, None] =
+                          None) -> Union[pd.DataFrame, pd.Series]:
+        """
+        Revert the fitted transformation.
+
+        Parameters
+        ----------
+        data: pd.DataFrame or pd.Series
+            Transformed data, with a subset of the fitted columns.
+        groups: pd.Series, np.ndarray or None
+            Group label of each row, among the fitted groups.
+
+        Returns
+        -------
+        original_data: pd.DataFrame or pd.Series
+            Data in the original scale.
+        """
+        frame = data.to_frame() if isinstance(data, pd.Series) else data
+        original = frame.astype(float)
+        if self.zscore_transform:
+            means, stds = self._get_params(frame, groups)
+            original = original * stds + means
+        if self.log2_transform:
+            original = np.exp2(original) - self.offset
+        if isinstance(data, pd.Series):
+            return original.iloc[:, 0]
+        return original
+
+    def get_params(self) -> dict:
+        """
+        Get the fitted parameters as a JSON serializable dictionary.
+
+        Returns
+        -------
+        params: dict
+            Transformation options, columns, groups, means and stds.
+        """
+        params = {'log2_transform': self.log2_transform,
+                  'zscore_transform': self.zscore_transform,
+                  'columns': self.columns,
+                  'groups': self.means.index.tolist(),
+                  'means': self.means.to_numpy().tolist(),
+                  'stds': self.stds.to_numpy().tolist()}
+        return params
+
+    @classmethod
+    def from_params(cls,
+                    params: dict) -> 'DataTransformer':
+        """
+        Build a fitted transformer from the output of get_params.
+
+        Parameters
+        ----------
+        params: dict
+            Fitted parameters.
+
+        Returns
+        -------
+        transformer: DataTransformer
+            Fitted transformer.
+        """
+        transformer = cls(params['log2_transform'],
+                          params['zscore_transform'])
+        index = pd.Index(params['groups'])
+        transformer.means = pd.DataFrame(params['means'],
+                                         index=index,
+                                         columns=params['columns'])
+        transformer.stds = pd.DataFrame(params['stds'],
+                                        index=index,
+                                        columns=params['columns'])
+        return transformer
+
+    def save(self,
+             path: str):
+        """
+        Save the fitted parameters to a JSON file.
+
+        Parameters
+        ----------
+        path: str
+            Path to the file.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.get_params(), f, indent=2)
+
+    @classmethod
+    def load(cls,
+             path: str) -> 'DataTransformer':
+        """
+        Load a fitted transformer from a JSON file.
+
+        Parameters
+        ----------
+        path: str
+            Path to the file.
+
+        Returns
+        -------
+        transformer: DataTransformer
+            Fitted transformer.
+        """
+        with open(path) as f:
+            params = json.load(f)
+        return cls.from_params(params)
+
+    def _log2(self,
+              data: pd.DataFrame) -> pd.DataFrame:
+        values = data.astype(float)
+        if self.log2_transform:
+            values = np.log2(values + self.offset)
+        return values
+
+    @staticmethod
+    def _get_groups(data: pd.DataFrame,
+                    groups: Union[pd.Series, np.ndarray, None]) -> \
+            np.ndarray:
+        if groups is None:
+            return np.zeros(len(data), dtype=int)
+        return np.asarray(groups)
+
+    def _get_params(self,
+                    data: pd.DataFrame,
+                    groups: Union[pd.Series, np.ndarray, None]) -> \
+            Tuple[np.ndarray, np.ndarray]:
+        groups = self._get_groups(data, groups)
+        positions = self.means.index.get_indexer(groups)
+        unknown = positions == -1
+        if unknown.any():
+            raise ValueError(f'Groups not seen during the fit: '
+                             f'{set(groups[unknown])}')
+        columns = list(data.columns)
+        means = self.means.loc[:, columns].to_numpy()[positions]
+        stds = self.stds.loc[:, columns].to_numpy()[positions]
+        return means, stds
+
+
 def cluster_corr(corr_array):
     """
     Rearranges the correlation matrix, corr_array, so that groups of highly
@@ -1,9 +1,12 @@
+import os
 import numpy as np
 import pandas as pd
+import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.lines as mlines
 
-from typing import Union, List
+from typing import Any, Callable, Dict, List, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor
 from matplotlib import cm
 from farmer_welder.stats import stats
 
@@ -165,9 +168,10 @@ def plot_pca_scores(pca_scores: np.ndarray,
                             pca_scores[:, comp + 1])
             comp = comp + 2
 
-    plt.tight_layout()
-    plt.savefig('results/figures/' + filename + '.pdf',
+    fig.tight_layout()
+    fig.savefig('results/figures/' + filename + '.pdf',
                 dpi=600)
+    plt.close(fig)
 
 
 def correlation_plot(data: Union[pd.DataFrame, np.ndarray],
@@ -235,3 +239,47 @@ def correlation_plot(data: Union[pd.DataFrame, np.ndarray],
                       ha='right')
         ax.set_yticks(np.arange(len(correlations)),
                       labels=labels)
+
+
+def _init_renderer():
+    """
+    Use a non-interactive backend in the rendering processes.
+    """
+    matplotlib.use('Agg')
+
+
+def _render(job: Tuple[Callable, Dict[str, Any]]) -> Any:
+    plot, kwargs = job
+    return plot(**kwargs)
+
+
+def render_jobs(jobs: List[Tuple[Callable, Dict[str, Any]]],
+                n_jobs: int = 1) -> list:
+    """
+    Render several figures, in parallel if requested.
+
+    Each job is a plotting function and its keyword arguments. The function
+    must save and close its own figure, so the memory of each figure is
+    released as soon as it is written.
+
+    Parameters
+    ----------
+    jobs: List[Tuple[Callable, Dict[str, Any]]]
+        Plotting functions (defined at module level) and their arguments.
+    n_jobs: int
+        Number of processes to use. -1 uses all the available cores.
+
+    Returns
+    -------
+    results: list
+        Return values of the plotting functions, in the order of jobs.
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_init_renderer) as executor:
+            results = list(executor.map(_render, jobs))
+    else:
+        results = [_render(job) for job in jobs]
+    return results
@@ -0,0 +1,40 @@
+import numpy as np
+from scipy.stats import norm
+
+from farmer_welder.stats import affinity, distance
+
+
+def affinity_matrix_reference(dist: np.ndarray,
+                              k: int = 20,
+                              sigma: float = 0.5) -> np.ndarray:
+    """
+    Original implementation of affinity.affinity_matrix.
+    """
+    mach_eps = np.finfo(float).eps
+    dist_mat = (dist + dist.transpose()) / 2
+    np.fill_diagonal(dist_mat, 0)
+    dist_mat_sort = np.sort(dist_mat, axis=0)
+    means = np.mean(dist_mat_sort[1:k + 1], axis=0) + mach_eps
+    sig = (np.add.outer(means, means) / 2) / 3 * 2 + dist_mat / 3 + mach_eps
+    sig[sig <= mach_eps] = mach_eps
+    densities = norm.pdf(dist_mat, loc=0, scale=(sigma * sig))
+    return (densities + densities.transpose()) / 2
+
+
+def test_affinity_matrices_few_samples():
+    """
+    With fewer samples than neighbors, all the other samples are the
+    neighbors, as in the original implementation.
+    """
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(15, 4))
+    dist = distance.squared_distances(X)
+    expected = affinity_matrix_reference(dist)
+
+    np.testing.assert_allclose(affinity.affinity_matrix(dist), expected,
+                               rtol=1e-10)
+    np.testing.assert_allclose(
+        affinity.sparse_affinity_matrix(dist).toarray(), expected,
+        rtol=1e-10)
+    np.testing.assert_allclose(
+        affinity.knn_affinity_matrix(X).toarray(), expected, rtol=1e-8)
@@ -0,0 +1,35 @@
+import os
+import numpy as np
+import pandas as pd
+
+from farmer_welder.stats import stats
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def test_ewas_matches_clarite():
+    """
+    The native EWAS reproduces clarite.analyze.association_study (2.0.0)
+    on a small fixture with continuous, binary and categorical predictors
+    and missing values. The expected results were computed with the clarite
+    based EWAS of the original code.
+    """
+    data = pd.read_csv(os.path.join(DATA_DIR, 'ewas_fixture.csv'))
+    expected = pd.read_csv(os.path.join(DATA_DIR,
+                                        'ewas_clarite_expected.csv'),
+                           index_col=['Variable', 'Outcome'])
+    res = stats.EWAS(outcomes=['o1', 'o2'],
+                     covariates=['age', 'sex'],
+                     predictors=['x_cont', 'x_bin', 'x_cat'],
+                     data=data)
+
+    assert list(res.columns) == list(expected.columns)
+    assert list(res.index) == list(expected.index)
+    assert (res['Variable_type'] == expected['Variable_type']).all()
+    assert (res['Converged'] == expected['Converged']).all()
+    assert (res['N'] == expected['N']).all()
+    for col in ['Beta', 'SE', 'Beta_pvalue', 'LRT_pvalue', 'Diff_AIC',
+                'pvalue']:
+        np.testing.assert_allclose(res[col].to_numpy(dtype=float),
+                                   expected[col].to_numpy(dtype=float),
+                                   rtol=1e-8, atol=1e-12, err_msg=col)
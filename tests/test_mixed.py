@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+import statsmodels.formula.api as smf
+
+from farmer_welder.stats import mixed
+
+
+def make_data(n: int = 80,
+              seed: int = 0) -> pd.DataFrame:
+    """
+    Two visits per participant with a random intercept, and missing values
+    in different rows (a few participants keep a single visit).
+    """
+    rng = np.random.default_rng(seed)
+    study_id = np.repeat(np.arange(n), 2)
+    dat = pd.DataFrame({'study_id': study_id,
+                        'Visit': np.tile([1.0, 2.0], n),
+                        'age': np.repeat(rng.normal(50, 10, n), 2),
+                        'sexd': np.repeat(rng.integers(0, 2, n), 2).
+                        astype(float),
+                        'e0': rng.normal(size=2 * n),
+                        'e1': rng.normal(size=2 * n)})
+    intercept = rng.normal(size=n)[study_id]
+    for i in range(3):
+        dat['m' + str(i)] = 0.4 * dat['e0'] - 0.2 * i * dat['e1'] + \
+            0.1 * dat['e0'] * dat['Visit'] + 0.02 * dat['age'] + \
+            intercept + rng.normal(size=2 * n)
+    dat.loc[[3, 10], 'age'] = np.nan
+    dat.loc[[5, 50, 71], 'e1'] = np.nan
+    dat.loc[[7, 8], 'm1'] = np.nan
+    dat.loc[[60], 'm2'] = np.nan
+    return dat
+
+
+def gls_se(fit, term: str) -> float:
+    """
+    Standard error of a fixed effect, (X' V^-1 X)^-1, at the variance
+    components of a statsmodels MixedLM fit. statsmodels' bse instead
+    inverts the Hessian of the REML criterion over the fixed effects and
+    the variance components together, which differs by a few percent in
+    small samples.
+    """
+    X = fit.model.exog
+    groups = fit.model.groups
+    precision = np.zeros((X.shape[1], X.shape[1]))
+    for g in np.unique(groups):
+        Xg = X[groups == g]
+        V = fit.scale * np.eye(len(Xg)) + fit.cov_re.iloc[0, 0]
+        precision += Xg.T @ np.linalg.solve(V, Xg)
+    j = list(fit.params.index).index(term)
+    return np.sqrt(np.linalg.inv(precision)[j, j])
+
+
+def test_random_intercept_lmm_matches_statsmodels():
+    """
+    The closed form REML fits give the same coef and number of observations
+    as fitting each pair with statsmodels MixedLM, and the standard error
+    at its variance components.
+    """
+    dat = make_data()
+    exposures = ['e0', 'e1']
+    outcomes = ['m0', 'm1', 'm2']
+    res = mixed.random_intercept_lmm(dat, exposures, outcomes,
+                                     ['age', 'sexd'])
+
+    for exp in exposures:
+        for met in outcomes:
+            fit = smf.mixedlm(met + ' ~ age + sexd + ' + exp + ' * Visit',
+                              dat, groups=dat['study_id'],
+                              missing='drop').fit()
+            row = res.loc[(exp, met), :]
+            assert row['converged']
+            np.testing.assert_allclose(row['coef'], fit.params[exp],
+                                       rtol=1e-4)
+            np.testing.assert_allclose(row['se'], gls_se(fit, exp),
+                                       rtol=1e-4)
+            np.testing.assert_allclose(row['se'], fit.bse[exp], rtol=5e-2)
+            assert row['nobs'] == fit.nobs
+
+
+def test_random_intercept_lmm_too_few_rows(capsys):
+    """
+    The pairs with too few complete rows are left as not converged, and
+    reported.
+    """
+    dat = make_data()
+    dat.loc[4:, 'm2'] = np.nan
+    res = mixed.random_intercept_lmm(dat, ['e0'], ['m0', 'm2'],
+                                     ['age', 'sexd'])
+
+    assert res.loc[('e0', 'm0'), 'converged']
+    assert not res.loc[('e0', 'm2'), 'converged']
+    assert np.isnan(res.loc[('e0', 'm2'), 'coef'])
+    assert '1 pairs with too few complete rows' in capsys.readouterr().out
+
+
+def test_random_intercept_lmm_singular_design():
+    """
+    A rank deficient design (a constant covariate, or a single visit) leaves
+    its pairs as not converged instead of raising.
+    """
+    dat = make_data()
+    dat['proj'] = 1.0
+    res = mixed.random_intercept_lmm(dat, ['e0'], ['m0', 'm1'],
+                                     ['age', 'sexd', 'proj'])
+    assert not res['converged'].any()
+    assert res[['coef', 'se', 'pvalue']].isna().all().all()
+
+    res = mixed.random_intercept_lmm(dat.loc[dat['Visit'] == 1, :], ['e0'],
+                                     ['m0'], ['age', 'sexd'])
+    assert not res['converged'].any()
+    assert res[['coef', 'se', 'pvalue']].isna().all().all()
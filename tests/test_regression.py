@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import statsmodels.formula.api as smf
+
+from farmer_welder.stats import regression
+
+
+def make_data(n: int = 120,
+              seed: int = 0) -> pd.DataFrame:
+    """
+    Exposures, outcomes and covariates with missing values in different
+    rows, so the pairs don't all share their complete rows.
+    """
+    rng = np.random.default_rng(seed)
+    dat = pd.DataFrame({'age': rng.normal(50, 10, n),
+                        'sexd': rng.integers(0, 2, n).astype(float),
+                        'e0': rng.normal(size=n),
+                        'e1': rng.normal(size=n)})
+    for i in range(3):
+        dat['m' + str(i)] = 0.5 * dat['e0'] - 0.2 * i * dat['e1'] + \
+            0.02 * dat['age'] + rng.normal(size=n)
+    dat.loc[[3, 10], 'age'] = np.nan
+    dat.loc[[5, 50, 70], 'e1'] = np.nan
+    dat.loc[[7, 8], 'm1'] = np.nan
+    dat.loc[[60], 'm2'] = np.nan
+    return dat
+
+
+def test_ols_association_matches_statsmodels():
+    """
+    The batched least squares give the same coef, standard error, pvalue and
+    number of observations as fitting each pair with statsmodels OLS.
+    """
+    dat = make_data()
+    exposures = ['e0', 'e1']
+    outcomes = ['m0', 'm1', 'm2']
+    covariates = ['age', 'sexd']
+    exclude = pd.DataFrame(False, index=dat.index,
+                           columns=exposures + outcomes)
+    exclude.loc[[20, 21], 'm0'] = True
+    res = regression.ols_association(dat, exposures, outcomes, covariates,
+                                     exclude=exclude)
+
+    for exp in exposures:
+        for met in outcomes:
+            keep = ~exclude.loc[:, exp] & ~exclude.loc[:, met]
+            fit = smf.ols(met + ' ~ age + sexd + ' + exp, dat.loc[keep, :],
+                          missing='drop').fit()
+            row = res.loc[(exp, met), :]
+            np.testing.assert_allclose(row['coef'], fit.params[exp],
+                                       rtol=1e-10)
+            np.testing.assert_allclose(row['se'], fit.bse[exp], rtol=1e-10)
+            np.testing.assert_allclose(row['pvalue'], fit.pvalues[exp],
+                                       rtol=1e-8)
+            assert row['nobs'] == fit.nobs
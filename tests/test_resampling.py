@@ -0,0 +1,194 @@
+import numpy as np
+import pandas as pd
+import statsmodels.formula.api as smf
+
+from farmer_welder.stats import mixed, resampling
+
+
+def make_data(n: int = 80,
+              seed: int = 0) -> pd.DataFrame:
+    """
+    Two visits per participant with a random intercept, and missing values
+    in different rows.
+    """
+    rng = np.random.default_rng(seed)
+    study_id = np.repeat(np.arange(n), 2)
+    dat = pd.DataFrame({'study_id': study_id,
+                        'Visit': np.tile([1.0, 2.0], n),
+                        'age': np.repeat(rng.normal(50, 10, n), 2),
+                        'sexd': np.repeat(rng.integers(0, 2, n), 2).
+                        astype(float),
+                        'e0': rng.normal(size=2 * n),
+                        'e1': rng.normal(size=2 * n)})
+    intercept = rng.normal(size=n)[study_id]
+    for i in range(3):
+        dat['m' + str(i)] = 0.4 * dat['e0'] - 0.2 * i * dat['e1'] + \
+            0.02 * dat['age'] + intercept + rng.normal(size=2 * n)
+    dat.loc[[3, 10], 'age'] = np.nan
+    dat.loc[[5, 50, 71], 'e1'] = np.nan
+    dat.loc[[7, 8], 'm1'] = np.nan
+    return dat
+
+
+def replicates(dat: pd.DataFrame,
+               n_bootstrap: int,
+               seed: int):
+    """
+    Resampled data frames of the bootstrap replicates, drawn as the single
+    chunk of resampling._run_chunks. A participant drawn several times is
+    repeated as different participants.
+    """
+    clusters = pd.factorize(dat['study_id'])[0]
+    n_clusters = clusters.max() + 1
+    rng = np.random.default_rng(np.random.SeedSequence(seed).spawn(1)[0])
+    counts = rng.multinomial(n_clusters, np.full(n_clusters, 1 / n_clusters),
+                             size=n_bootstrap)
+    for count in counts:
+        drawn = np.repeat(np.arange(n_clusters), count)
+        copies = [dat.loc[clusters == c, :].assign(study_id=i)
+                  for i, c in enumerate(drawn)]
+        yield pd.concat(copies, ignore_index=True)
+
+
+def percentile_ci(coefs: np.ndarray,
+                  alpha: float = 0.05) -> np.ndarray:
+    """
+    Lower and upper percentiles of the bootstrap coefficients.
+    """
+    return np.nanpercentile(coefs, [100 * alpha / 2, 100 * (1 - alpha / 2)],
+                            axis=0).T
+
+
+def test_bootstrap_ci_matches_naive():
+    """
+    The weighted least squares of the replicates give the same intervals as
+    refitting statsmodels OLS on the resampled data frames.
+    """
+    dat = make_data()
+    exposures = ['e0', 'e1']
+    outcomes = ['m0', 'm1', 'm2']
+    ci = resampling.bootstrap_ci(dat, exposures, outcomes, ['age', 'sexd'],
+                                 n_bootstrap=20, seed=3, chunk_size=20)
+
+    coefs = []
+    for sample in replicates(dat, 20, 3):
+        coefs.append([smf.ols(met + ' ~ age + sexd + ' + exp, sample,
+                              missing='drop').fit().params[exp]
+                      for exp in exposures for met in outcomes])
+    np.testing.assert_allclose(ci.to_numpy(), percentile_ci(np.array(coefs)),
+                               rtol=1e-8)
+
+
+def test_lmm_bootstrap_ci_matches_naive():
+    """
+    The group weights of the replicates give the same intervals as refitting
+    the random intercept models on the resampled data frames.
+    """
+    dat = make_data()
+    exposures = ['e0', 'e1']
+    outcomes = ['m0', 'm1', 'm2']
+    ci = resampling.lmm_bootstrap_ci(dat, exposures, outcomes,
+                                     ['age', 'sexd'], n_bootstrap=20, seed=3,
+                                     chunk_size=20)
+
+    coefs = [mixed.random_intercept_lmm(sample, exposures, outcomes,
+                                        ['age', 'sexd'])['coef']
+             for sample in replicates(dat, 20, 3)]
+    np.testing.assert_allclose(ci.to_numpy(), percentile_ci(np.array(coefs)),
+                               rtol=1e-6)
+
+
+def test_bootstrap_ci_n_jobs():
+    """
+    The intervals only depend on the seed, not on the number of processes.
+    """
+    dat = make_data()
+    for bootstrap in [resampling.bootstrap_ci, resampling.lmm_bootstrap_ci]:
+        serial = bootstrap(dat, ['e0', 'e1'], ['m0', 'm1'], ['age', 'sexd'],
+                           n_bootstrap=40, seed=5, chunk_size=10)
+        parallel = bootstrap(dat, ['e0', 'e1'], ['m0', 'm1'],
+                             ['age', 'sexd'], n_bootstrap=40, seed=5,
+                             chunk_size=10, n_jobs=2)
+        pd.testing.assert_frame_equal(serial, parallel)
+
+
+def test_lmm_bootstrap_ci_degenerate_replicates():
+    """
+    The replicates without any participant of a rare covariate level have a
+    singular design. They are left out of the intervals instead of raising.
+    """
+    dat = make_data()
+    dat['sexd'] = 1.0
+    dat.loc[dat['study_id'] < 2, 'sexd'] = 0.0
+    blocks = mixed.lmm_blocks(dat, ['e0'], ['m0'], ['age', 'sexd'])
+    weights = np.ones((2, len(blocks[0]['stats']['n_g'])))
+    weights[1, :2] = 0
+    coef, se, converged = mixed.fit_block(blocks[0], weights)
+    assert converged[0].all() and not converged[1].any()
+    assert np.isnan(coef[1]).all() and np.isnan(se[1]).all()
+
+    ci = resampling.lmm_bootstrap_ci(dat, ['e0'], ['m0', 'm2'],
+                                     ['age', 'sexd'], n_bootstrap=200,
+                                     seed=0)
+    assert np.isfinite(ci.to_numpy()).all()
+
+
+def test_maxt_pvalues_matches_naive():
+    """
+    The max-T adjusted pvalues match a loop over the permutations of the
+    exposure residuals of each pair (Kennedy), with the same permutations.
+    The pairs without complete rows have missing pvalues and don't change
+    the others.
+    """
+    dat = make_data(n=40)
+    dat['m3'] = np.nan
+    exposures = ['e0', 'e1']
+    outcomes = ['m0', 'm1', 'm2', 'm3']
+    n_permutations = 50
+    res = resampling.maxt_pvalues(dat, exposures, outcomes, ['age', 'sexd'],
+                                  n_permutations=n_permutations, seed=2,
+                                  chunk_size=n_permutations)
+
+    rng = np.random.default_rng(np.random.SeedSequence(2).spawn(1)[0])
+    keys = rng.random((n_permutations, len(dat)))
+    observed = {}
+    max_t = np.zeros(n_permutations)
+    for exp in exposures:
+        for met in outcomes[:3]:
+            rows = np.flatnonzero(dat[['age', 'sexd', exp, met]].notna().
+                                  all(axis=1))
+            sample = dat.iloc[rows, :]
+            fit = smf.ols(met + ' ~ age + sexd + ' + exp, sample).fit()
+            observed[(exp, met)] = np.abs(fit.tvalues[exp])
+            res_exp = smf.ols(exp + ' ~ age + sexd', sample).fit().resid.\
+                to_numpy()
+            res_out = smf.ols(met + ' ~ age + sexd', sample).fit().resid.\
+                to_numpy()
+            for b in range(n_permutations):
+                x = res_exp[np.argsort(keys[b, rows])]
+                beta = x @ res_out / (x @ x)
+                rss = res_out @ res_out - beta * (x @ res_out)
+                t = beta / np.sqrt(rss / fit.df_resid / (x @ x))
+                max_t[b] = max(max_t[b], np.abs(t))
+
+    for exp in exposures:
+        for met in outcomes[:3]:
+            expected = (1 + (max_t >= observed[(exp, met)]).sum()) / \
+                (n_permutations + 1)
+            np.testing.assert_allclose(res[(exp, met)], expected)
+        assert np.isnan(res[(exp, 'm3')])
+
+
+def test_maxt_pvalues_n_jobs():
+    """
+    The adjusted pvalues only depend on the seed, not on the number of
+    processes.
+    """
+    dat = make_data()
+    serial = resampling.maxt_pvalues(dat, ['e0', 'e1'], ['m0', 'm1', 'm2'],
+                                     ['age', 'sexd'], n_permutations=200,
+                                     seed=4, chunk_size=30)
+    parallel = resampling.maxt_pvalues(dat, ['e0', 'e1'], ['m0', 'm1', 'm2'],
+                                       ['age', 'sexd'], n_permutations=200,
+                                       seed=4, chunk_size=30, n_jobs=2)
+    pd.testing.assert_series_equal(serial, parallel)
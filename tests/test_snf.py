@@ -0,0 +1,59 @@
+import numpy as np
+import scipy.sparse as sp
+
+from farmer_welder.stats import affinity, snf
+
+
+def make_affinities(n: int = 60,
+                    seed: int = 0):
+    """
+    Sparse kNN affinity matrices of three noisy views of the same samples.
+    """
+    rng = np.random.default_rng(seed)
+    base = rng.normal(size=(n, 5))
+    return [affinity.knn_affinity_matrix(base + rng.normal(size=(n, 5)),
+                                         k=10)
+            for _ in range(3)]
+
+
+def test_sparse_kernels_match_dense():
+    """
+    The kernels of a sparse affinity matrix are sparse and equal to the
+    kernels of its dense version.
+    """
+    W = make_affinities()[0]
+    S = snf.knn_kernel(W, k=10)
+    P = snf.normalize_affinity(W)
+    assert sp.issparse(S) and sp.issparse(P)
+    np.testing.assert_allclose(S.toarray(),
+                               snf.knn_kernel(W.toarray(), k=10).toarray(),
+                               rtol=1e-12)
+    np.testing.assert_allclose(P.toarray(),
+                               snf.normalize_affinity(W.toarray()),
+                               rtol=1e-12)
+
+
+def test_snf_sparse_matches_dense(monkeypatch):
+    """
+    Fusing sparse affinity matrices gives the same network as fusing their
+    dense versions, whether the networks are kept sparse or not.
+    """
+    affinities = make_affinities()
+    expected = snf.snf([W.toarray() for W in affinities], k=10,
+                       to_print=False)
+    fused = snf.snf(affinities, k=10, to_print=False)
+    np.testing.assert_allclose(fused, expected, rtol=1e-10)
+
+    monkeypatch.setattr(snf, 'DENSE_FRACTION', 1.0)
+    fused = snf.snf(affinities, k=10, to_print=False)
+    assert sp.issparse(fused)
+    np.testing.assert_allclose(fused.toarray(), expected, rtol=1e-10)
+
+
+def test_estimate_n_clusters_few_samples():
+    """
+    The eigengap doesn't fail with fewer samples than clusters to consider.
+    """
+    for n in range(1, 5):
+        W = np.ones((n, n)) + np.eye(n)
+        assert 1 <= snf.estimate_n_clusters(W) <= n